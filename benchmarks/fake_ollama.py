@@ -0,0 +1,263 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+
+class FakeOllamaServer:
+    """
+    Local stub of the Ollama HTTP API, for benchmarks that should not need a GPU.
+
+    Chat responses are streamed as `tokens_per_response` tokens of `token_size` characters at `tokens_per_second`.
+    Loading a model that is not resident takes `load_seconds`, at most `max_loaded_models` stay resident (least
+    recently used are evicted) until their keep_alive expires.
+    """
+
+    def __init__(
+        self,
+        tokens_per_second: float = 2000,
+        tokens_per_response: int = 32,
+        token_size: int = 4,
+        models: Optional[list[str]] = None,
+        load_seconds: float = 0,
+        max_loaded_models: Optional[int] = None,
+        pull_layer_sizes: tuple[int, ...] = (4096, 1024),
+        host: str = '127.0.0.1',
+        port: int = 0,
+    ) -> None:
+        self.tokens_per_second = tokens_per_second
+        self.tokens_per_response = tokens_per_response
+        self.token_size = token_size
+        self.models = models or ['fake-model-1', 'fake-model-2']
+        self.load_seconds = load_seconds
+        self.max_loaded_models = max_loaded_models
+        self.pull_layer_sizes = pull_layer_sizes
+        self.requests: list[tuple[str, dict]] = []
+        # Number of times a model had to be loaded.
+        self.loads = 0
+        self._loaded: OrderedDict[str, datetime] = OrderedDict()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-ollama', daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def __enter__(self) -> 'FakeOllamaServer':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def generate_tokens(self) -> list[str]:
+        token = 'x' * (self.token_size - 1) + ' '
+        return [token] * self.tokens_per_response
+
+    def load_model(self, model: str, keep_alive=None) -> int:
+        """Make the model resident, returns the load duration in nanoseconds."""
+        with self._lock:
+            now = datetime.now(timezone.utc)
+            for name, expires_at in list(self._loaded.items()):
+                if expires_at <= now:
+                    del self._loaded[name]
+
+            was_loaded = model in self._loaded
+            if not was_loaded:
+                self.loads += 1
+                while self.max_loaded_models and len(self._loaded) >= self.max_loaded_models:
+                    self._loaded.popitem(last=False)
+            self._loaded[model] = now + _parse_keep_alive(keep_alive)
+            self._loaded.move_to_end(model)
+
+        if was_loaded:
+            return 0
+        time.sleep(self.load_seconds)
+        return int(self.load_seconds * 1e9)
+
+    def get_loaded_models(self) -> dict[str, datetime]:
+        with self._lock:
+            now = datetime.now(timezone.utc)
+            return {name: expires_at for name, expires_at in self._loaded.items() if expires_at > now}
+
+    def _make_handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Stream every token as soon as it is written, like Ollama does.
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                body = self._read_body()
+                server.requests.append((self.path, body))
+                if self.path == '/api/tags':
+                    self._send_json({'models': [_model_entry(model) for model in server.models]})
+                elif self.path == '/api/ps':
+                    self._send_json(
+                        {
+                            'models': [
+                                {**_model_entry(model), 'expires_at': expires_at.isoformat(), 'size_vram': 0}
+                                for model, expires_at in server.get_loaded_models().items()
+                            ]
+                        }
+                    )
+                else:
+                    self._send_json({'error': 'not found'}, status=404)
+
+            def do_POST(self) -> None:
+                body = self._read_body()
+                server.requests.append((self.path, body))
+                if self.path == '/api/chat':
+                    self._chat(body)
+                elif self.path == '/api/generate':
+                    self._send_json({**_stats_fields(body.get('model', ''), 0, 0, 0), 'response': '', 'done': True})
+                elif self.path == '/api/show':
+                    self._send_json({'modelfile': '', 'parameters': '', 'template': '', 'details': {}})
+                elif self.path == '/api/pull':
+                    self._pull(body)
+                else:
+                    self._send_json({'error': 'not found'}, status=404)
+
+            def do_DELETE(self) -> None:
+                server.requests.append((self.path, self._read_body()))
+                self._send_json({})
+
+            def _chat(self, body: dict) -> None:
+                model = body.get('model', '')
+                load_duration = server.load_model(model, body.get('keep_alive'))
+                if not body.get('messages'):
+                    # Ollama only loads the model when there is nothing to answer.
+                    self._send_json(
+                        {
+                            **_stats_fields(model, 0, 0, 0),
+                            'load_duration': load_duration,
+                            'message': {'role': 'assistant', 'content': ''},
+                            'done': True,
+                            'done_reason': 'load',
+                        }
+                    )
+                    return
+
+                prompt_tokens = sum(len(message.get('content', '')) // 4 for message in body.get('messages', []))
+                tokens = server.generate_tokens()
+                eval_duration = int(len(tokens) / server.tokens_per_second * 1e9)
+                final = {
+                    **_stats_fields(model, prompt_tokens, len(tokens), eval_duration),
+                    'load_duration': load_duration,
+                    'message': {'role': 'assistant', 'content': ''},
+                    'done': True,
+                    'done_reason': 'stop',
+                }
+
+                if not body.get('stream', True):
+                    final['message']['content'] = ''.join(tokens)
+                    self._send_json(final)
+                    return
+
+                delay = 1 / server.tokens_per_second
+                chunks = (
+                    {
+                        'model': model,
+                        'created_at': _now(),
+                        'message': {'role': 'assistant', 'content': t},
+                        'done': False,
+                    }
+                    for t in tokens
+                )
+                self._stream(chunks, delay=delay, final=final)
+
+            def _pull(self, body: dict) -> None:
+                model = body.get('model') or body.get('name', '')
+                chunks = [{'status': 'pulling manifest'}]
+                for i, layer_size in enumerate(server.pull_layer_sizes):
+                    digest = f'sha256:{i:064x}'
+                    step = max(layer_size // 4, 1)
+                    chunks += [
+                        {'status': f'pulling {digest[7:19]}', 'digest': digest, 'total': layer_size, 'completed': c}
+                        for c in range(0, layer_size + 1, step)
+                    ]
+                chunks += [{'status': 'verifying sha256 digest'}, {'status': 'writing manifest'}, {'status': 'success'}]
+                self._stream(chunks)
+                if model not in server.models:
+                    server.models.append(model)
+
+            def _read_body(self) -> dict:
+                length = int(self.headers.get('Content-Length') or 0)
+                return json.loads(self.rfile.read(length) or b'{}') if length else {}
+
+            def _send_json(self, payload: dict, status: int = 200) -> None:
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, chunks, delay: float = 0, final: Optional[dict] = None) -> None:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/x-ndjson')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                try:
+                    for chunk in chunks:
+                        if delay:
+                            time.sleep(delay)
+                        self._write_chunk(chunk)
+                    if final:
+                        self._write_chunk(final)
+                    self.wfile.write(b'0\r\n\r\n')
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client cancelled the request, like a discarded speculative turn.
+                    self.close_connection = True
+
+            def _write_chunk(self, payload: dict) -> None:
+                data = (json.dumps(payload) + '\n').encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                self.wfile.flush()
+
+        return Handler
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _model_entry(model: str) -> dict:
+    return {'model': model, 'name': model, 'size': 0, 'digest': '', 'details': {}}
+
+
+def _stats_fields(model: str, prompt_tokens: int, eval_tokens: int, eval_duration: int) -> dict:
+    return {
+        'model': model,
+        'created_at': _now(),
+        'total_duration': eval_duration,
+        'load_duration': 0,
+        'prompt_eval_count': prompt_tokens,
+        'prompt_eval_duration': 0,
+        'eval_count': eval_tokens,
+        'eval_duration': eval_duration,
+    }
+
+
+def _parse_keep_alive(keep_alive) -> timedelta:
+    """Ollama's keep_alive, seconds or a duration like '30m', defaults to 5 minutes."""
+    if keep_alive is None:
+        return timedelta(minutes=5)
+    if isinstance(keep_alive, (int, float)):
+        return timedelta(seconds=keep_alive) if keep_alive >= 0 else timedelta(days=365)
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    for suffix in sorted(units, key=len, reverse=True):
+        if keep_alive.endswith(suffix):
+            return timedelta(seconds=float(keep_alive[: -len(suffix)]) * units[suffix])
+    return timedelta(seconds=float(keep_alive))
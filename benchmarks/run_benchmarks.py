@@ -0,0 +1,270 @@
+"""
+Measure the overhead of llm-talks itself against a local fake Ollama server, no GPU needed.
+
+Usage: python -m benchmarks.run_benchmarks --turns 10 --turns 100 --turns 1000
+
+Benchmark conversations are written to the configured database and removed afterwards.
+"""
+
+import contextlib
+import functools
+import io
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import click
+import rich
+from click.testing import CliRunner
+from rich.console import Console
+from rich.table import Table
+from sqlalchemy import event
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from cli.batch import run_batch
+from cli.cli import cli, print_transcript
+from cli.rendering import LiveStreamRenderer
+from database.db import get_async_db_engine, get_db_engine
+from integrations.ollama_manager import OllamaManager
+from models.chat import Chat
+from models.conversation import Conversation
+
+
+@dataclass
+class BenchmarkResult:
+    scenario: str
+    turns: int
+    total_s: float
+    db_s: float
+    render_s: float = 0.0
+    turn_latencies_ms: list[float] = field(default_factory=list, repr=False)
+    ttft_ms: list[float] = field(default_factory=list, repr=False)
+
+    def summary(self) -> dict:
+        return {
+            'scenario': self.scenario,
+            'turns': self.turns,
+            'total_s': round(self.total_s, 3),
+            'turn_p50_ms': percentile(self.turn_latencies_ms, 50),
+            'turn_p95_ms': percentile(self.turn_latencies_ms, 95),
+            'ttft_p50_ms': percentile(self.ttft_ms, 50),
+            'db_ms_per_turn': round(self.db_s * 1000 / max(self.turns, 1), 3),
+            'render_ms': round(self.render_s * 1000, 3),
+        }
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))], 3)
+
+
+class DBTimer:
+    """Accumulates the time spent executing statements on the sync and async engines."""
+
+    def __init__(self, *engines) -> None:
+        self.total = 0.0
+        self._lock = threading.Lock()
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._before)
+            event.listen(engine, 'after_cursor_execute', self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany) -> None:
+        elapsed = time.perf_counter() - conn.info['query_started_at'].pop()
+        with self._lock:
+            self.total += elapsed
+
+
+class RenderTimer:
+    """
+    Times the renderer of run-conversation while patched in: the whole turn it shows, the first chunk and the time
+    spent rendering.
+    """
+
+    def __init__(self) -> None:
+        self.total = 0.0
+        self.turn_latencies_ms: list[float] = []
+        self.ttft_ms: list[float] = []
+        self._turn_started_at: Optional[float] = None
+        self._rendering = False
+
+    def _timed(self, method):
+        @functools.wraps(method)
+        def timed(renderer, *args, **kwargs):
+            # write flushes and __exit__ flushes, count the outermost call only.
+            if self._rendering:
+                return method(renderer, *args, **kwargs)
+            self._rendering = True
+            started_at = time.perf_counter()
+            try:
+                return method(renderer, *args, **kwargs)
+            finally:
+                self.total += time.perf_counter() - started_at
+                self._rendering = False
+
+        return timed
+
+    @contextlib.contextmanager
+    def patch(self):
+        original = {name: getattr(LiveStreamRenderer, name) for name in ('__enter__', 'write', 'flush', '__exit__')}
+
+        def enter(renderer):
+            self._turn_started_at = time.perf_counter()
+            return original['__enter__'](renderer)
+
+        def write(renderer, chunk):
+            if len(self.ttft_ms) < len(self.turn_latencies_ms) + 1:
+                self.ttft_ms.append((time.perf_counter() - self._turn_started_at) * 1000)
+            original['write'](renderer, chunk)
+
+        def exit_(renderer, *exc_info):
+            original['__exit__'](renderer, *exc_info)
+            self.turn_latencies_ms.append((time.perf_counter() - self._turn_started_at) * 1000)
+
+        for name, method in (('__enter__', enter), ('write', write), ('flush', original['flush']), ('__exit__', exit_)):
+            setattr(LiveStreamRenderer, name, self._timed(method))
+        try:
+            yield self
+        finally:
+            for name, method in original.items():
+                setattr(LiveStreamRenderer, name, method)
+
+
+def set_up_conversation(prefix: str):
+    agent_1_chat = Chat.set_up_agent(model='fake-model-1', system_message=f'{prefix} agent 1')
+    agent_2_chat = Chat.set_up_agent(model='fake-model-2', system_message=f'{prefix} agent 2')
+    return Conversation(agent_1_chat_id=agent_1_chat.id, agent_2_chat_id=agent_2_chat.id).save()
+
+
+def remove_conversation(conv_id: int) -> None:
+    Conversation.delete_many([conv_id])
+
+
+def bench_chat(timer: DBTimer, conv_id: int, turns: int) -> BenchmarkResult:
+    sender, responder = Conversation.load(conv_id).get_turn_order()
+    result = BenchmarkResult('ollama_manager.chat', turns, 0, 0)
+    db_before, started_at = timer.total, time.perf_counter()
+
+    for _ in range(turns):
+        turn_started_at = time.perf_counter()
+        first_chunk_at = None
+        for _chunk in OllamaManager.chat(sender_agent_chat=sender, responder_agent_chat=responder):
+            first_chunk_at = first_chunk_at or time.perf_counter()
+        result.turn_latencies_ms.append((time.perf_counter() - turn_started_at) * 1000)
+        result.ttft_ms.append(((first_chunk_at or time.perf_counter()) - turn_started_at) * 1000)
+        sender, responder = responder, sender
+
+    result.total_s = time.perf_counter() - started_at
+    result.db_s = timer.total - db_before
+    return result
+
+
+def bench_run_conversation(timer: DBTimer, conv_id: int, turns: int) -> BenchmarkResult:
+    """Run the run-conversation command non-interactively, rendering into a terminal that is not shown."""
+    conversation = Conversation.load(conv_id)
+    conversation.max_turns = turns
+    conversation.save()
+
+    # Live only redraws on a terminal, the command's output goes to rich's console.
+    rich.reconfigure(file=io.StringIO(), force_terminal=True, width=120)
+    render_timer = RenderTimer()
+    db_before, started_at = timer.total, time.perf_counter()
+    try:
+        with render_timer.patch():
+            arguments = ['run-conversation', '--conv_id', str(conv_id), '--interactive', 'False', '--tail', '0']
+            output = CliRunner().invoke(cli, arguments).output
+    finally:
+        rich.reconfigure()
+    total = time.perf_counter() - started_at
+    assert '❌' not in output, output
+
+    return BenchmarkResult(
+        'run_conversation',
+        turns,
+        total,
+        timer.total - db_before,
+        render_s=render_timer.total,
+        turn_latencies_ms=render_timer.turn_latencies_ms,
+        ttft_ms=render_timer.ttft_ms,
+    )
+
+
+def bench_run_batch(timer: DBTimer, conv_id: int, turns: int) -> BenchmarkResult:
+    db_before, started_at = timer.total, time.perf_counter()
+    # The headless runner writes one JSON line per turn, keep those out of the report.
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        run_batch([conv_id], max_turns=turns, concurrency=1)
+
+    result = BenchmarkResult('run_batch', turns, time.perf_counter() - started_at, 0)
+    result.db_s = timer.total - db_before
+    for line in output.getvalue().splitlines():
+        record = json.loads(line)
+        if record['event'] == 'turn_completed':
+            result.turn_latencies_ms.append(record['duration_s'] * 1000)
+    return result
+
+
+def bench_show_conversation(timer: DBTimer, conv_id: int, turns: int) -> BenchmarkResult:
+    console = Console(file=io.StringIO(), width=120)
+    db_before, started_at = timer.total, time.perf_counter()
+    print_transcript(Conversation.load(conv_id), console=console)
+    total = time.perf_counter() - started_at
+
+    db_s = timer.total - db_before
+    return BenchmarkResult('show_conversation', turns, total, db_s, render_s=total - db_s)
+
+
+@click.command()
+@click.option('--turns', type=int, multiple=True, default=[10, 100, 1000], show_default=True)
+@click.option('--tokens-per-second', type=float, default=2000, show_default=True, help='Fake server token rate.')
+@click.option('--tokens-per-response', type=int, default=32, show_default=True)
+@click.option('--token-size', type=int, default=4, show_default=True, help='Characters per fake token.')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON lines.')
+def main(turns: tuple[int], tokens_per_second: float, tokens_per_response: int, token_size: int, as_json: bool):
+    """Benchmark chat, run-conversation, run-batch and show of conversations of the given lengths."""
+    with FakeOllamaServer(
+        tokens_per_second=tokens_per_second, tokens_per_response=tokens_per_response, token_size=token_size
+    ) as server:
+        # Must be set before the first Ollama client is created.
+        os.environ['OLLAMA_HOST'] = server.url
+
+        timer = DBTimer(get_db_engine(), get_async_db_engine().sync_engine)
+        results = []
+        for turn_count in turns:
+            chat_conv = set_up_conversation(f'benchmark chat {turn_count}')
+            run_conv = set_up_conversation(f'benchmark run {turn_count}')
+            batch_conv = set_up_conversation(f'benchmark batch {turn_count}')
+            try:
+                results.append(bench_chat(timer, chat_conv.id, turn_count))
+                results.append(bench_run_conversation(timer, run_conv.id, turn_count))
+                results.append(bench_run_batch(timer, batch_conv.id, turn_count))
+                results.append(bench_show_conversation(timer, chat_conv.id, turn_count))
+            finally:
+                remove_conversation(chat_conv.id)
+                remove_conversation(run_conv.id)
+                remove_conversation(batch_conv.id)
+
+    if as_json:
+        for result in results:
+            click.echo(json.dumps(result.summary()))
+        return
+
+    table = Table(title='llm-talks benchmarks')
+    columns = list(results[0].summary()) if results else []
+    for column in columns:
+        table.add_column(column)
+    for result in results:
+        table.add_row(*[str(value) for value in result.summary().values()])
+    Console().print(table)
+
+
+if __name__ == '__main__':
+    main()
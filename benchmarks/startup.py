@@ -0,0 +1,85 @@
+"""
+Measure the cold start cost of every CLI command, each run in a fresh interpreter.
+
+Usage: python -m benchmarks.startup --runs 5
+
+Every command is timed with --help, which is what parsing and importing cost before the command runs. Commands that
+only talk to Ollama are also run for real against the fake server, they should never import the database layer.
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import click
+from rich.console import Console
+from rich.table import Table
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from cli.cli import cli
+
+ENTRY_POINT = str(Path(__file__).resolve().parent.parent / 'llm-talks.py')
+HEAVY_MODULES = ['sqlalchemy', 'ollama', 'rich', 'simple_term_menu']
+
+
+def run_cold(args: list[str], env: dict) -> tuple[float, float, set[str]]:
+    """Wall time and import time in ms, and the heavy top level packages imported by one run."""
+    started_at = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', ENTRY_POINT, *args], capture_output=True, text=True, env=env
+    )
+    wall_ms = (time.perf_counter() - started_at) * 1000
+
+    import_us, imported = 0, set()
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, package = line[len('import time:') :].split('|')
+        import_us += int(self_us)
+        imported.add(package.strip().split('.')[0])
+
+    return wall_ms, import_us / 1000, imported & set(HEAVY_MODULES)
+
+
+def measure(name: str, args: list[str], runs: int, env: dict) -> dict:
+    samples = [run_cold(args, env) for _ in range(runs)]
+    return {
+        'command': name,
+        'wall_ms_p50': round(statistics.median(s[0] for s in samples), 1),
+        'import_ms_p50': round(statistics.median(s[1] for s in samples), 1),
+        'heavy_imports': ','.join(sorted(samples[-1][2])) or '-',
+    }
+
+
+@click.command()
+@click.option('--runs', type=int, default=5, show_default=True, help='Cold starts per command, the median is shown.')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON lines.')
+def main(runs: int, as_json: bool):
+    """Benchmark the startup time of every llm-talks command."""
+    with FakeOllamaServer() as server:
+        env = {**os.environ, 'OLLAMA_HOST': server.url}
+        cases = [('--help', ['--help'])]
+        cases += [(f'{name} --help', [name, '--help']) for name in sorted(cli.commands)]
+        cases += [('list-models', ['list-models']), ('show-model', ['show-model', '--model', 'fake-model-1'])]
+        results = [measure(name, args, runs, env) for name, args in cases]
+
+    if as_json:
+        for result in results:
+            click.echo(json.dumps(result))
+        return
+
+    table = Table(title='llm-talks startup')
+    for column in results[0]:
+        table.add_column(column)
+    for result in results:
+        table.add_row(*[str(value) for value in result.values()])
+    Console().print(table)
+
+
+if __name__ == '__main__':
+    main()
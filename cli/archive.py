@@ -0,0 +1,262 @@
+import gzip
+import io
+import json
+from datetime import datetime
+from enum import Enum
+from typing import IO, Iterable, Iterator, Optional
+
+from sqlalchemy import Connection, DateTime, Table, bindparam, insert, select, update
+
+from database.db import get_db_engine
+from models.chat import Chat
+from models.chat_message import ChatMessage
+from models.conversation import Conversation
+from models.message_content import MessageContent
+
+ARCHIVE_VERSION = 1
+BATCH_SIZE = 1000
+COMPRESSIONS = {'.gz': 'gzip', '.zst': 'zstd'}
+
+# Rows of these tables are written in this order, every record only references records written before it. The
+# exception is chat.parent_message_id, which is set once the messages are imported.
+CHAT_TABLE: Table = Chat.__table__
+MESSAGE_TABLE: Table = ChatMessage.__table__
+CONVERSATION_TABLE: Table = Conversation.__table__
+CONTENT_TABLE: Table = MessageContent.__table__
+
+
+def get_compression(path: str, compression: Optional[str] = None) -> Optional[str]:
+    """The given compression, or the one matching the file extension. None for plain JSONL."""
+    if compression:
+        return None if compression == 'none' else compression
+    return next((name for suffix, name in COMPRESSIONS.items() if path.endswith(suffix)), None)
+
+
+def open_archive(path: str, mode: str, compression: Optional[str] = None) -> IO[str]:
+    """Open an archive for reading ('r') or writing ('w') as text, compressing it on the fly."""
+    if compression == 'gzip':
+        return gzip.open(path, f'{mode}t', encoding='utf-8')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError as e:
+            raise RuntimeError('zstd compression needs the zstandard package, run pip install zstandard.') from e
+
+        raw = open(path, f'{mode}b')
+        if mode == 'w':
+            stream = zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+        return io.TextIOWrapper(stream, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def _to_record(record_type: str, row: dict) -> str:
+    values = {
+        key: value.value if isinstance(value, Enum) else value.isoformat() if isinstance(value, datetime) else value
+        for key, value in row.items()
+    }
+    return json.dumps({'type': record_type, **values}, ensure_ascii=False) + '\n'
+
+
+def _from_record(table: Table, record: dict) -> dict:
+    """Column values of a record, converted back to what the columns take. Unknown fields are ignored."""
+    values = {}
+    for column in table.columns:
+        if column.name not in record:
+            continue
+        value = record[column.name]
+        if value is not None and isinstance(column.type, DateTime):
+            value = datetime.fromisoformat(value)
+        elif value is not None and getattr(column.type, 'enum_class', None):
+            value = column.type.enum_class(value)
+        values[column.name] = value
+    return values
+
+
+def _get_exported_chat_ids(connection: Connection, conv_ids: list[int]) -> list[int]:
+    """Chats of the conversations and the chats they were forked from, whose history they share."""
+    chat_ids = set()
+    pending = {
+        chat_id
+        for row in connection.execute(
+            select(CONVERSATION_TABLE.c.agent_1_chat_id, CONVERSATION_TABLE.c.agent_2_chat_id).where(
+                CONVERSATION_TABLE.c.id.in_(conv_ids)
+            )
+        )
+        for chat_id in row
+    }
+    while pending:
+        chat_ids |= pending
+        pending = {
+            parent_chat_id
+            for parent_chat_id in connection.execute(
+                select(CHAT_TABLE.c.parent_chat_id).where(
+                    CHAT_TABLE.c.id.in_(pending), CHAT_TABLE.c.parent_chat_id.is_not(None)
+                )
+            ).scalars()
+        } - chat_ids
+    return sorted(chat_ids)
+
+
+def export_conversations(output: IO[str], conv_ids: Optional[list[int]] = None) -> dict[str, int]:
+    """
+    Write the conversations, all of them if no ids are given, with their chats and messages to output as JSONL.
+    Rows are streamed from server-side cursors, memory use does not grow with the size of the export.
+    Returns the number of records written per type.
+    """
+    counts = {'conversation': 0, 'chat': 0, 'chat_message': 0}
+    output.write(_to_record('header', {'version': ARCHIVE_VERSION}))
+
+    with get_db_engine().connect() as connection:
+        chat_ids = _get_exported_chat_ids(connection, conv_ids) if conv_ids is not None else None
+
+        chats = select(CHAT_TABLE).order_by(CHAT_TABLE.c.id)
+        messages = (
+            select(*[c for c in MESSAGE_TABLE.columns if c.name != 'content_id'], CONTENT_TABLE.c.content)
+            .join(CONTENT_TABLE, CONTENT_TABLE.c.id == MESSAGE_TABLE.c.content_id)
+            .order_by(MESSAGE_TABLE.c.id)
+        )
+        conversations = select(CONVERSATION_TABLE).order_by(CONVERSATION_TABLE.c.id)
+        if conv_ids is not None:
+            chats = chats.where(CHAT_TABLE.c.id.in_(chat_ids))
+            messages = messages.where(MESSAGE_TABLE.c.chat_id.in_(chat_ids))
+            conversations = conversations.where(CONVERSATION_TABLE.c.id.in_(conv_ids))
+
+        for record_type, statement in (('chat', chats), ('chat_message', messages), ('conversation', conversations)):
+            for row in connection.execution_options(yield_per=BATCH_SIZE).execute(statement).mappings():
+                output.write(_to_record(record_type, row))
+                counts[record_type] += 1
+
+    return counts
+
+
+def _read_records(lines: Iterable[str]) -> Iterator[dict]:
+    lines = iter(lines)
+    header = json.loads(next(lines, 'null'))
+    assert header and header.get('type') == 'header', 'not a conversation archive, the header is missing.'
+    assert header['version'] <= ARCHIVE_VERSION, f'archive version {header["version"]} is not supported.'
+
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+
+
+def _batches(records: Iterator[dict]) -> Iterator[tuple[str, list[dict]]]:
+    """Consecutive records of the same type, at most BATCH_SIZE at a time."""
+    batch_type, batch = None, []
+    for record in records:
+        if batch and (record['type'] != batch_type or len(batch) >= BATCH_SIZE):
+            yield batch_type, batch
+            batch = []
+        batch_type = record['type']
+        batch.append(record)
+    if batch:
+        yield batch_type, batch
+
+
+def _insert_returning_ids(connection: Connection, table: Table, rows: list[dict]) -> list[int]:
+    """Insert the rows in one statement and return their new ids, in the order of the rows."""
+    statement = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+    return list(connection.execute(statement, rows).scalars())
+
+
+def _get_content_ids(connection: Connection, contents: list[str]) -> dict[str, int]:
+    """Map each content hash to the id of its message_content row, inserting the missing ones."""
+    hashes = {MessageContent.compute_hash(content): content for content in contents}
+    content_ids = dict(
+        connection.execute(
+            select(CONTENT_TABLE.c.hash, CONTENT_TABLE.c.id).where(CONTENT_TABLE.c.hash.in_(list(hashes)))
+        ).all()
+    )
+    missing = [{'hash': h, 'content': c} for h, c in hashes.items() if h not in content_ids]
+    if missing:
+        content_ids.update(
+            zip([row['hash'] for row in missing], _insert_returning_ids(connection, CONTENT_TABLE, missing))
+        )
+    return content_ids
+
+
+def import_conversations(lines: Iterable[str]) -> dict[str, int]:
+    """
+    Import an archive written by export_conversations, in one transaction. Every row gets a new id, references
+    between the imported rows are remapped. Archives with forks but not the chats they were forked from are rejected.
+    Returns the number of records imported per type.
+    """
+    counts = {'conversation': 0, 'chat': 0, 'chat_message': 0}
+    chat_ids: dict[int, int] = {}
+    # Forks, as new chat id to the exported ids of the chat and message they were forked at, and the new ids of those
+    # messages. Only the ids of fork points are kept, so memory does not grow with the number of messages.
+    fork_points: dict[int, tuple[int, int]] = {}
+    message_ids: dict[int, int] = {}
+    fork_message_ids: set[int] = set()
+
+    with get_db_engine().begin() as connection:
+        for record_type, records in _batches(_read_records(lines)):
+            if record_type == 'chat':
+                # A parent can be in the same batch, forks are linked to their parents after the messages.
+                rows = [
+                    {**_from_record(CHAT_TABLE, record), 'parent_chat_id': None, 'parent_message_id': None}
+                    for record in records
+                ]
+                for row in rows:
+                    del row['id']
+                new_ids = _insert_returning_ids(connection, CHAT_TABLE, rows)
+                for record, new_id in zip(records, new_ids):
+                    chat_ids[record['id']] = new_id
+                    if record.get('parent_chat_id') is not None:
+                        fork_points[new_id] = (record['parent_chat_id'], record['parent_message_id'])
+                        fork_message_ids.add(record['parent_message_id'])
+
+            elif record_type == 'chat_message':
+                content_ids = _get_content_ids(connection, [record['content'] for record in records])
+                rows = []
+                for record in records:
+                    row = _from_record(MESSAGE_TABLE, record)
+                    del row['id']
+                    row['chat_id'] = chat_ids[row['chat_id']]
+                    row['content_id'] = content_ids[MessageContent.compute_hash(record['content'])]
+                    rows.append(row)
+                if any(record['id'] in fork_message_ids for record in records):
+                    new_ids = _insert_returning_ids(connection, MESSAGE_TABLE, rows)
+                    message_ids.update(
+                        (record['id'], new_id)
+                        for record, new_id in zip(records, new_ids)
+                        if record['id'] in fork_message_ids
+                    )
+                else:
+                    connection.execute(insert(MESSAGE_TABLE), rows)
+
+            elif record_type == 'conversation':
+                rows = []
+                for record in records:
+                    row = _from_record(CONVERSATION_TABLE, record)
+                    del row['id']
+                    row['agent_1_chat_id'] = chat_ids[row['agent_1_chat_id']]
+                    row['agent_2_chat_id'] = chat_ids[row['agent_2_chat_id']]
+                    rows.append(row)
+                connection.execute(insert(CONVERSATION_TABLE), rows)
+
+            else:
+                raise ValueError(f'unknown record type {record_type}')
+
+            counts[record_type] += len(records)
+
+        # A fork without the chat it was forked from would lose the history it shares, including its system message.
+        for parent_chat_id, message_id in fork_points.values():
+            assert parent_chat_id in chat_ids and message_id in message_ids, (
+                f'a chat is forked from chat {parent_chat_id} at message {message_id}, which are not in the archive.'
+            )
+
+        if fork_points:
+            connection.execute(
+                update(CHAT_TABLE)
+                .where(CHAT_TABLE.c.id == bindparam('chat_id'))
+                .values(parent_chat_id=bindparam('parent_id'), parent_message_id=bindparam('message_id')),
+                [
+                    {'chat_id': chat_id, 'parent_id': chat_ids[parent_chat_id], 'message_id': message_ids[message_id]}
+                    for chat_id, (parent_chat_id, message_id) in fork_points.items()
+                ],
+            )
+
+    return counts
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+import click
+
+from database.db import AsyncSessionLocal, session, transaction
+from enums.enums import RepetitionAction
+from integrations.event_loop import BackgroundEventLoop
+from integrations.ollama_manager import AsyncOllamaManager, OllamaManager, StreamStats
+from models.chat import Chat
+from models.conversation import Conversation
+
+
+def log_event(event: str, **fields) -> None:
+    """Write a single structured (JSON) progress line."""
+    record = {'ts': datetime.now(timezone.utc).isoformat(), 'event': event, **fields}
+    click.echo(json.dumps(record, default=str))
+
+
+def create_conversations_from_spec(spec_path: str) -> list[int]:
+    """
+    Create the conversations described in a JSON spec file and return their ids.
+
+    The spec is a list of entries like
+    {"agent_1": {"model": "...", "system_message": "...", "context_token_budget": null}, "agent_2": {...}, "count": 1,
+     "budget": {"max_turns": null, "max_generated_tokens": null, "max_wall_seconds": null}}
+    """
+    with open(spec_path) as spec_file:
+        spec = json.load(spec_file)
+
+    assert isinstance(spec, list), 'spec file must contain a list of conversations'
+
+    # All conversations of the spec are created in one transaction, or none if any entry is invalid.
+    conversations = []
+    with transaction():
+        for entry in spec:
+            for _ in range(entry.get('count', 1)):
+                agent_1_chat = Chat.set_up_agent(**entry['agent_1'])
+                agent_2_chat = Chat.set_up_agent(**entry['agent_2'])
+                conversations.append(
+                    Conversation(
+                        agent_1_chat_id=agent_1_chat.id, agent_2_chat_id=agent_2_chat.id, **entry.get('budget', {})
+                    ).save()
+                )
+        conv_ids = [conv.id for conv in conversations]
+
+    for conv_id in conv_ids:
+        log_event('conversation_created', conv_id=conv_id)
+    return conv_ids
+
+
+async def run_conversation_headless(
+    manager: AsyncOllamaManager, conversation: Conversation, sender: Chat, responder: Chat, max_turns: int
+) -> int:
+    """
+    Run up to max_turns turns of the given conversation without any TTY rendering, or until one of its budgets is
+    used up. Returns turns taken.
+    """
+    conv_id = conversation.id
+    for turn in range(1, max_turns + 1):
+        # Checked between turns against the stored counters, so a rerun continues where the last run stopped.
+        exhausted_budget = conversation.get_exhausted_budget()
+        if exhausted_budget:
+            log_event('budget_exhausted', conv_id=conv_id, budget=exhausted_budget)
+            return turn - 1
+
+        started_at = time.perf_counter()
+        response_length = 0
+        stream_stats = StreamStats()
+        async for chunk in manager.chat(
+            sender_agent_chat=sender, responder_agent_chat=responder, stream_stats=stream_stats
+        ):
+            response_length += len(chunk)
+
+        # The whole turn counts towards the wall time, waiting for the model and saving the messages included.
+        seconds = time.perf_counter() - started_at
+        async with AsyncSessionLocal() as db_session:
+            await conversation.record_turn_async(db_session, generated_tokens=stream_stats.eval_count, seconds=seconds)
+
+        log_event(
+            'turn_completed',
+            conv_id=conv_id,
+            turn=turn,
+            model=sender.default_model,
+            response_chars=response_length,
+            generated_tokens=stream_stats.eval_count,
+            duration_s=round(seconds, 3),
+        )
+
+        similarity = manager.repetition.similarities.get(sender.id) if manager.repetition else None
+        action = await manager.handle_repetition(sender, responder)
+        if action != RepetitionAction.CONTINUE:
+            log_event('repetition_detected', conv_id=conv_id, turn=turn, similarity=similarity, action=action.value)
+        if action == RepetitionAction.STOP:
+            return turn
+
+        sender, responder = responder, sender
+
+    return max_turns
+
+
+async def run_batch_async(
+    turn_orders: dict[int, tuple[Conversation, Chat, Chat]],
+    max_turns: int,
+    concurrency: int,
+    max_loaded_models: Optional[int],
+) -> dict[int, bool]:
+    manager = OllamaManager.get_async_manager()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # Load the models before the first turn and, on a memory constrained server, group turns by model.
+    manager.residency.max_loaded_models = max_loaded_models
+    models = [chat.default_model for _, *chats in turn_orders.values() for chat in chats]
+    await manager.residency.preload(models)
+    log_event('models_preloaded', models=sorted(await manager.residency.get_loaded_models()))
+
+    async def run_one(conversation: Conversation, sender: Chat, responder: Chat) -> bool:
+        async with semaphore:
+            try:
+                turns = await run_conversation_headless(manager, conversation, sender, responder, max_turns)
+                log_event(
+                    'conversation_completed',
+                    conv_id=conversation.id,
+                    turns=turns,
+                    total_turns=conversation.turn_count,
+                    total_generated_tokens=conversation.generated_token_count,
+                    total_wall_s=round(conversation.wall_seconds, 3),
+                )
+                return True
+            except Exception as e:
+                log_event('conversation_failed', conv_id=conversation.id, error=str(e))
+                return False
+
+    results = await asyncio.gather(*(run_one(*turn_order) for turn_order in turn_orders.values()))
+    log_event('model_switches', count=manager.residency.switches)
+    if manager.response_cache:
+        log_event('response_cache', hits=manager.response_cache.hits, misses=manager.response_cache.misses)
+    return dict(zip(turn_orders, results))
+
+
+def run_batch(
+    conv_ids: list[int], max_turns: int, concurrency: int, max_loaded_models: Optional[int] = None
+) -> dict[int, bool]:
+    """Run the conversations concurrently, at most `concurrency` at a time. Returns success per conversation."""
+    results = {}
+    log_event(
+        'batch_started',
+        conversations=len(conv_ids),
+        max_turns=max_turns,
+        concurrency=concurrency,
+        max_loaded_models=max_loaded_models,
+    )
+
+    # Conversations are loaded up front, the turns themselves run on the background event loop.
+    turn_orders = {}
+    for conv_id in conv_ids:
+        try:
+            conversation = Conversation.load(conv_id)
+            turn_order = (conversation, *conversation.get_turn_order())
+            # Used on the event loop thread from here on, detached so nothing lazy loads through this thread's session.
+            for instance in turn_order:
+                session.expunge(instance)
+            turn_orders[conv_id] = turn_order
+        except Exception as e:
+            results[conv_id] = False
+            log_event('conversation_failed', conv_id=conv_id, error=str(e))
+
+    if turn_orders:
+        results.update(
+            BackgroundEventLoop.run(
+                run_batch_async(
+                    turn_orders, max_turns=max_turns, concurrency=concurrency, max_loaded_models=max_loaded_models
+                )
+            )
+        )
+
+    log_event('batch_completed', succeeded=sum(results.values()), failed=len(results) - sum(results.values()))
+    return results
@@ -1,18 +1,18 @@
+from typing import TYPE_CHECKING, Callable, Iterable, Optional
+
 import click
 
-from enums.enums import ChatRole, TextAlignment
-from models.chat import Chat
-from integrations.ollama_manager import OllamaManager
-from database.clean_db import clean_db
-from database.init_db import init_db
-from simple_term_menu import TerminalMenu
+# Commands import what they need when they run, so startup and --help only pay for click. Models, the database,
+# ollama and rich are heavy to import, and the database is only configured where it is used.
+if TYPE_CHECKING:
+    from datetime import datetime, timedelta
 
-from models.chat_message import ChatMessage
-from models.conversation import Conversation
+    from integrations.ollama_manager import SpeculativeChat
+    from models.chat_message import ChatMessage
+    from models.conversation import Conversation
+    from rich.console import Console
 
-from rich.text import Text
-from rich.console import Console
-from rich.live import Live
+FOLLOW_POLL_SECONDS = 1
 
 
 @click.group()
@@ -20,9 +20,72 @@ def cli():
     pass
 
 
+def budget_options(command: Callable) -> Callable:
+    """Options for the turn, token and wall time budgets of a conversation, unlimited if not given."""
+    for option in reversed(
+        [
+            click.option('--max_turns', type=int, default=None, help='Stop the conversation after this many turns.'),
+            click.option(
+                '--max_generated_tokens',
+                type=int,
+                default=None,
+                help='Stop the conversation once the agents generated this many tokens.',
+            ),
+            click.option(
+                '--max_wall_time',
+                type=str,
+                default=None,
+                callback=lambda ctx, param, value: parse_duration(value),
+                help='Stop the conversation after generating for this long, like 30m or 2h.',
+            ),
+        ]
+    ):
+        command = option(command)
+    return command
+
+
+def generation_options(command: Callable) -> Callable:
+    """Options for sampling the responses, the model's defaults if not given."""
+    for option in reversed(
+        [
+            click.option(
+                '--seed',
+                type=int,
+                default=None,
+                help='Seed for sampling, with the same seed the same prompt gets the same response.',
+            ),
+            click.option(
+                '--temperature',
+                type=click.FloatRange(min=0),
+                default=None,
+                help='Sampling temperature, 0 always picks the most likely token.',
+            ),
+        ]
+    ):
+        command = option(command)
+    return command
+
+
 @click.command()
-def set_up_conversation() -> None:
+@click.option(
+    '--context_token_budget',
+    type=int,
+    default=None,
+    help='Max tokens of history sent to each agent, older turns are summarized. Sends the full history if not set.',
+)
+@budget_options
+def set_up_conversation(
+    context_token_budget: Optional[int],
+    max_turns: Optional[int],
+    max_generated_tokens: Optional[int],
+    max_wall_time: Optional['timedelta'],
+) -> None:
     """Set up a conversation."""
+    from integrations.ollama_manager import OllamaManager
+    from models.chat import Chat
+    from models.conversation import Conversation
+    from simple_term_menu import TerminalMenu
+
     try:
         manager = OllamaManager()
         download_models = manager.get_downloaded_models()
@@ -39,92 +102,359 @@ def set_up_conversation() -> None:
 
             click.echo(f'Model: {model}')
 
-            new_chat = Chat(default_model=model).save()
-            chats.append(new_chat)
-
             system_message = click.prompt('Enter initial system message', type=str)
-            ChatMessage(chat_id=new_chat.id, role=ChatRole.SYSTEM, content=system_message).save()
-
-            # To get the models to start talking they both need to have empty user messages to start with.
-            ChatMessage(chat_id=new_chat.id, role=ChatRole.USER, content='').save()
+            chats.append(
+                Chat.set_up_agent(model=model, system_message=system_message, context_token_budget=context_token_budget)
+            )
 
             click.echo('\n')
 
-        conv = Conversation(agent_1_chat_id=chats[0].id, agent_2_chat_id=chats[1].id).save()
+        conv = Conversation(
+            agent_1_chat_id=chats[0].id,
+            agent_2_chat_id=chats[1].id,
+            max_turns=max_turns,
+            max_generated_tokens=max_generated_tokens,
+            max_wall_seconds=max_wall_time.total_seconds() if max_wall_time else None,
+        ).save()
         click.echo(f'✅ Conversation with id {conv.id} was successfully set up!')
     except Exception as e:
         click.echo(f'❌ {e}')
 
 
+@click.command()
+@click.option('--conv_id', type=int, required=True, help='Conversation ID')
+@budget_options
+@click.option('--clear', is_flag=True, help='Remove all budgets, applied before the ones given.')
+def set_budget(
+    conv_id: int,
+    max_turns: Optional[int],
+    max_generated_tokens: Optional[int],
+    max_wall_time: Optional['timedelta'],
+    clear: bool,
+) -> None:
+    """Set the turn, token and wall time budgets of a conversation."""
+    from models.conversation import Conversation
+
+    try:
+        conversation = Conversation.get_one(id=conv_id)
+        if clear:
+            conversation.max_turns = conversation.max_generated_tokens = conversation.max_wall_seconds = None
+        if max_turns is not None:
+            conversation.max_turns = max_turns
+        if max_generated_tokens is not None:
+            conversation.max_generated_tokens = max_generated_tokens
+        if max_wall_time is not None:
+            conversation.max_wall_seconds = max_wall_time.total_seconds()
+        conversation.save()
+
+        max_turns, max_generated_tokens, max_wall_seconds = (
+            'unlimited' if limit is None else round(limit)
+            for limit in (conversation.max_turns, conversation.max_generated_tokens, conversation.max_wall_seconds)
+        )
+        click.echo(
+            f'✅ Conversation {conv_id} used {conversation.turn_count} of {max_turns} turns, '
+            f'{conversation.generated_token_count} of {max_generated_tokens} tokens and '
+            f'{round(conversation.wall_seconds)} of {max_wall_seconds} seconds.'
+        )
+    except Exception as e:
+        click.echo(f'❌ {e}')
+
+
 @click.command()
 @click.option('--conv_id', type=str, help='Conversation ID')
-def show_conversation(conv_id: int) -> None:
+@click.option('--tail', type=int, default=None, help='Only show the last N messages.')
+@click.option('--page', type=int, default=None, help='Only show the given page of messages, starting at 1.')
+@click.option('--page_size', type=int, default=50, show_default=True, help='Messages per page, used with --page.')
+@click.option('--follow', is_flag=True, help='Keep showing new messages as they are added, until interrupted.')
+def show_conversation(conv_id: int, tail: Optional[int], page: Optional[int], page_size: int, follow: bool) -> None:
     """Prints the given conversation."""
-    try:
-        console = Console()
-        conv = Conversation.get_one(id=conv_id)
+    import time
 
-        for message in conv.merged_chat_history:
-            chat_bubble = conv.generate_chat_bubble(message)
-            console.print(
-                chat_bubble,
-                justify=chat_bubble.renderable.title_align,
+    from models.conversation import Conversation
+
+    try:
+        assert tail is None or page is None, '--tail and --page can not be combined.'
+        assert page is None or page >= 1, '--page starts at 1.'
+        conversation = Conversation.load(conv_id)
+        if tail is not None:
+            messages = conversation.load_transcript_tail(tail)
+        elif page is not None:
+            messages = conversation.load_transcript_page(page, page_size=page_size)
+        else:
+            # Rendered while the next rows are fetched, long transcripts start showing right away.
+            messages = conversation.iter_transcript()
+
+        last_message = print_transcript(conversation, messages=messages)
+        while follow:
+            time.sleep(FOLLOW_POLL_SECONDS)
+            last_message = (
+                print_transcript(
+                    conversation,
+                    conversation.iter_transcript(after_message_id=last_message.id if last_message else None),
+                )
+                or last_message
             )
+    except KeyboardInterrupt:
+        return
     except Exception as e:
         click.echo(f'❌ {e}')
         return
 
 
+def print_transcript(
+    conversation: 'Conversation',
+    messages: Optional[Iterable['ChatMessage']] = None,
+    console: Optional['Console'] = None,
+) -> Optional['ChatMessage']:
+    """Print the messages, the whole transcript if none are given. Returns the last message printed."""
+    from rich.console import Console
+
+    console = console or Console()
+    message = None
+    for message in conversation.iter_transcript() if messages is None else messages:
+        chat_bubble = conversation.generate_chat_bubble(message)
+        console.print(
+            chat_bubble,
+            justify=chat_bubble.renderable.title_align,
+        )
+    return message
+
+
+@click.command()
+@click.option('--conv_id', type=int, required=True, help='ID of the conversation to branch.')
+@click.option(
+    '--at-message',
+    'at_message',
+    type=int,
+    required=True,
+    help='ID of the message to branch after, shown under each message by show-conversation.',
+)
+@click.option('--count', type=int, default=1, show_default=True, help='Number of forks to create.')
+def fork_conversation(conv_id: int, at_message: int, count: int) -> None:
+    """Branch a conversation after the given message, sharing its history."""
+    from models.conversation import Conversation
+
+    try:
+        conversation = Conversation.load(conv_id)
+        forks = [conversation.fork(at_message_id=at_message) for _ in range(count)]
+
+        for fork in forks:
+            click.echo(f'✅ Conversation with id {fork.id} was forked from conversation {conv_id}!')
+        if count > 1:
+            conv_id_options = ' '.join(f'--conv_id {fork.id}' for fork in forks)
+            click.echo(f'Run them in parallel with: python llm-talks.py run-batch {conv_id_options}')
+    except Exception as e:
+        click.echo(f'❌ {e}')
+
+
 @click.command()
 @click.option('--conv_id', type=str, help='Conversation ID')
 @click.option(
     '--interactive', default=True, type=bool, help='Run the conversation interactively by adding system messages.'
 )
-@click.pass_context
-def run_conversation(ctx, conv_id: int, interactive: bool) -> None:
+@click.option(
+    '--render/--no-render', default=True, help='Render responses live in chat bubbles or write them as plain text.'
+)
+@click.option(
+    '--cache_responses',
+    is_flag=True,
+    help='Replay responses to identical prompts from a local cache, for reruns of seeded conversations.',
+)
+@generation_options
+@click.option(
+    '--tail',
+    type=int,
+    default=6,
+    show_default=True,
+    help='Messages of the transcript to show before continuing, use show-conversation for the rest.',
+)
+@click.option(
+    '--repetition_threshold',
+    type=click.FloatRange(0, 1),
+    default=None,
+    help="Stop when a response is this similar (0-1) to one of the agent's last responses, like 0.8.",
+)
+@click.option(
+    '--repetition_nudge',
+    type=str,
+    default=None,
+    help='System message added to both agents the first time they repeat themselves, instead of stopping.',
+)
+def run_conversation(
+    conv_id: int,
+    interactive: bool,
+    render: bool,
+    cache_responses: bool,
+    seed: Optional[int],
+    temperature: Optional[float],
+    tail: int,
+    repetition_threshold: Optional[float],
+    repetition_nudge: Optional[str],
+) -> None:
     """Run the given conversation."""
+    import time
+
+    from cli.rendering import LiveStreamRenderer, PlainStreamRenderer
+    from enums.enums import RepetitionAction
+    from integrations.ollama_manager import OllamaManager, StreamStats
+    from models.conversation import Conversation
+
     try:
-        conversation = Conversation.get_one(id=conv_id)
+        OllamaManager.set_generation_options(seed=seed, temperature=temperature)
+        response_cache = OllamaManager.enable_response_cache() if cache_responses else None
+        if repetition_threshold is not None:
+            OllamaManager.enable_repetition_detection(threshold=repetition_threshold, nudge=repetition_nudge)
 
-        keep_conversing = True
+        conversation = Conversation.load(conv_id)
 
-        ctx.invoke(show_conversation, conv_id=conv_id)
+        keep_conversing = True
 
-        messages = ChatMessage.get_multiple(
-            chat_id=[conversation.agent_1_chat.id, conversation.agent_2_chat.id], role=ChatRole.ASSISTANT
-        )
+        if tail > 0:
+            print_transcript(conversation, messages=conversation.load_transcript_tail(tail))
 
-        # Figure out whos turn it is to answer.
-        context = {'sender': conversation.agent_1_chat, 'responder': conversation.agent_2_chat}
+        sender, responder = conversation.get_turn_order()
+        context = {'sender': sender, 'responder': responder}
 
-        if messages:
-            last_message = messages[-1]
-            if last_message.chat_id == conversation.agent_2_chat.id:
-                context = {'sender': conversation.agent_2_chat, 'responder': conversation.agent_1_chat}
+        # Load both models up front and keep them loaded, so Ollama does not swap them on every turn.
+        OllamaManager.preload_models([sender.default_model, responder.default_model])
 
+        speculative_chat = None
         while keep_conversing:
-            with Live(refresh_per_second=5) as live:
-                chat_bubble = conversation.generate_empty_chat_bubble(context['sender'])
-                live.update(chat_bubble)
-                response = ''
-                for x in OllamaManager.chat(
-                    sender_agent_chat=context['sender'], responder_agent_chat=context['responder']
-                ):
-                    response += x
-                    new_text = Text(response, justify=TextAlignment.LEFT.value)
-                    chat_bubble.renderable.renderable = new_text
-                    live.update(chat_bubble)
+            exhausted_budget = conversation.get_exhausted_budget()
+            if exhausted_budget:
+                click.echo(f'⏹️ The conversation used up its budget of {exhausted_budget}.')
+                break
+
+            turn_started_at = time.perf_counter()
+            chat_bubble = conversation.generate_empty_chat_bubble(context['sender'])
+            renderer = (
+                LiveStreamRenderer(chat_bubble, refresh_per_second=5) if render else PlainStreamRenderer(chat_bubble)
+            )
+            with renderer:
+                if speculative_chat:
+                    stream_stats = speculative_chat.stream_stats
+                    chunks = OllamaManager.stream_speculative_chat(speculative_chat)
+                else:
+                    stream_stats = StreamStats()
+                    chunks = OllamaManager.chat(
+                        sender_agent_chat=context['sender'],
+                        responder_agent_chat=context['responder'],
+                        stream_stats=stream_stats,
+                    )
+                for x in chunks:
+                    renderer.write(x)
+            # The whole turn counts towards the wall time, rendering and saving the messages included.
+            conversation.record_turn(
+                generated_tokens=stream_stats.eval_count, seconds=time.perf_counter() - turn_started_at
+            )
+
+            action = OllamaManager.handle_repetition(
+                sender_agent_chat=context['sender'], responder_agent_chat=context['responder']
+            )
+            if action == RepetitionAction.STOP:
+                click.echo('🔁 The agents keep repeating themselves, stopping the conversation.')
+                break
+            if action == RepetitionAction.NUDGE:
+                click.echo('🔁 The agents are repeating themselves, added the nudge system message.')
 
             context['sender'], context['responder'] = context['responder'], context['sender']
 
-            if interactive:
-                run_interactive_prompt(conversation)
+            if interactive and not conversation.get_exhausted_budget():
+                # Generate the next turn while the menu is open, most of the time the user just continues.
+                speculative_chat = OllamaManager.start_speculative_chat(
+                    sender_agent_chat=context['sender'], responder_agent_chat=context['responder']
+                )
+                keep_conversing = run_interactive_prompt(conversation, speculative_chat)
+                if speculative_chat.discarded:
+                    speculative_chat = None
+
+        if response_cache:
+            click.echo(f'💾 Response cache: {response_cache.hits} hit(s), {response_cache.misses} miss(es).')
     except Exception as e:
         click.echo(f'❌ {e}')
         return
 
 
-def run_interactive_prompt(conversation: Conversation) -> None:
+@click.command()
+@click.option('--conv_id', type=int, multiple=True, help='Conversation ID, can be given multiple times.')
+@click.option('--spec', type=click.Path(exists=True), help='JSON file describing conversations to create and run.')
+@click.option('--max_turns', type=int, default=10, show_default=True, help='Number of turns to run per conversation.')
+@click.option('--concurrency', type=int, default=4, show_default=True, help='Conversations to run at the same time.')
+@click.option(
+    '--max_loaded_models',
+    type=int,
+    default=None,
+    help='Models the Ollama server can keep loaded at once, turns are grouped by model to avoid reloading weights.',
+)
+@click.option(
+    '--cache_responses',
+    is_flag=True,
+    help='Replay responses to identical prompts from a local cache, for reruns of seeded conversations.',
+)
+@generation_options
+@click.option(
+    '--repetition_threshold',
+    type=click.FloatRange(0, 1),
+    default=None,
+    help="Stop when a response is this similar (0-1) to one of the agent's last responses, like 0.8.",
+)
+@click.option(
+    '--repetition_nudge',
+    type=str,
+    default=None,
+    help='System message added to both agents the first time they repeat themselves, instead of stopping.',
+)
+def run_batch(
+    conv_id: tuple[int],
+    spec: str,
+    max_turns: int,
+    concurrency: int,
+    max_loaded_models: Optional[int],
+    cache_responses: bool,
+    seed: Optional[int],
+    temperature: Optional[float],
+    repetition_threshold: Optional[float],
+    repetition_nudge: Optional[str],
+) -> None:
+    """Run many conversations headless and in parallel."""
+    from cli.batch import create_conversations_from_spec, run_batch as run_conversations_batch
+    from integrations.ollama_manager import OllamaManager
+
+    try:
+        OllamaManager.set_generation_options(seed=seed, temperature=temperature)
+        if cache_responses:
+            OllamaManager.enable_response_cache()
+        if repetition_threshold is not None:
+            OllamaManager.enable_repetition_detection(threshold=repetition_threshold, nudge=repetition_nudge)
+
+        conv_ids = list(conv_id)
+        if spec:
+            conv_ids += create_conversations_from_spec(spec)
+
+        assert conv_ids, 'No conversations given, use --conv_id or --spec.'
+        assert concurrency > 0, '--concurrency must be at least 1.'
+
+        results = run_conversations_batch(
+            conv_ids=conv_ids, max_turns=max_turns, concurrency=concurrency, max_loaded_models=max_loaded_models
+        )
+        if not all(results.values()):
+            click.echo(f'❌ {list(results.values()).count(False)} conversation(s) failed.')
+    except Exception as e:
+        click.echo(f'❌ {e}')
+
+
+def run_interactive_prompt(conversation: 'Conversation', speculative_chat: Optional['SpeculativeChat'] = None) -> bool:
+    """
+    Menu between turns. Adding a system message discards the speculatively generated next turn. Returns False when
+    the conversation was aborted.
+    """
+    from enums.enums import ChatRole
+    from integrations.ollama_manager import OllamaManager
+    from models.chat_history_cache import ChatHistoryCache
+    from models.chat_message import ChatMessage
+    from rich.console import Console
+    from simple_term_menu import TerminalMenu
+
     options = [
         'Continue',
         'Add system message to agent 1 (right side)',
@@ -138,8 +468,11 @@ def run_interactive_prompt(conversation: Conversation) -> None:
         menu_entry_index = terminal_menu.show()
         option = options[menu_entry_index]
         chat_message = None
+        if option != options[0] and speculative_chat and not speculative_chat.discarded:
+            OllamaManager.discard_speculative_chat(speculative_chat)
+
         if option == options[3]:
-            exit()
+            return False
         elif option == options[1]:
             system_message = click.prompt('Enter system message for agent 1 (right side)', type=str)
             chat_message = ChatMessage(
@@ -152,41 +485,55 @@ def run_interactive_prompt(conversation: Conversation) -> None:
             ).save()
 
         if chat_message:
+            # A new system message changes what the agent is prompted with, drop its cached history.
+            ChatHistoryCache.invalidate(chat_message.chat_id)
+
             chat_bubble = conversation.generate_chat_bubble(chat_message)
             console.print(
                 chat_bubble,
                 justify=chat_bubble.renderable.title_align,
             )
 
+    return True
+
 
 @click.command()
 @click.option(
     '--model',
     type=str,
-    help='Name of the model you want to download (see options at https://ollama.com/library). If you abort the progress will be saved.',
+    multiple=True,
+    help='Name of a model you want to download (see options at https://ollama.com/library), can be given multiple times. If you abort the progress will be saved.',
 )
-def download_model(model: str):
-    """Download LLM model."""
-    manager = OllamaManager()
+@click.option('--manifest', type=click.Path(exists=True), help='File with the models to download, one name per line.')
+@click.option('--concurrency', type=int, default=3, show_default=True, help='Models to download at the same time.')
+@click.option('--retries', type=int, default=3, show_default=True, help='Retries of an interrupted download.')
+def download_model(model: tuple[str], manifest: str, concurrency: int, retries: int):
+    """Download LLM models."""
+    from cli.download import download_models, get_missing_models, read_manifest
 
-    current_progress = 0
     try:
-        with click.progressbar(length=1000, label=f'Downloading model {model}...') as bar:
-            for progress in manager.download_model(model=model):
-                if progress.completed:
-                    new_progress = progress.completed
-                    bar.length = progress.total
-                else:
-                    new_progress = current_progress + 1
+        models = list(model)
+        if manifest:
+            models += read_manifest(manifest)
+
+        assert models, 'No models given, use --model or --manifest.'
+        assert concurrency > 0, '--concurrency must be at least 1.'
+
+        missing_models = get_missing_models(models)
+        for skipped_model in dict.fromkeys(models):
+            if skipped_model not in missing_models:
+                click.echo(f'✅ {skipped_model} is already downloaded, skipping.')
 
-                increment = new_progress - current_progress
-                bar.update(increment)
-                current_progress = new_progress
+        errors = download_models(missing_models, concurrency=concurrency, retries=retries) if missing_models else {}
     except Exception as e:
         click.echo(f'❌ {e}')
         return
 
-    click.echo(f'✅ {model} was successfully downloaded!')
+    for downloaded_model, error in errors.items():
+        if error:
+            click.echo(f'❌ {downloaded_model} was not downloaded: {error}')
+        else:
+            click.echo(f'✅ {downloaded_model} was successfully downloaded!')
 
 
 @click.command()
@@ -197,6 +544,8 @@ def download_model(model: str):
 )
 def remove_model(model: str):
     """Remove model."""
+    from integrations.ollama_manager import OllamaManager
+
     try:
         manager = OllamaManager()
         response = manager.delete_model(model)
@@ -213,33 +562,251 @@ def remove_model(model: str):
 @click.option(
     '--conv_id',
     type=int,
-    help='ID of the conversation you want to delete.',
+    multiple=True,
+    required=True,
+    help='ID of the conversation you want to delete, can be given multiple times.',
 )
-def remove_conversation(conv_id: int):
-    """Remove conversation."""
+def remove_conversation(conv_id: tuple[int]):
+    """Remove conversations."""
+    from models.conversation import Conversation
+
     try:
-        conversation = Conversation.get_one(id=conv_id)
-        conversation.delete()
+        deleted = Conversation.delete_many(list(conv_id))
+        echo_deleted_conversations(deleted, requested=conv_id)
     except Exception as e:
         click.echo(f'❌ {e}')
         return
 
 
 @click.command()
-def list_conversations():
+@click.option(
+    '--older-than',
+    'older_than',
+    type=str,
+    required=True,
+    callback=lambda ctx, param, value: parse_duration(value),
+    help='Remove conversations without messages for this long, like 30d, 12h or 2w.',
+)
+@click.option('--model', type=str, default=None, help='Only conversations where either agent uses this model.')
+@click.option('--dry-run', 'dry_run', is_flag=True, help='Only list the conversations that would be removed.')
+def prune(older_than: 'timedelta', model: Optional[str], dry_run: bool):
+    """Remove conversations that have been inactive for a while."""
+    from datetime import datetime, timezone
+
+    from database.db import session
+    from models.conversation import Conversation
+
+    try:
+        # created_at is stored by the database as UTC without a time zone.
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        stale = Conversation.stale_statement(now - older_than, model=model)
+        if dry_run:
+            conv_ids = list(session.scalars(Conversation.with_forks_statement(stale)))
+            ids = f': {", ".join(map(str, conv_ids))}' if conv_ids else ''
+            click.echo(f'{len(conv_ids)} conversation(s) would be removed, forks included{ids}.')
+            return
+
+        echo_deleted_conversations(Conversation.delete_many(stale))
+    except Exception as e:
+        click.echo(f'❌ {e}')
+
+
+def echo_deleted_conversations(deleted: list[int], requested: Iterable[int] = ()) -> None:
+    for missing in sorted(set(requested) - set(deleted)):
+        click.echo(f'❌ Conversation with id {missing} does not exist.')
+    forks = sorted(set(deleted) - set(requested)) if requested else []
+    if forks:
+        click.echo(f'Also removing forks {", ".join(map(str, forks))}, they share the removed history.')
+    click.echo(f'✅ Removed {len(deleted)} conversation(s)!')
+
+
+def parse_duration(value: Optional[str]) -> Optional['timedelta']:
+    """Parse durations like 90s, 15m, 12h, 30d or 2w."""
+    from datetime import timedelta
+
+    if value is None:
+        return None
+
+    units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+    number, unit = value[:-1], value[-1:].lower()
+    if unit not in units or not number.replace('.', '', 1).isdigit():
+        raise click.BadParameter(f'{value!r} is not a duration like 90s, 15m, 12h, 30d or 2w.')
+    return timedelta(**{units[unit]: float(number)})
+
+
+@click.command()
+@click.option('--model', type=str, default=None, help='Only conversations where either agent uses this model.')
+@click.option('--since', type=click.DateTime(), default=None, help='Only conversations created at or after this date.')
+@click.option('--until', type=click.DateTime(), default=None, help='Only conversations created before this date.')
+@click.option(
+    '--sort',
+    type=click.Choice(['id', 'created_at', 'last_activity', 'turns', 'characters']),
+    default='id',
+    show_default=True,
+    help='Column to sort by.',
+)
+@click.option('--desc', 'descending', is_flag=True, help='Sort in descending order.')
+@click.option('--limit', type=int, default=50, show_default=True, help='Maximum number of conversations.')
+@click.option('--offset', type=int, default=0, show_default=True, help='Number of conversations to skip.')
+def list_conversations(
+    model: Optional[str],
+    since: Optional['datetime'],
+    until: Optional['datetime'],
+    sort: str,
+    descending: bool,
+    limit: int,
+    offset: int,
+):
     """List conversations."""
+    from enums.enums import ConversationSortKey
+    from models.conversation import Conversation
+    from rich.console import Console
+    from rich.table import Table
+
+    try:
+        summaries = Conversation.get_summaries(
+            model=model,
+            since=since,
+            until=until,
+            sort=ConversationSortKey(sort),
+            descending=descending,
+            limit=limit,
+            offset=offset,
+        )
+        if not summaries:
+            click.echo('No conversations found.')
+            return
+
+        table = Table()
+        for column in ('id', 'agent 1', 'agent 2', 'turns', 'characters', 'created at', 'last activity'):
+            table.add_column(column)
+        for summary in summaries:
+            table.add_row(
+                str(summary.conv_id),
+                summary.agent_1_model,
+                summary.agent_2_model,
+                str(summary.turns),
+                str(summary.characters),
+                f'{summary.created_at:%Y-%m-%d %H:%M:%S}',
+                f'{summary.last_activity:%Y-%m-%d %H:%M:%S}',
+            )
+        Console().print(table)
+    except Exception as e:
+        click.echo(f'❌ {e}')
+        return
+
+
+@click.command()
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), required=True, help='File to write to.')
+@click.option(
+    '--conv_id', type=int, multiple=True, help='Conversation ID, can be given multiple times. All if not given.'
+)
+@click.option(
+    '--compression',
+    type=click.Choice(['none', 'gzip', 'zstd']),
+    default=None,
+    help='Compression of the file, by default picked from its extension (.gz or .zst).',
+)
+def export_conversations(output: str, conv_id: tuple[int], compression: Optional[str]):
+    """Export conversations as JSONL."""
+    from cli.archive import export_conversations as export_archive, get_compression, open_archive
+
+    try:
+        with open_archive(output, 'w', get_compression(output, compression)) as archive:
+            counts = export_archive(archive, conv_ids=list(conv_id) or None)
+        click.echo(
+            f'✅ Exported {counts["conversation"]} conversation(s), {counts["chat"]} chat(s) '
+            f'and {counts["chat_message"]} message(s) to {output}!'
+        )
+    except Exception as e:
+        click.echo(f'❌ {e}')
+
+
+@click.command()
+@click.option('--input', 'input_path', type=click.Path(exists=True, dir_okay=False), required=True)
+@click.option(
+    '--compression',
+    type=click.Choice(['none', 'gzip', 'zstd']),
+    default=None,
+    help='Compression of the file, by default picked from its extension (.gz or .zst).',
+)
+def import_conversations(input_path: str, compression: Optional[str]):
+    """Import conversations exported with export-conversations."""
+    from cli.archive import get_compression, import_conversations as import_archive, open_archive
+
     try:
-        conversations = Conversation.get_multiple()
-        for conv in conversations:
-            click.echo(conv.to_dict())
+        with open_archive(input_path, 'r', get_compression(input_path, compression)) as archive:
+            counts = import_archive(archive)
+        click.echo(
+            f'✅ Imported {counts["conversation"]} conversation(s), {counts["chat"]} chat(s) '
+            f'and {counts["chat_message"]} message(s)!'
+        )
     except Exception as e:
         click.echo(f'❌ {e}')
+
+
+@click.command()
+@click.argument('query', callback=lambda ctx, param, value: parse_search_query(value))
+@click.option('--conv_id', type=int, default=None, help='Only search this conversation.')
+@click.option('--limit', type=int, default=20, show_default=True, help='Maximum number of results.')
+def search(query: str, conv_id: Optional[int], limit: int):
+    """Search the messages of all conversations."""
+    from models.message_search import search_messages
+    from sqlalchemy.exc import SQLAlchemyError
+
+    try:
+        results = search_messages(query, limit=limit, conv_id=conv_id)
+    except SQLAlchemyError as e:
+        click.echo(f'❌ {e}')
         return
 
+    if not results:
+        click.echo('No messages found.')
+    for result in results:
+        agent = f'Agent {result.agent}' + (' (SYSTEM)' if result.role.is_system() else '')
+        click.echo(f'Conversation {result.conv_id}, {agent}, turn {result.turn}, message #{result.chat_message_id}')
+        click.echo(f'  {" ".join(result.snippet.split())}\n')
+
+
+def parse_search_query(value: str) -> str:
+    if not value.split():
+        raise click.BadParameter('Search for at least one word.')
+    return value
+
+
+@click.command()
+@click.option('--conv_id', type=int, default=None, help='Conversation ID, all conversations if not given.')
+def conversation_stats(conv_id: Optional[int]):
+    """Show token and latency statistics per conversation and model."""
+    from models.chat_message_metrics import ChatMessageMetrics
+    from rich.console import Console
+    from rich.table import Table
+
+    try:
+        console = Console()
+        for title, stats in (
+            ('Per conversation', ChatMessageMetrics.get_stats(conv_id=conv_id)),
+            ('Per model', ChatMessageMetrics.get_stats(conv_id=conv_id, per_conversation=False)),
+        ):
+            if not stats:
+                click.echo('No metrics recorded yet.')
+                return
+
+            table = Table(title=title)
+            for column in stats[0]:
+                table.add_column(column)
+            for row in stats:
+                table.add_row(*['-' if value is None else str(value) for value in row.values()])
+            console.print(table)
+    except Exception as e:
+        click.echo(f'❌ {e}')
+
 
 @click.command()
 def list_models():
     """List all downloaded models."""
+    from integrations.ollama_manager import OllamaManager
+
     try:
         downloaded_models = OllamaManager().get_downloaded_models().models
         for model in downloaded_models:
@@ -252,6 +819,8 @@ def list_models():
 @click.option('--model', type=str)
 def show_model(model: str):
     """Get model information."""
+    from integrations.ollama_manager import OllamaManager
+
     try:
         response = OllamaManager().get_model_information(model)
         click.echo(response.json)
@@ -262,6 +831,8 @@ def show_model(model: str):
 @click.command()
 def nuke_db():
     """Clean the database."""
+    from database.clean_db import clean_db
+
     try:
         clean_db()
         click.echo('✅ Database tables cleared successfully!')
@@ -272,6 +843,8 @@ def nuke_db():
 @click.command()
 def build_db():
     """Create the database."""
+    from database.init_db import init_db
+
     try:
         init_db()
         click.echo('✅ Database tables created successfully!')
@@ -279,6 +852,21 @@ def build_db():
         click.echo(f'❌ {e}')
 
 
+@click.command()
+def migrate_db():
+    """Apply pending database migrations."""
+    from database.migrate_db import migrate_db as run_migrations
+
+    try:
+        applied = run_migrations()
+        for migration in applied:
+            click.echo(f'✅ Applied migration {migration.version}: {migration.description}')
+        if not applied:
+            click.echo('✅ Database is up to date!')
+    except Exception as e:
+        click.echo(f'❌ {e}')
+
+
 # Add commands to the main CLI group
 cli.add_command(download_model)
 cli.add_command(list_models)
@@ -286,10 +874,19 @@ cli.add_command(remove_model)
 cli.add_command(show_model)
 
 cli.add_command(set_up_conversation)
+cli.add_command(set_budget)
 cli.add_command(run_conversation)
+cli.add_command(run_batch)
+cli.add_command(fork_conversation)
 cli.add_command(show_conversation)
 cli.add_command(remove_conversation)
+cli.add_command(prune)
 cli.add_command(list_conversations)
+cli.add_command(conversation_stats)
+cli.add_command(search)
+cli.add_command(export_conversations)
+cli.add_command(import_conversations)
 
 cli.add_command(nuke_db)
 cli.add_command(build_db)
+cli.add_command(migrate_db)
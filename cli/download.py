@@ -0,0 +1,127 @@
+import asyncio
+from collections import defaultdict
+from typing import Callable, Optional
+
+import ollama
+from rich.progress import (
+    BarColumn,
+    DownloadColumn,
+    Progress,
+    TaskID,
+    TextColumn,
+    TimeRemainingColumn,
+    TransferSpeedColumn,
+)
+
+from integrations.event_loop import BackgroundEventLoop
+from integrations.ollama_manager import AsyncOllamaManager, OllamaManager
+
+RETRY_BACKOFF_SECONDS = 2
+
+
+def read_manifest(manifest_path: str) -> list[str]:
+    """Model names from a manifest file, one per line. Blank lines and lines starting with # are ignored."""
+    with open(manifest_path) as manifest_file:
+        lines = [line.split('#', 1)[0].strip() for line in manifest_file]
+    return [line for line in lines if line]
+
+
+def normalize_model_name(model: str) -> str:
+    """Ollama stores models without a tag as :latest."""
+    return model if ':' in model else f'{model}:latest'
+
+
+class DownloadProgress:
+    """Byte accurate progress of concurrent pulls, summed over the layers of each model."""
+
+    def __init__(self) -> None:
+        # Completed and total bytes per layer digest, per model.
+        self.layers: dict[str, dict[str, tuple[int, int]]] = defaultdict(dict)
+        self.status: dict[str, str] = {}
+
+    def update(self, model: str, chunk: ollama.ProgressResponse) -> None:
+        self.status[model] = chunk.status or ''
+        # Status only chunks (pulling manifest, verifying, writing manifest) carry no bytes.
+        if chunk.digest and chunk.total:
+            self.layers[model][chunk.digest] = (chunk.completed or 0, chunk.total)
+
+    def get_bytes(self, model: Optional[str] = None) -> tuple[int, int]:
+        """Completed and total bytes of a model, or of all models. Totals grow as layers are discovered."""
+        layers = [self.layers[model]] if model else self.layers.values()
+        sizes = [size for model_layers in layers for size in model_layers.values()]
+        return sum(completed for completed, _ in sizes), sum(total for _, total in sizes)
+
+
+async def pull_model(
+    manager: AsyncOllamaManager,
+    model: str,
+    progress: DownloadProgress,
+    retries: int,
+    on_progress: Callable[[str], None],
+) -> None:
+    """Pull a model, retrying interrupted pulls. Ollama keeps partially downloaded layers, so a retry resumes."""
+    for attempt in range(retries + 1):
+        try:
+            async for chunk in manager.download_model(model=model):
+                progress.update(model, chunk)
+                on_progress(model)
+            return
+        except Exception as e:
+            # Client errors, like an unknown model, will not go away on retry.
+            if (isinstance(e, ollama.ResponseError) and 400 <= e.status_code < 500) or attempt == retries:
+                raise
+            progress.status[model] = f'retrying ({attempt + 1}/{retries}): {e}'
+            on_progress(model)
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS * 2**attempt)
+
+
+async def download_models_async(
+    models: list[str], concurrency: int, retries: int, progress: DownloadProgress, on_progress: Callable[[str], None]
+) -> dict[str, Optional[Exception]]:
+    manager = OllamaManager.get_async_manager()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def download_one(model: str) -> Optional[Exception]:
+        async with semaphore:
+            try:
+                await pull_model(manager, model, progress, retries=retries, on_progress=on_progress)
+                return None
+            except Exception as e:
+                return e
+
+    errors = await asyncio.gather(*(download_one(model) for model in models))
+    return dict(zip(models, errors))
+
+
+def get_missing_models(models: list[str]) -> list[str]:
+    """The given models, without duplicates and without the ones that are downloaded already."""
+    downloaded = {normalize_model_name(model.model) for model in OllamaManager.get_downloaded_models().models}
+    return [model for model in dict.fromkeys(models) if normalize_model_name(model) not in downloaded]
+
+
+def download_models(models: list[str], concurrency: int, retries: int) -> dict[str, Optional[Exception]]:
+    """Pull the models concurrently, at most `concurrency` at a time, showing per model and total progress."""
+    progress = DownloadProgress()
+    display = Progress(
+        TextColumn('{task.description}'),
+        BarColumn(),
+        DownloadColumn(),
+        TransferSpeedColumn(),
+        TimeRemainingColumn(),
+        TextColumn('{task.fields[status]}'),
+    )
+    tasks: dict[Optional[str], TaskID] = {
+        model: display.add_task(model, total=None, status='waiting') for model in models
+    }
+    tasks[None] = display.add_task('Total', total=None, status='')
+
+    def on_progress(model: str) -> None:
+        # Called on the event loop thread, rich Progress is safe to update from there.
+        for key, status in ((model, progress.status.get(model, '')), (None, '')):
+            completed, total = progress.get_bytes(key)
+            display.update(tasks[key], completed=completed, total=total or None, status=status)
+
+    with display:
+        return BackgroundEventLoop.run(
+            download_models_async(models, concurrency, retries, progress=progress, on_progress=on_progress)
+        )
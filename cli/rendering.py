@@ -0,0 +1,70 @@
+import time
+
+import click
+from rich.align import Align
+from rich.live import Live
+from rich.text import Text
+
+from enums.enums import TextAlignment
+
+
+class LiveStreamRenderer:
+    """
+    Renders a streamed response into a chat bubble.
+
+    Chunks are buffered and appended to a single Text, the Live display is redrawn at most refresh_per_second times.
+    """
+
+    def __init__(self, chat_bubble: Align, refresh_per_second: float = 5) -> None:
+        self.chat_bubble = chat_bubble
+        self.refresh_interval = 1 / refresh_per_second
+        self.text = Text('', justify=TextAlignment.LEFT.value)
+        self._buffer: list[str] = []
+        self._last_refresh = 0.0
+        self._live = Live(chat_bubble, refresh_per_second=refresh_per_second, auto_refresh=False)
+
+    def __enter__(self) -> 'LiveStreamRenderer':
+        self._live.__enter__()
+        self._live.refresh()
+        self._last_refresh = time.monotonic()
+        return self
+
+    def write(self, chunk: str) -> None:
+        self._buffer.append(chunk)
+        if time.monotonic() - self._last_refresh >= self.refresh_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buffer:
+            # The panel shows 'Loading...' until the first chunk arrives.
+            if not self.text:
+                self.chat_bubble.renderable.renderable = self.text
+            self.text.append(''.join(self._buffer))
+            self._buffer.clear()
+
+        self._live.refresh()
+        self._last_refresh = time.monotonic()
+
+    def __exit__(self, *exc_info) -> None:
+        self.flush()
+        self._live.__exit__(*exc_info)
+
+
+class PlainStreamRenderer:
+    """Writes a streamed response straight to stdout, for non-TTY use."""
+
+    def __init__(self, chat_bubble: Align) -> None:
+        self.title = chat_bubble.renderable.title
+
+    def __enter__(self) -> 'PlainStreamRenderer':
+        click.echo(f'{self.title}: ', nl=False)
+        return self
+
+    def write(self, chunk: str) -> None:
+        click.echo(chunk, nl=False)
+
+    def flush(self) -> None:
+        pass
+
+    def __exit__(self, *exc_info) -> None:
+        click.echo('\n')
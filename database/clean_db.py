@@ -1,13 +1,26 @@
-from .db import db_engine
+from .db import get_db_engine
 from models.base import BaseModel
 
 # ruff: noqa: F401
 from models.chat_message import ChatMessage
+from models.chat_message_metrics import ChatMessageMetrics
+from models.message_content import MessageContent
 from models.chat import Chat
 from models.conversation import Conversation
+from models.schema_migration import SchemaMigration
 # ruff: noqa
 
 
 def clean_db() -> None:
-    # Drop all tables
-    BaseModel.metadata.drop_all(bind=db_engine)
+    with get_db_engine().connect() as connection:
+        # chat and chat_message reference each other, SQLite checks the references of every table it drops.
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+        try:
+            # Drop all tables
+            BaseModel.metadata.drop_all(bind=connection)
+            connection.commit()
+        finally:
+            if sqlite:
+                connection.exec_driver_sql('PRAGMA foreign_keys=ON')
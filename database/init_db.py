@@ -1,13 +1,19 @@
-from database.db import db_engine
+from database.db import get_db_engine
+from database.migrate_db import stamp_db
 from models.base import BaseModel
 
 # ruff: noqa: F401
 from models.chat_message import ChatMessage
+from models.chat_message_metrics import ChatMessageMetrics
+from models.message_content import MessageContent
 from models.chat import Chat
 from models.conversation import Conversation
+from models.schema_migration import SchemaMigration
 # ruff: noqa
 
 
 def init_db() -> None:
     # Create tables
-    BaseModel.metadata.create_all(db_engine)
+    BaseModel.metadata.create_all(get_db_engine())
+    # The tables match the current models, so there is nothing left to migrate.
+    stamp_db()
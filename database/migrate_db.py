@@ -0,0 +1,315 @@
+import hashlib
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import Column, Connection, Float, Integer, String, Table, inspect, insert, select, text
+from sqlalchemy.schema import CreateTable
+
+from database.db import get_db_engine
+
+# ruff: noqa: F401
+from models.chat_message import ChatMessage
+from models.chat_message_metrics import ChatMessageMetrics
+from models.message_content import MessageContent, create_search_index
+from models.chat import Chat
+from models.conversation import Conversation
+from models.schema_migration import SchemaMigration
+# ruff: noqa
+
+BACKFILL_BATCH_SIZE = 1000
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+def _has_column(connection: Connection, table: str, column: str) -> bool:
+    return column in {c['name'] for c in inspect(connection).get_columns(table)}
+
+
+def _add_column(connection: Connection, table: str, column: Column) -> None:
+    if _has_column(connection, table, column.name):
+        return
+
+    ddl = f'ALTER TABLE {table} ADD COLUMN {column.name} {column.type.compile(dialect=connection.dialect)}'
+    if column.server_default is not None:
+        ddl += f' DEFAULT {column.server_default.arg}'
+    if not column.nullable:
+        ddl += ' NOT NULL'
+    connection.execute(text(ddl))
+
+
+def _add_message_content(connection: Connection) -> None:
+    """Move chat_message.content into the deduplicated message_content table."""
+    MessageContent.__table__.create(connection, checkfirst=True)
+    _add_column(connection, 'chat_message', Column('content_id', Integer, nullable=True))
+
+    if not _has_column(connection, 'chat_message', 'content'):
+        return
+
+    content_table = MessageContent.__table__
+    while True:
+        rows = connection.execute(
+            text('SELECT id, content FROM chat_message WHERE content_id IS NULL ORDER BY id LIMIT :limit'),
+            {'limit': BACKFILL_BATCH_SIZE},
+        ).all()
+        if not rows:
+            break
+
+        hashes = {hashlib.sha256(row.content.encode('utf-8')).hexdigest(): row.content for row in rows}
+        existing = dict(
+            connection.execute(
+                select(content_table.c.hash, content_table.c.id).where(content_table.c.hash.in_(list(hashes)))
+            ).all()
+        )
+        missing = [{'hash': h, 'content': c} for h, c in hashes.items() if h not in existing]
+        if missing:
+            connection.execute(insert(content_table), missing)
+            existing.update(
+                connection.execute(
+                    select(content_table.c.hash, content_table.c.id).where(
+                        content_table.c.hash.in_([m['hash'] for m in missing])
+                    )
+                ).all()
+            )
+
+        for row in rows:
+            connection.execute(
+                text('UPDATE chat_message SET content_id = :content_id WHERE id = :id'),
+                {'content_id': existing[hashlib.sha256(row.content.encode('utf-8')).hexdigest()], 'id': row.id},
+            )
+
+    connection.execute(text('ALTER TABLE chat_message DROP COLUMN content'))
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('ALTER TABLE chat_message ALTER COLUMN content_id SET NOT NULL'))
+        connection.execute(
+            text(
+                'ALTER TABLE chat_message ADD CONSTRAINT chat_message_content_id_fkey '
+                'FOREIGN KEY (content_id) REFERENCES message_content (id)'
+            )
+        )
+
+
+def _add_chat_context_window(connection: Connection) -> None:
+    _add_column(connection, 'chat', Column('context_token_budget', Integer, nullable=True))
+    _add_column(connection, 'chat', Column('context_summary', String(), nullable=True))
+    _add_column(
+        connection, 'chat', Column('context_summary_message_count', Integer, nullable=False, server_default='0')
+    )
+
+
+def _add_chat_message_history_index(connection: Connection) -> None:
+    for index in ChatMessage.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _add_chat_message_metrics(connection: Connection) -> None:
+    ChatMessageMetrics.__table__.create(connection, checkfirst=True)
+
+
+def _add_chat_fork_columns(connection: Connection) -> None:
+    _add_column(connection, 'chat', Column('parent_chat_id', Integer, nullable=True))
+    _add_column(connection, 'chat', Column('parent_message_id', Integer, nullable=True))
+
+    # SQLite can not add constraints to an existing table, migration 9 rebuilds it with them.
+    if connection.dialect.name == 'postgresql':
+        existing = {fk['name'] for fk in inspect(connection).get_foreign_keys('chat')}
+        for name, column, target in (
+            ('chat_parent_chat_id_fkey', 'parent_chat_id', 'chat'),
+            ('chat_parent_message_id_fkey', 'parent_message_id', 'chat_message'),
+        ):
+            if name not in existing:
+                connection.execute(
+                    text(f'ALTER TABLE chat ADD CONSTRAINT {name} FOREIGN KEY ({column}) REFERENCES {target} (id)')
+                )
+
+
+def _add_message_search_index(connection: Connection) -> None:
+    # Postgres computes the tsvector of all existing messages here, this rewrites message_content.
+    create_search_index(connection)
+    for index in ChatMessage.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+
+def _add_on_delete_cascade(connection: Connection) -> None:
+    """Let the database cascade deletes, and index the referencing columns it looks rows up by when it does."""
+    for model in (Conversation, Chat):
+        for index in model.__table__.indexes:
+            index.create(connection, checkfirst=True)
+
+    # SQLite can not change the constraints of an existing table, migration 9 rebuilds the tables with them.
+    if connection.dialect.name != 'postgresql':
+        return
+
+    for model in (Conversation, Chat, ChatMessage, ChatMessageMetrics):
+        existing = inspect(connection).get_foreign_keys(model.__tablename__)
+        for foreign_key in model.__table__.foreign_keys:
+            if foreign_key.ondelete != 'CASCADE':
+                continue
+            column = foreign_key.parent.name
+            for constraint in existing:
+                if constraint['constrained_columns'] != [column]:
+                    continue
+                if constraint.get('options', {}).get('ondelete') == 'CASCADE':
+                    break
+                target = foreign_key.column.table.name
+                connection.execute(text(f'ALTER TABLE {model.__tablename__} DROP CONSTRAINT {constraint["name"]}'))
+                connection.execute(
+                    text(
+                        f'ALTER TABLE {model.__tablename__} ADD CONSTRAINT {constraint["name"]} '
+                        f'FOREIGN KEY ({column}) REFERENCES {target} (id) ON DELETE CASCADE'
+                    )
+                )
+
+
+def _add_conversation_budgets(connection: Connection) -> None:
+    for name, column_type in (('max_turns', Integer), ('max_generated_tokens', Integer), ('max_wall_seconds', Float)):
+        _add_column(connection, 'conversation', Column(name, column_type, nullable=True))
+
+    added = not _has_column(connection, 'conversation', 'turn_count')
+    for name, column_type in (('turn_count', Integer), ('generated_token_count', Integer), ('wall_seconds', Float)):
+        _add_column(connection, 'conversation', Column(name, column_type, nullable=False, server_default='0'))
+    if not added:
+        return
+
+    # Count what existing conversations used so far, so runs continue from there. Wall time is Ollama's own time.
+    own_responses = (
+        'FROM chat_message WHERE chat_message.chat_id IN (conversation.agent_1_chat_id, conversation.agent_2_chat_id) '
+        "AND chat_message.role = 'ASSISTANT'"
+    )
+    connection.execute(
+        text(
+            f'UPDATE conversation SET turn_count = (SELECT count(*) {own_responses}), '
+            'generated_token_count = (SELECT coalesce(sum(chat_message_metrics.eval_count), 0) '
+            f'FROM chat_message_metrics WHERE chat_message_metrics.chat_message_id IN (SELECT id {own_responses})), '
+            'wall_seconds = (SELECT coalesce(sum(chat_message_metrics.total_duration), 0) / 1e9 '
+            f'FROM chat_message_metrics WHERE chat_message_metrics.chat_message_id IN (SELECT id {own_responses}))'
+        )
+    )
+
+
+def _rebuild_sqlite_table(connection: Connection, table: Table) -> None:
+    """
+    Recreate a table from its model and copy the rows over, SQLite's way of changing constraints. Foreign keys are off
+    while migrating, see migrate_db, other tables refer to the dropped table until the new one takes its name.
+    """
+    new_name = f'_new_{table.name}'
+    ddl = str(CreateTable(table).compile(dialect=connection.dialect))
+    connection.execute(text(ddl.replace(f'CREATE TABLE {table.name} ', f'CREATE TABLE {new_name} ', 1)))
+
+    columns = ', '.join(c['name'] for c in inspect(connection).get_columns(table.name) if c['name'] in table.c)
+    connection.execute(text(f'INSERT INTO {new_name} ({columns}) SELECT {columns} FROM {table.name}'))
+    connection.execute(text(f'DROP TABLE {table.name}'))
+    connection.execute(text(f'ALTER TABLE {new_name} RENAME TO {table.name}'))
+    for index in table.indexes:
+        index.create(connection)
+
+
+def _match_model_constraints(connection: Connection) -> None:
+    """Give the tables the foreign keys and NOT NULL columns of the models, earlier migrations skipped some."""
+    rebuilt = False
+    for model in (Chat, ChatMessage, ChatMessageMetrics, Conversation):
+        table = model.__table__
+        existing = {fk['constrained_columns'][0]: fk for fk in inspect(connection).get_foreign_keys(table.name)}
+        changed = [
+            foreign_key
+            for foreign_key in table.foreign_keys
+            if foreign_key.parent.name not in existing
+            or (
+                existing[foreign_key.parent.name]['referred_table'],
+                existing[foreign_key.parent.name].get('options', {}).get('ondelete'),
+            )
+            != (foreign_key.column.table.name, foreign_key.ondelete)
+        ]
+
+        if connection.dialect.name == 'postgresql':
+            for foreign_key in changed:
+                column = foreign_key.parent.name
+                name = existing[column]['name'] if column in existing else f'{table.name}_{column}_fkey'
+                if column in existing:
+                    connection.execute(text(f'ALTER TABLE {table.name} DROP CONSTRAINT {name}'))
+                ondelete = f' ON DELETE {foreign_key.ondelete}' if foreign_key.ondelete else ''
+                connection.execute(
+                    text(
+                        f'ALTER TABLE {table.name} ADD CONSTRAINT {name} FOREIGN KEY ({column}) '
+                        f'REFERENCES {foreign_key.column.table.name} (id){ondelete}'
+                    )
+                )
+        elif connection.dialect.name == 'sqlite':
+            nullable = {c['name']: c['nullable'] for c in inspect(connection).get_columns(table.name)}
+            if changed or any(nullable.get(c.name, c.nullable) != c.nullable for c in table.columns):
+                _rebuild_sqlite_table(connection, table)
+                rebuilt = True
+
+    if rebuilt:
+        violations = connection.exec_driver_sql('PRAGMA foreign_key_check').all()
+        assert not violations, f'Rows refer to rows that do not exist: {violations[:10]}'
+
+
+# Append only, never reorder or change applied migrations. Every upgrade must be safe to run on a schema that
+# already has the change, databases created before migrations existed are upgraded by running all of them.
+MIGRATIONS = [
+    Migration(1, 'Store message bodies in message_content', _add_message_content),
+    Migration(2, 'Add context window settings to chat', _add_chat_context_window),
+    Migration(3, 'Add chat_message (chat_id, role, created_at, id) index', _add_chat_message_history_index),
+    Migration(4, 'Add chat_message_metrics table', _add_chat_message_metrics),
+    Migration(5, 'Add parent chat and message to chat for forks', _add_chat_fork_columns),
+    Migration(6, 'Add full-text search index on message_content', _add_message_search_index),
+    Migration(7, 'Cascade deletes of conversations, chats and messages', _add_on_delete_cascade),
+    Migration(8, 'Add turn, token and wall time budgets to conversation', _add_conversation_budgets),
+    Migration(9, 'Match the foreign keys and NOT NULL columns of the models', _match_model_constraints),
+]
+
+
+def get_applied_versions(connection: Connection) -> set[int]:
+    SchemaMigration.__table__.create(connection, checkfirst=True)
+    return set(connection.execute(select(SchemaMigration.version)).scalars())
+
+
+def migrate_db() -> list[Migration]:
+    """Apply all pending migrations, each in its own transaction. Returns the applied migrations."""
+    applied = []
+    with get_db_engine().connect() as connection:
+        # Rebuilding a SQLite table drops the table others refer to, SQLite would check those references. Foreign keys
+        # can only be switched outside of a transaction.
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+            connection.commit()
+        try:
+            with connection.begin():
+                applied_versions = get_applied_versions(connection)
+
+            for migration in MIGRATIONS:
+                if migration.version in applied_versions:
+                    continue
+
+                with connection.begin():
+                    migration.upgrade(connection)
+                    connection.execute(
+                        insert(SchemaMigration.__table__).values(
+                            version=migration.version, description=migration.description
+                        )
+                    )
+                applied.append(migration)
+        finally:
+            if sqlite:
+                connection.exec_driver_sql('PRAGMA foreign_keys=ON')
+                connection.commit()
+
+    return applied
+
+
+def stamp_db() -> None:
+    """Mark all migrations as applied, for databases created from the current models."""
+    with get_db_engine().begin() as connection:
+        applied_versions = get_applied_versions(connection)
+        pending = [m for m in MIGRATIONS if m.version not in applied_versions]
+        if pending:
+            connection.execute(
+                insert(SchemaMigration.__table__),
+                [{'version': m.version, 'description': m.description} for m in pending],
+            )
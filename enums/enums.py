@@ -44,3 +44,17 @@ class TextColor(Enum):
 
     def is_agent_2_color(self) -> bool:
         return self == TextColor.AGENT_2_COLOR
+
+
+class ConversationSortKey(Enum):
+    ID = 'id'
+    CREATED_AT = 'created_at'
+    LAST_ACTIVITY = 'last_activity'
+    TURNS = 'turns'
+    CHARACTERS = 'characters'
+
+
+class RepetitionAction(Enum):
+    CONTINUE = 'continue'
+    NUDGE = 'nudge'
+    STOP = 'stop'
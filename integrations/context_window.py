@@ -0,0 +1,132 @@
+from typing import TYPE_CHECKING, Optional, Union
+
+import ollama
+
+from enums.enums import ChatRole
+
+if TYPE_CHECKING:
+    from models.chat import Chat
+
+# Rough average for English text, good enough to keep the prompt within budget without a tokenizer.
+CHARS_PER_TOKEN = 4
+# Per message overhead of the chat template.
+MESSAGE_TOKEN_OVERHEAD = 4
+
+SUMMARY_PROMPT = (
+    'You are summarizing the earlier part of a conversation you are taking part in. '
+    'Write a concise summary that keeps the facts, names, decisions and open questions. '
+    'Respond with only the summary.'
+)
+
+
+def estimate_tokens(messages: list[dict[str, str]]) -> int:
+    return sum(len(message['content']) // CHARS_PER_TOKEN + MESSAGE_TOKEN_OVERHEAD for message in messages)
+
+
+class ContextWindow:
+    """
+    Fits a chat history into the chat's context_token_budget.
+
+    System messages are always kept, the most recent turns are sent as is and older turns are folded into a
+    rolling summary stored on the chat, so each turn is summarized only once.
+    """
+
+    # Never fold the latest messages, the model needs them to answer.
+    MIN_RECENT_MESSAGES = 2
+
+    def __init__(self, client: ollama.AsyncClient, keep_alive: Optional[Union[str, float]] = None) -> None:
+        self.client = client
+        self.keep_alive = keep_alive
+
+    async def build(self, chat: 'Chat', history: list[dict[str, str]]) -> list[dict[str, str]]:
+        if not chat.context_token_budget:
+            return history
+
+        folded_count = chat.context_summary_message_count
+        summary = chat.context_summary
+
+        context = self._assemble(history, folded_count, summary)
+        if estimate_tokens(context) <= chat.context_token_budget:
+            return context
+
+        new_folded_count = self._get_folded_count(history, folded_count, chat.context_token_budget)
+        if new_folded_count > folded_count:
+            newly_folded = self._get_non_system_messages(history)[folded_count:new_folded_count]
+            summary = await self._summarize(chat.default_model, summary, newly_folded)
+            await self._store_summary(chat, summary, new_folded_count)
+
+        return self._assemble(history, new_folded_count, summary)
+
+    def _get_folded_count(self, history: list[dict[str, str]], folded_count: int, budget: int) -> int:
+        # Fold down to half the budget so the summary is refreshed every few turns, not on every turn.
+        system_tokens = estimate_tokens([m for m in history if m['role'] == ChatRole.SYSTEM.value])
+        target = max(budget // 2 - system_tokens, 0)
+
+        non_system_messages = self._get_non_system_messages(history)
+        max_folded_count = max(len(non_system_messages) - self.MIN_RECENT_MESSAGES, folded_count)
+
+        new_folded_count = folded_count
+        window_tokens = estimate_tokens(non_system_messages[folded_count:])
+        while new_folded_count < max_folded_count and window_tokens > target:
+            window_tokens -= estimate_tokens([non_system_messages[new_folded_count]])
+            new_folded_count += 1
+
+        return new_folded_count
+
+    @staticmethod
+    def _get_non_system_messages(history: list[dict[str, str]]) -> list[dict[str, str]]:
+        return [message for message in history if message['role'] != ChatRole.SYSTEM.value]
+
+    @staticmethod
+    def _assemble(history: list[dict[str, str]], folded_count: int, summary: str) -> list[dict[str, str]]:
+        """System messages of the folded part, then the summary, then everything after the folded part."""
+        if not folded_count:
+            return list(history)
+
+        # Index right after the last folded non-system message.
+        boundary = seen = 0
+        for index, message in enumerate(history):
+            if seen == folded_count:
+                break
+            if message['role'] != ChatRole.SYSTEM.value:
+                seen += 1
+            boundary = index + 1
+
+        folded_system_messages = [m for m in history[:boundary] if m['role'] == ChatRole.SYSTEM.value]
+        summary_message = {'role': ChatRole.SYSTEM.value, 'content': f'Summary of the conversation so far: {summary}'}
+        return folded_system_messages + [summary_message] + history[boundary:]
+
+    async def _summarize(self, model: str, summary: str, messages: list[dict[str, str]]) -> str:
+        transcript = '\n'.join(f'{message["role"]}: {message["content"]}' for message in messages)
+        if summary:
+            transcript = f'Summary so far: {summary}\n\nContinued conversation:\n{transcript}'
+
+        response = await self.client.chat(
+            model=model,
+            keep_alive=self.keep_alive,
+            messages=[
+                {'role': ChatRole.SYSTEM.value, 'content': SUMMARY_PROMPT},
+                {'role': ChatRole.USER.value, 'content': transcript},
+            ],
+        )
+        return response.message.content
+
+    @staticmethod
+    async def _store_summary(chat: 'Chat', summary: str, folded_count: int) -> None:
+        from sqlalchemy import update
+        from sqlalchemy.orm.attributes import set_committed_value
+
+        from database.db import AsyncSessionLocal
+        from models.chat import Chat
+
+        async with AsyncSessionLocal() as db_session:
+            await db_session.execute(
+                update(Chat)
+                .where(Chat.id == chat.id)
+                .values(context_summary=summary, context_summary_message_count=folded_count)
+            )
+            await db_session.commit()
+
+        # Keep the loaded chat in sync without marking it dirty in its own session.
+        set_committed_value(chat, 'context_summary', summary)
+        set_committed_value(chat, 'context_summary_message_count', folded_count)
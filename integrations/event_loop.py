@@ -0,0 +1,42 @@
+import asyncio
+import threading
+from typing import AsyncGenerator, Coroutine, Generator, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class BackgroundEventLoop:
+    """
+    A single asyncio event loop running in a daemon thread.
+
+    All async work (Ollama clients and async DB sessions) runs on this loop, so connections are never shared
+    between loops and sync code can drive coroutines and async generators without starting its own loop.
+    """
+
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_loop(cls) -> asyncio.AbstractEventLoop:
+        with cls._lock:
+            if cls._loop is None:
+                cls._loop = asyncio.new_event_loop()
+                threading.Thread(target=cls._loop.run_forever, name='llm-talks-event-loop', daemon=True).start()
+            return cls._loop
+
+    @classmethod
+    def run(cls, coroutine: Coroutine[None, None, T]) -> T:
+        """Run a coroutine on the background loop and block until it is done."""
+        return asyncio.run_coroutine_threadsafe(coroutine, cls.get_loop()).result()
+
+    @classmethod
+    def iterate(cls, async_generator: AsyncGenerator[T, None]) -> Generator[T, None, None]:
+        """Expose an async generator running on the background loop as a sync generator."""
+        try:
+            while True:
+                try:
+                    yield cls.run(async_generator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            cls.run(async_generator.aclose())
@@ -1,72 +1,340 @@
-from typing import Generator, Optional
+import asyncio
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncGenerator, AsyncIterator, Generator, Optional, Union
 
 import ollama
 
-from models.chat import Chat
-from models.chat_message import ChatMessage
+from integrations.context_window import ContextWindow
+from integrations.event_loop import BackgroundEventLoop
+from integrations.repetition import RepetitionDetector
+from integrations.response_cache import ResponseCache
 
-from enums.enums import ChatRole
+from enums.enums import ChatRole, RepetitionAction
 
+# The database and the models are imported where they are used, managing models must not need them.
+if TYPE_CHECKING:
+    from models.chat import Chat
+    from models.chat_message import ChatMessage
 
-class OllamaManager:
-    def __init__(self):
-        pass
 
-    @staticmethod
-    def get_downloaded_models() -> ollama.ListResponse:
-        return ollama.list()
+class StreamStats:
+    """Client side timing of a streamed response, and the final chunk carrying Ollama's own numbers."""
 
-    @staticmethod
-    def get_model_information(model: str) -> ollama.ShowResponse:
-        return ollama.show(model=model)
+    def __init__(self) -> None:
+        self.started_at = time.perf_counter()
+        self.time_to_first_token: Optional[float] = None
+        self.final_chunk: Optional[ollama.ChatResponse] = None
+        # Replayed from the response cache, nothing was generated.
+        self.cached = False
 
-    @staticmethod
-    def download_model(model: Optional[str] = None) -> Generator:
-        for x in ollama.pull(model=model, stream=True):
+    def start(self) -> None:
+        """Measure from now on, called when the request is sent."""
+        self.started_at = time.perf_counter()
+
+    def observe(self, chunk: ollama.ChatResponse) -> None:
+        if self.time_to_first_token is None:
+            self.time_to_first_token = time.perf_counter() - self.started_at
+        if chunk.done:
+            self.final_chunk = chunk
+
+    @property
+    def eval_count(self) -> int:
+        """Tokens generated, 0 for responses replayed from the cache."""
+        return (self.final_chunk.eval_count or 0) if self.final_chunk else 0
+
+
+class ModelResidencyManager:
+    """
+    Keeps the models of running conversations loaded in Ollama.
+
+    Models are preloaded and kept alive with keep_alive, so Ollama does not unload them between turns. With
+    max_loaded_models set, turns are gated so that at most that many models are in use at once. Turns for a model
+    that is already in use run right away, others wait and are let in grouped by model, which keeps the number of
+    model switches low when many conversations share one Ollama server.
+    """
+
+    DEFAULT_KEEP_ALIVE = '30m'
+
+    def __init__(
+        self,
+        client: ollama.AsyncClient,
+        keep_alive: Union[str, float] = DEFAULT_KEEP_ALIVE,
+        max_loaded_models: Optional[int] = None,
+    ) -> None:
+        self.client = client
+        self.keep_alive = keep_alive
+        self.max_loaded_models = max_loaded_models
+        # Number of times a turn needed a model that was not loaded.
+        self.switches = 0
+        self._active: dict[str, int] = defaultdict(int)
+        self._waiting: dict[str, int] = defaultdict(int)
+        # Loaded models, least recently used first.
+        self._resident: dict[str, None] = {}
+        self._condition: Optional[asyncio.Condition] = None
+
+    async def get_loaded_models(self) -> set[str]:
+        response = await self.client.ps()
+        self._resident = dict.fromkeys(model.model for model in response.models)
+        return set(self._resident)
+
+    async def preload(self, models: list[str]) -> None:
+        """Load the given models that are not loaded yet and pin them for keep_alive."""
+        loaded = await self.get_loaded_models()
+        for model in dict.fromkeys(models):
+            if self.max_loaded_models and len(loaded) >= self.max_loaded_models and model not in loaded:
+                break
+            # A chat request without messages only loads the model, it also refreshes keep_alive if loaded already.
+            await self.client.chat(model=model, messages=[], keep_alive=self.keep_alive)
+            loaded.add(model)
+
+    @asynccontextmanager
+    async def turn(self, model: str) -> AsyncIterator[None]:
+        """Wait until the model may be used, hold it for the duration of one turn."""
+        if not self.max_loaded_models:
+            yield
+            return
+
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        async with self._condition:
+            self._waiting[model] += 1
+            try:
+                await self._condition.wait_for(lambda: self._can_run(model))
+            finally:
+                self._waiting[model] -= 1
+            # Every turn makes the model the most recently used, like its request does on the server.
+            self._mark_resident(model)
+            self._active[model] += 1
+
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._active[model] -= 1
+                if not self._active[model]:
+                    del self._active[model]
+                self._condition.notify_all()
+
+    def _mark_resident(self, model: str) -> None:
+        if model not in self._resident:
+            self.switches += 1
+            # Like Ollama, assume the least recently used model was unloaded to make room.
+            while len(self._resident) >= self.max_loaded_models:
+                del self._resident[next(iter(self._resident))]
+        self._resident.pop(model, None)
+        self._resident[model] = None
+
+    def _can_run(self, model: str) -> bool:
+        if model in self._active:
+            return True
+        if len(self._active) >= self.max_loaded_models:
+            return False
+
+        # Let in the model with the most waiting turns, so they run as a group. Prefer models that are still loaded.
+        candidates = [m for m, count in self._waiting.items() if count and m not in self._active]
+        return model == max(candidates, key=lambda m: (m in self._resident, self._waiting[m]))
+
+
+class AsyncOllamaManager:
+    """Ollama integration built on ollama.AsyncClient and async DB sessions."""
+
+    def __init__(self, host: Optional[str] = None) -> None:
+        self.client = ollama.AsyncClient(host=host)
+        self.residency = ModelResidencyManager(self.client)
+        self.context_window = ContextWindow(self.client, keep_alive=self.residency.keep_alive)
+        # Generation options sent with every response, see set_generation_options.
+        self.options: Optional[dict] = None
+        # Opt-in, see enable_response_cache.
+        self.response_cache: Optional[ResponseCache] = None
+        # Opt-in, see enable_repetition_detection.
+        self.repetition: Optional[RepetitionDetector] = None
+
+    def set_generation_options(self, seed: Optional[int] = None, temperature: Optional[float] = None) -> None:
+        """Sample every response with these options, the model's defaults for those not given."""
+        options = {'seed': seed, 'temperature': temperature}
+        self.options = {name: value for name, value in options.items() if value is not None} or None
+
+    def enable_response_cache(
+        self, directory: Optional[str] = None, max_bytes: int = ResponseCache.DEFAULT_MAX_BYTES
+    ) -> ResponseCache:
+        """Replay responses to byte-identical prompts from an on-disk cache instead of generating them again."""
+        self.response_cache = ResponseCache(directory=directory, max_bytes=max_bytes)
+        return self.response_cache
+
+    def enable_repetition_detection(
+        self, threshold: float = RepetitionDetector.DEFAULT_THRESHOLD, nudge: Optional[str] = None
+    ) -> RepetitionDetector:
+        """Track how much every saved response repeats the agent's previous ones, see handle_repetition."""
+        self.repetition = RepetitionDetector(threshold=threshold, nudge=nudge)
+        return self.repetition
+
+    async def handle_repetition(self, sender_agent_chat: 'Chat', responder_agent_chat: 'Chat') -> RepetitionAction:
+        """
+        Call after a turn. If the agent that answered is repeating itself, adds the nudge system message to both
+        chats the first time and returns NUDGE, returns STOP when the conversation should end.
+        """
+        from database.db import AsyncSessionLocal
+        from models.chat_history_cache import ChatHistoryCache
+        from models.chat_message import ChatMessage
+
+        if not self.repetition:
+            return RepetitionAction.CONTINUE
+
+        action = self.repetition.get_action(sender_agent_chat.id)
+        if action == RepetitionAction.NUDGE:
+            chats = [sender_agent_chat, responder_agent_chat]
+            async with AsyncSessionLocal() as db_session:
+                await ChatMessage.save_all_async(
+                    db_session,
+                    [
+                        ChatMessage(chat_id=chat.id, role=ChatRole.SYSTEM, content=self.repetition.nudge)
+                        for chat in chats
+                    ],
+                )
+            for chat in chats:
+                # Like a system message added from the menu, the history sent to the agent changed.
+                ChatHistoryCache.invalidate(chat.id)
+            self.repetition.mark_nudged([chat.id for chat in chats])
+        return action
+
+    async def get_downloaded_models(self) -> ollama.ListResponse:
+        return await self.client.list()
+
+    async def get_model_information(self, model: str) -> ollama.ShowResponse:
+        return await self.client.show(model=model)
+
+    async def download_model(self, model: Optional[str] = None) -> AsyncGenerator:
+        async for x in await self.client.pull(model=model, stream=True):
             yield x
 
-    @staticmethod
-    def delete_model(model: str) -> ollama.StatusResponse:
-        return ollama.delete(model=model)
+    async def delete_model(self, model: str) -> ollama.StatusResponse:
+        return await self.client.delete(model=model)
 
-    @staticmethod
-    def chat(sender_agent_chat: Chat, responder_agent_chat: Chat) -> Generator:
-        message_history = sender_agent_chat.get_chat_history_as_dict()
+    async def generate(self, chat: 'Chat', stream_stats: StreamStats) -> AsyncGenerator:
+        """Stream the next response of the chat, without saving it."""
+        from database.db import AsyncSessionLocal
+
+        async with AsyncSessionLocal() as db_session:
+            message_history = await chat.get_chat_history_as_dict_async(db_session)
+
+        async with self.residency.turn(chat.default_model):
+            message_history = await self.context_window.build(chat, message_history)
 
+            cache_key = None
+            if self.response_cache:
+                cache_key = self.response_cache.make_key(chat.default_model, self.options, message_history)
+                cached_chunks = await asyncio.to_thread(self.response_cache.get, cache_key)
+                if cached_chunks is not None:
+                    stream_stats.cached = True
+                    for content in cached_chunks:
+                        yield content
+                    return
+
+            chunks = []
+            stream_stats.start()
+            async for chunked_response in await self.client.chat(
+                messages=message_history,
+                stream=True,
+                model=chat.default_model,
+                options=self.options,
+                keep_alive=self.residency.keep_alive,
+            ):
+                stream_stats.observe(chunked_response)
+                chunks.append(chunked_response.message.content)
+                yield chunked_response.message.content
+
+            # Only complete responses are cached, an interrupted stream never gets here.
+            if cache_key:
+                await asyncio.to_thread(self.response_cache.set, cache_key, chunks)
+
+    async def chat(
+        self, sender_agent_chat: 'Chat', responder_agent_chat: 'Chat', stream_stats: Optional[StreamStats] = None
+    ) -> AsyncGenerator:
+        """Stream the next response and save the turn. Pass stream_stats to read the numbers of the turn after."""
         ai_response = ''
-        for chunked_response in ollama.chat(
-            messages=message_history, stream=True, model=sender_agent_chat.default_model
-        ):
-            ai_response += chunked_response.message.content
-            yield chunked_response.message.content
+        stream_stats = stream_stats or StreamStats()
+        async for content in self.generate(sender_agent_chat, stream_stats):
+            ai_response += content
+            yield content
+
+        await self.save_turn(sender_agent_chat, responder_agent_chat, ai_response, stream_stats)
 
-        ChatMessage(
+    async def start_speculative_chat(
+        self, sender_agent_chat: 'Chat', responder_agent_chat: 'Chat'
+    ) -> 'SpeculativeChat':
+        return SpeculativeChat(self, sender_agent_chat=sender_agent_chat, responder_agent_chat=responder_agent_chat)
+
+    async def save_turn(
+        self, sender_agent_chat: 'Chat', responder_agent_chat: 'Chat', ai_response: str, stream_stats: StreamStats
+    ) -> None:
+        from models.chat_message import ChatMessage
+
+        # Both rows share one stored content and are written in the same transaction.
+        assistant_message = ChatMessage(
             chat_id=sender_agent_chat.id,
             role=ChatRole.ASSISTANT,
             model=sender_agent_chat.default_model,
             content=ai_response,
-        ).save()
-
-        ChatMessage(
+        )
+        user_message = ChatMessage(
             chat_id=responder_agent_chat.id,
             role=ChatRole.USER,
             model=responder_agent_chat.default_model,
             content=ai_response,
-        ).save()
+        )
+        await self._save_generated_messages([assistant_message, user_message], assistant_message, stream_stats)
+        if self.repetition:
+            self.repetition.observe(sender_agent_chat.id, ai_response)
+
+    async def chat_gui(self, chat: 'Chat') -> AsyncGenerator:
+        from models.chat_message import ChatMessage
 
-    @staticmethod
-    def chat_gui(chat: Chat) -> Generator:
-        message_history = chat.get_chat_history_as_dict()
         ai_response = ChatMessage(chat_id=chat.id, role=ChatRole.ASSISTANT, model=chat.default_model, content='')
-        for chunked_response in ollama.chat(messages=message_history, stream=True, model=chat.default_model):
-            ai_response.content += chunked_response.message.content
-            yield chunked_response.message.content
+        stream_stats = StreamStats()
+        async for content in self.generate(chat, stream_stats):
+            ai_response.content += content
+            yield content
 
-        ai_response.save()
+        await self._save_generated_messages([ai_response], ai_response, stream_stats)
 
     @staticmethod
-    def generate_chat_name(chat: Chat) -> str:
-        message_history = chat.get_chat_history_as_dict()
+    async def _save_generated_messages(
+        messages: list['ChatMessage'], generated_message: 'ChatMessage', stream_stats: StreamStats
+    ) -> None:
+        """Save the messages of a turn, then record the metrics of the generated one unless it was replayed."""
+        from database.db import AsyncSessionLocal
+        from models.chat_message import ChatMessage
+        from models.chat_message_metrics import ChatMessageMetrics
+
+        async with AsyncSessionLocal() as db_session:
+            write_started_at = time.perf_counter()
+            await ChatMessage.save_all_async(db_session, messages)
+            db_write_duration = time.perf_counter() - write_started_at
+            # A cached response has no numbers of its own, an empty row would only skew the statistics.
+            if stream_stats.cached:
+                return
+
+            db_session.add(
+                ChatMessageMetrics(
+                    chat_message_id=generated_message.id,
+                    model=generated_message.model,
+                    final_chunk=stream_stats.final_chunk,
+                    time_to_first_token=stream_stats.time_to_first_token,
+                    db_write_duration=db_write_duration,
+                )
+            )
+            await db_session.commit()
+
+    async def generate_chat_name(self, chat: 'Chat') -> str:
+        from database.db import AsyncSessionLocal
+        from models.chat_message import ChatMessage
+
+        async with AsyncSessionLocal() as db_session:
+            message_history = await chat.get_chat_history_as_dict_async(db_session)
+
         message_history.append(
             ChatMessage(
                 chat_id=chat.id,
@@ -78,4 +346,180 @@ class OllamaManager:
                 'If you include anything other than the name, the response is invalid.',
             ).to_dict()
         )
-        return ollama.chat(messages=message_history, model=chat.default_model).message.content
+        response = await self.client.chat(
+            messages=message_history, model=chat.default_model, keep_alive=self.residency.keep_alive
+        )
+        return response.message.content
+
+
+class SpeculativeChat:
+    """
+    A turn generated in the background before anyone asked for it.
+
+    Tokens are buffered until stream() is called, which replays them and saves the turn once it is complete.
+    discard() cancels the generation, nothing of a discarded turn is ever saved. Must be created on the event loop.
+    """
+
+    def __init__(self, manager: AsyncOllamaManager, sender_agent_chat: 'Chat', responder_agent_chat: 'Chat') -> None:
+        self.manager = manager
+        self.sender_agent_chat = sender_agent_chat
+        self.responder_agent_chat = responder_agent_chat
+        self.stream_stats = StreamStats()
+        self.discarded = False
+        self._ai_response = ''
+        # Generated chunks, None once the generation stopped.
+        self._chunks: asyncio.Queue[Optional[str]] = asyncio.Queue()
+        self._task = asyncio.create_task(self._generate())
+
+    async def _generate(self) -> None:
+        try:
+            async for content in self.manager.generate(self.sender_agent_chat, self.stream_stats):
+                self._ai_response += content
+                self._chunks.put_nowait(content)
+        finally:
+            self._chunks.put_nowait(None)
+
+    async def stream(self) -> AsyncGenerator:
+        """Yield the buffered and remaining tokens, then save the turn. Can only be consumed once."""
+        assert not self.discarded, 'The speculative chat was discarded.'
+        while (content := await self._chunks.get()) is not None:
+            yield content
+
+        # Raises if the generation failed.
+        await self._task
+        await self.manager.save_turn(
+            self.sender_agent_chat, self.responder_agent_chat, self._ai_response, self.stream_stats
+        )
+
+    async def discard(self) -> None:
+        self.discarded = True
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+class OllamaManager:
+    """Blocking API, a thin wrapper running AsyncOllamaManager on the background event loop."""
+
+    _async_manager: Optional[AsyncOllamaManager] = None
+
+    def __init__(self):
+        pass
+
+    @classmethod
+    def get_async_manager(cls) -> AsyncOllamaManager:
+        """The AsyncOllamaManager shared by everything running on the background event loop."""
+        if cls._async_manager is None:
+            cls._async_manager = AsyncOllamaManager()
+        return cls._async_manager
+
+    @staticmethod
+    async def _load_chats(chat_ids: list[int]) -> list['Chat']:
+        """
+        Chats of the calling thread's session are never used on the event loop, a commit on that thread expires
+        them and reading them would lazy load through its session. They are loaded again from an async session.
+        """
+        from database.db import AsyncSessionLocal
+        from models.chat import Chat
+
+        async with AsyncSessionLocal() as db_session:
+            return await Chat.load_async(db_session, chat_ids)
+
+    @classmethod
+    def set_generation_options(cls, seed: Optional[int] = None, temperature: Optional[float] = None) -> None:
+        cls.get_async_manager().set_generation_options(seed=seed, temperature=temperature)
+
+    @classmethod
+    def enable_response_cache(
+        cls, directory: Optional[str] = None, max_bytes: int = ResponseCache.DEFAULT_MAX_BYTES
+    ) -> ResponseCache:
+        return cls.get_async_manager().enable_response_cache(directory=directory, max_bytes=max_bytes)
+
+    @classmethod
+    def enable_repetition_detection(
+        cls, threshold: float = RepetitionDetector.DEFAULT_THRESHOLD, nudge: Optional[str] = None
+    ) -> RepetitionDetector:
+        return cls.get_async_manager().enable_repetition_detection(threshold=threshold, nudge=nudge)
+
+    @classmethod
+    def handle_repetition(cls, sender_agent_chat: 'Chat', responder_agent_chat: 'Chat') -> RepetitionAction:
+        return BackgroundEventLoop.run(cls._handle_repetition([sender_agent_chat.id, responder_agent_chat.id]))
+
+    @classmethod
+    async def _handle_repetition(cls, chat_ids: list[int]) -> RepetitionAction:
+        sender_agent_chat, responder_agent_chat = await cls._load_chats(chat_ids)
+        return await cls.get_async_manager().handle_repetition(
+            sender_agent_chat=sender_agent_chat, responder_agent_chat=responder_agent_chat
+        )
+
+    @classmethod
+    def get_downloaded_models(cls) -> ollama.ListResponse:
+        return BackgroundEventLoop.run(cls.get_async_manager().get_downloaded_models())
+
+    @classmethod
+    def get_model_information(cls, model: str) -> ollama.ShowResponse:
+        return BackgroundEventLoop.run(cls.get_async_manager().get_model_information(model=model))
+
+    @classmethod
+    def download_model(cls, model: Optional[str] = None) -> Generator:
+        return BackgroundEventLoop.iterate(cls.get_async_manager().download_model(model=model))
+
+    @classmethod
+    def delete_model(cls, model: str) -> ollama.StatusResponse:
+        return BackgroundEventLoop.run(cls.get_async_manager().delete_model(model=model))
+
+    @classmethod
+    def preload_models(cls, models: list[str]) -> None:
+        BackgroundEventLoop.run(cls.get_async_manager().residency.preload(models))
+
+    @classmethod
+    def chat(
+        cls, sender_agent_chat: 'Chat', responder_agent_chat: 'Chat', stream_stats: Optional[StreamStats] = None
+    ) -> Generator:
+        return BackgroundEventLoop.iterate(cls._chat([sender_agent_chat.id, responder_agent_chat.id], stream_stats))
+
+    @classmethod
+    async def _chat(cls, chat_ids: list[int], stream_stats: Optional[StreamStats]) -> AsyncGenerator:
+        sender_agent_chat, responder_agent_chat = await cls._load_chats(chat_ids)
+        async for content in cls.get_async_manager().chat(
+            sender_agent_chat=sender_agent_chat, responder_agent_chat=responder_agent_chat, stream_stats=stream_stats
+        ):
+            yield content
+
+    @classmethod
+    def start_speculative_chat(cls, sender_agent_chat: 'Chat', responder_agent_chat: 'Chat') -> SpeculativeChat:
+        """Start generating the next turn in the background, see SpeculativeChat."""
+        return BackgroundEventLoop.run(cls._start_speculative_chat([sender_agent_chat.id, responder_agent_chat.id]))
+
+    @classmethod
+    async def _start_speculative_chat(cls, chat_ids: list[int]) -> SpeculativeChat:
+        sender_agent_chat, responder_agent_chat = await cls._load_chats(chat_ids)
+        return await cls.get_async_manager().start_speculative_chat(
+            sender_agent_chat=sender_agent_chat, responder_agent_chat=responder_agent_chat
+        )
+
+    @classmethod
+    def stream_speculative_chat(cls, speculative_chat: SpeculativeChat) -> Generator:
+        return BackgroundEventLoop.iterate(speculative_chat.stream())
+
+    @classmethod
+    def discard_speculative_chat(cls, speculative_chat: SpeculativeChat) -> None:
+        BackgroundEventLoop.run(speculative_chat.discard())
+
+    @classmethod
+    def chat_gui(cls, chat: 'Chat') -> Generator:
+        return BackgroundEventLoop.iterate(cls._chat_gui(chat.id))
+
+    @classmethod
+    async def _chat_gui(cls, chat_id: int) -> AsyncGenerator:
+        (chat,) = await cls._load_chats([chat_id])
+        async for content in cls.get_async_manager().chat_gui(chat=chat):
+            yield content
+
+    @classmethod
+    def generate_chat_name(cls, chat: 'Chat') -> str:
+        return BackgroundEventLoop.run(cls._generate_chat_name(chat.id))
+
+    @classmethod
+    async def _generate_chat_name(cls, chat_id: int) -> str:
+        (chat,) = await cls._load_chats([chat_id])
+        return await cls.get_async_manager().generate_chat_name(chat=chat)
@@ -0,0 +1,99 @@
+import random
+import re
+import zlib
+from collections import defaultdict, deque
+from typing import Optional
+
+from enums.enums import RepetitionAction
+
+# Hashes are computed modulo this prime, 2^61 - 1.
+MERSENNE_PRIME = (1 << 61) - 1
+ROLLING_BASE = 1_000_003
+WORD_PATTERN = re.compile(r'\w+')
+
+
+class RepetitionDetector:
+    """
+    Notices agents that keep giving the same answer.
+
+    Every response is reduced to a MinHash signature of its word shingles in one pass and compared with the
+    signatures of the agent's last `window` responses, so a turn costs O(response length) however long the
+    conversation gets. The similarity of two signatures estimates the Jaccard similarity of their shingles.
+
+    Once an agent crosses the threshold the conversation is nudged with a system message if one is configured,
+    and stopped if it keeps repeating afterwards, or right away without a nudge.
+    """
+
+    DEFAULT_THRESHOLD = 0.8
+
+    def __init__(
+        self,
+        threshold: float = DEFAULT_THRESHOLD,
+        window: int = 3,
+        shingle_size: int = 3,
+        num_hashes: int = 64,
+        nudge: Optional[str] = None,
+    ) -> None:
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.nudge = nudge
+        # Fixed seed, the same response gets the same signature in every run.
+        rng = random.Random(0)
+        self._permutations = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME)) for _ in range(num_hashes)
+        ]
+        self._signatures: dict[int, deque[tuple[int, ...]]] = defaultdict(lambda: deque(maxlen=window))
+        # Highest similarity of the last response of each chat to its previous ones.
+        self.similarities: dict[int, float] = {}
+        self._nudged: set[int] = set()
+
+    def shingle_hashes(self, text: str) -> set[int]:
+        """Hashes of all runs of shingle_size words, each computed from the previous one with a rolling hash."""
+        words = [zlib.crc32(word.encode('utf-8')) for word in WORD_PATTERN.findall(text.lower())]
+        size = min(self.shingle_size, len(words))
+        if not size:
+            return set()
+
+        top_power = pow(ROLLING_BASE, size - 1, MERSENNE_PRIME)
+        shingle_hash = 0
+        for word in words[:size]:
+            shingle_hash = (shingle_hash * ROLLING_BASE + word) % MERSENNE_PRIME
+        hashes = {shingle_hash}
+        for dropped, added in zip(words, words[size:]):
+            shingle_hash = ((shingle_hash - dropped * top_power) * ROLLING_BASE + added) % MERSENNE_PRIME
+            hashes.add(shingle_hash)
+        return hashes
+
+    def signature(self, text: str) -> tuple[int, ...]:
+        hashes = self.shingle_hashes(text)
+        if not hashes:
+            return tuple(MERSENNE_PRIME for _ in self._permutations)
+        return tuple(min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in self._permutations)
+
+    @staticmethod
+    def similarity(signature: tuple[int, ...], other: tuple[int, ...]) -> float:
+        return sum(x == y for x, y in zip(signature, other)) / len(signature)
+
+    def observe(self, chat_id: int, response: str) -> float:
+        """Record a response of the chat, returns its highest similarity to the chat's recent responses."""
+        signature = self.signature(response)
+        recent = self._signatures[chat_id]
+        similarity = max((self.similarity(signature, previous) for previous in recent), default=0.0)
+        recent.append(signature)
+        self.similarities[chat_id] = similarity
+        return similarity
+
+    def get_action(self, chat_id: int) -> RepetitionAction:
+        """What to do after the last response of the chat."""
+        if self.similarities.get(chat_id, 0.0) < self.threshold:
+            return RepetitionAction.CONTINUE
+        if self.nudge and chat_id not in self._nudged:
+            return RepetitionAction.NUDGE
+        return RepetitionAction.STOP
+
+    def mark_nudged(self, chat_ids: list[int]) -> None:
+        """Start over for the nudged chats, their next responses are only compared with what follows the nudge."""
+        for chat_id in chat_ids:
+            self._nudged.add(chat_id)
+            self._signatures.pop(chat_id, None)
+            self.similarities.pop(chat_id, None)
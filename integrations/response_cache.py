@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+
+class ResponseCache:
+    """
+    On disk cache of generated responses, keyed by model, generation options and the exact messages sent.
+
+    Only useful when generation is deterministic (a fixed seed or temperature 0), a hit returns the response of
+    the first run. Entries are evicted least recently used first once the cache grows over max_bytes.
+    """
+
+    DEFAULT_DIRECTORY = Path.home() / '.cache' / 'llm-talks' / 'responses'
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, directory: Optional[Path] = None, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        self.directory = Path(directory or self.DEFAULT_DIRECTORY)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Size per key, least recently used first. Loaded from the directory on first use.
+        self._entries: Optional[OrderedDict[str, int]] = None
+        self._size = 0
+
+    @staticmethod
+    def make_key(model: str, options: Optional[dict], messages: list[dict]) -> str:
+        payload = json.dumps(
+            {'model': model, 'options': options or {}, 'messages': messages},
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(',', ':'),
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[list[str]]:
+        """The cached chunks of the response, None on a miss."""
+        with self._lock:
+            entries = self._load_entries()
+            path = self._path(key)
+            try:
+                chunks = json.loads(path.read_text(encoding='utf-8'))['chunks'] if key in entries else None
+            except (OSError, ValueError, KeyError):
+                self._remove(key)
+                chunks = None
+
+            if chunks is None:
+                self.misses += 1
+                return None
+
+            entries.move_to_end(key)
+            # Keep the recency across runs, entries are ordered by modification time when loaded.
+            os.utime(path)
+            self.hits += 1
+            return chunks
+
+    def set(self, key: str, chunks: list[str]) -> None:
+        data = json.dumps({'chunks': chunks}, ensure_ascii=False).encode('utf-8')
+        if len(data) > self.max_bytes:
+            return
+
+        with self._lock:
+            self._remove(key)
+            path = self._path(key)
+            tmp_path = path.with_suffix('.tmp')
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+
+            self._entries[key] = len(data)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        with self._lock:
+            for key in list(self._load_entries()):
+                self._remove(key)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f'{key}.json'
+
+    def _load_entries(self) -> OrderedDict[str, int]:
+        if self._entries is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            stats = sorted(
+                ((path.stem, path.stat()) for path in self.directory.glob('*.json')), key=lambda x: x[1].st_mtime
+            )
+            self._entries = OrderedDict((key, stat.st_size) for key, stat in stats)
+            self._size = sum(self._entries.values())
+        return self._entries
+
+    def _remove(self, key: str) -> None:
+        size = self._load_entries().pop(key, None)
+        if size is not None:
+            self._size -= size
+        self._path(key).unlink(missing_ok=True)
@@ -2,7 +2,7 @@ from sqlalchemy.ext.declarative import as_declarative, declared_attr
 from sqlalchemy.orm import Query
 from sqlalchemy import Column, Integer, DateTime, func
 
-from database.db import session
+from database.db import commit, session
 
 from typing_extensions import Self
 
@@ -22,15 +22,22 @@ class BaseModel:
         return {column.name: getattr(self, column.name) for column in self.__table__.columns}
 
     def save(self) -> Self:
-        """Save model to database."""
+        """Save model to database, committed at the end of the enclosing transaction block if any."""
         if self not in session:
             session.add(self)
-        session.commit()
+        commit()
         return self
 
+    @classmethod
+    def save_all(cls, instances: list[Self]) -> list[Self]:
+        """Save several models to database in a single transaction."""
+        session.add_all([instance for instance in instances if instance not in session])
+        commit()
+        return instances
+
     def delete(self) -> None:
         session.delete(self)
-        session.commit()
+        commit()
 
     @classmethod
     def get_one(cls, **kwargs) -> Self:
@@ -44,7 +51,7 @@ class BaseModel:
 
     @classmethod
     def get_multiple(cls, **kwargs) -> list[Self]:
-        return cls.query(**kwargs).order_by(cls.created_at).all()
+        return cls.query(**kwargs).all()
 
     @classmethod
     def query(cls, **kwargs) -> Query:
@@ -60,4 +67,5 @@ class BaseModel:
             else:  # Handle single values
                 query = query.filter(attr == value)
 
-        return query.order_by(cls.created_at)
+        # Rows written in the same transaction share created_at, id keeps their insertion order.
+        return query.order_by(cls.created_at, cls.id)
@@ -1,30 +1,174 @@
 from typing import Optional
 
 from .base import BaseModel
-from sqlalchemy import Column, String
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, ForeignKey, Index, Integer, Select, String, and_, case, cast, event, null, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased, relationship
 
+from database.db import session, transaction
+
+from enums.enums import ChatRole
 from models.chat_message import ChatMessage
+from models.chat_history_cache import ChatHistoryCache
 
 
 class Chat(BaseModel):
     __tablename__ = 'chat'
+    __table_args__ = (
+        # Finds the forks of a chat, for deletes.
+        Index('ix_chat_parent_chat_id', 'parent_chat_id'),
+        Index('ix_chat_parent_message_id', 'parent_message_id'),
+    )
 
     default_model = Column(String(), nullable=False)
-    messages = relationship('ChatMessage', back_populates='chat', cascade='all, delete-orphan')
 
-    def __init__(self, default_model: Optional[str] = None) -> None:
+    # Token budget for the history sent to the model, older turns are folded into context_summary. None sends all.
+    context_token_budget = Column(Integer, nullable=True)
+    context_summary = Column(String(), nullable=True)
+    # Number of leading non-system messages that context_summary covers.
+    context_summary_message_count = Column(Integer, nullable=False, default=0)
+
+    # A fork shares the history of its parent chat up to and including parent_message_id instead of copying it. It
+    # is deleted with that history.
+    parent_chat_id = Column(Integer, ForeignKey('chat.id', ondelete='CASCADE'), nullable=True)
+    parent_message_id = Column(
+        Integer,
+        ForeignKey('chat_message.id', use_alter=True, name='chat_parent_message_id_fkey', ondelete='CASCADE'),
+        nullable=True,
+    )
+
+    messages = relationship(
+        'ChatMessage',
+        back_populates='chat',
+        cascade='all, delete-orphan',
+        foreign_keys='ChatMessage.chat_id',
+        passive_deletes=True,
+    )
+
+    def __init__(
+        self,
+        default_model: Optional[str] = None,
+        context_token_budget: Optional[int] = None,
+        parent_chat_id: Optional[int] = None,
+        parent_message_id: Optional[int] = None,
+    ) -> None:
         super().__init__()
         self.default_model = default_model
+        self.context_token_budget = context_token_budget
+        self.context_summary_message_count = 0
+        self.parent_chat_id = parent_chat_id
+        self.parent_message_id = parent_message_id
+
+    @classmethod
+    def set_up_agent(cls, model: str, system_message: str, context_token_budget: Optional[int] = None) -> 'Chat':
+        """Create a chat for an LLM agent with its initial system message."""
+        with transaction():
+            chat = cls(default_model=model, context_token_budget=context_token_budget).save()
+            ChatMessage.save_all(
+                [
+                    ChatMessage(chat_id=chat.id, role=ChatRole.SYSTEM, content=system_message),
+                    # To get the models to start talking they both need to have empty user messages to start with.
+                    ChatMessage(chat_id=chat.id, role=ChatRole.USER, content=''),
+                ]
+            )
+
+        return chat
+
+    @classmethod
+    async def load_async(cls, db_session: AsyncSession, chat_ids: list[int]) -> list['Chat']:
+        """The chats with the given ids, in that order."""
+        chats = {chat.id: chat for chat in await db_session.scalars(select(cls).where(cls.id.in_(chat_ids)))}
+        return [chats[chat_id] for chat_id in chat_ids]
+
+    @classmethod
+    def fork(cls, parent: 'Chat', parent_message_id: int) -> 'Chat':
+        """A new, unsaved chat continuing the history of the parent after the given message of that history."""
+        return cls(
+            default_model=parent.default_model,
+            context_token_budget=parent.context_token_budget,
+            parent_chat_id=parent.id,
+            parent_message_id=parent_message_id,
+        )
+
+    @classmethod
+    def history_statement(cls, chat_ids: list[int], roles: Optional[list[ChatRole]] = None) -> Select:
+        """
+        Select the messages of the chats including the history shared with the chats they were forked from, as
+        (message, id of the given chat it belongs to) rows ordered by created_at, id.
+        """
+        # Walk up the forks. Every ancestor contributes its messages up to the message the fork below it was made
+        # at, unless that fork was made at a message the ancestor inherited itself, then the older bound applies.
+        lineage = select(
+            cls.id.label('owner_chat_id'), cls.id.label('chat_id'), cast(null(), Integer).label('until_message_id')
+        ).where(cls.id.in_(chat_ids))
+        lineage = lineage.cte('chat_lineage', recursive=True)
+
+        chat = aliased(cls)
+        until_message = aliased(ChatMessage)
+        lineage = lineage.union_all(
+            select(
+                lineage.c.owner_chat_id,
+                chat.parent_chat_id,
+                case(
+                    (lineage.c.until_message_id.is_(None), chat.parent_message_id),
+                    (until_message.chat_id == chat.id, chat.parent_message_id),
+                    else_=lineage.c.until_message_id,
+                ),
+            )
+            .join(chat, chat.id == lineage.c.chat_id)
+            .outerjoin(until_message, until_message.id == lineage.c.until_message_id)
+            .where(chat.parent_chat_id.is_not(None))
+        )
+
+        until_message = aliased(ChatMessage)
+        statement = (
+            select(ChatMessage, lineage.c.owner_chat_id)
+            .join(lineage, ChatMessage.chat_id == lineage.c.chat_id)
+            .outerjoin(until_message, until_message.id == lineage.c.until_message_id)
+            .filter(
+                or_(
+                    lineage.c.until_message_id.is_(None),
+                    ChatMessage.created_at < until_message.created_at,
+                    and_(ChatMessage.created_at == until_message.created_at, ChatMessage.id <= until_message.id),
+                )
+            )
+            .order_by(ChatMessage.created_at, ChatMessage.id)
+        )
+        if roles:
+            statement = statement.filter(ChatMessage.role.in_(roles))
+        return statement
 
     def get_chat_history(self) -> list[ChatMessage]:
-        return ChatMessage.get_multiple(chat_id=self.id)
+        return list(session.scalars(self.history_statement([self.id])))
 
     def get_chat_history_as_dict(self) -> list[dict[str, str]]:
-        return [m.to_dict() for m in self.get_chat_history()]
+        history = ChatHistoryCache.get(self.id)
+        if history is None:
+            history = [m.to_dict() for m in self.get_chat_history()]
+            ChatHistoryCache.set(self.id, history)
+
+        # Return a copy so callers can extend the history without touching the cache.
+        return list(history)
+
+    async def get_chat_history_as_dict_async(self, db_session: AsyncSession) -> list[dict[str, str]]:
+        history = ChatHistoryCache.get(self.id)
+        if history is None:
+            result = await db_session.execute(self.history_statement([self.id]))
+            history = [m.to_dict() for m in result.scalars()]
+            ChatHistoryCache.set(self.id, history)
+
+        return list(history)
 
     def get_gui_id(self) -> str:
         return f'_{self.id}'
 
     def get_gui_id_with_hash_tag(self) -> str:
         return f'#{self.get_gui_id()}'
+
+
+@event.listens_for(Chat, 'after_insert')
+@event.listens_for(Chat, 'after_delete')
+def _invalidate_history_cache(mapper, connection, chat: Chat) -> None:
+    # Ids of deleted chats are reused, also when another process deleted them, so new chats and forks never start
+    # from a cached history.
+    ChatHistoryCache.invalidate(chat.id)
@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class ChatHistoryCache:
+    """
+    Append-only, in-memory cache of the message dicts sent to the LLM for each chat. Holds the histories of the
+    MAX_CHATS most recently used chats, the others are loaded again on next access.
+    """
+
+    MAX_CHATS = 256
+
+    # Used from the calling thread and the background event loop.
+    _lock = threading.Lock()
+    _histories: OrderedDict[int, list[dict]] = OrderedDict()
+
+    @classmethod
+    def get(cls, chat_id: int) -> Optional[list[dict]]:
+        with cls._lock:
+            history = cls._histories.get(chat_id)
+            if history is not None:
+                cls._histories.move_to_end(chat_id)
+            return history
+
+    @classmethod
+    def set(cls, chat_id: int, history: list[dict]) -> None:
+        with cls._lock:
+            cls._histories[chat_id] = history
+            cls._histories.move_to_end(chat_id)
+            while len(cls._histories) > cls.MAX_CHATS:
+                cls._histories.popitem(last=False)
+
+    @classmethod
+    def append(cls, chat_id: int, message: dict) -> None:
+        # Only extend histories that are already cached, a missing history is loaded in full on next access.
+        with cls._lock:
+            history = cls._histories.get(chat_id)
+            if history is not None:
+                history.append(message)
+
+    @classmethod
+    def invalidate(cls, chat_id: int) -> None:
+        with cls._lock:
+            cls._histories.pop(chat_id, None)
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._histories.clear()
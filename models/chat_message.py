@@ -1,22 +1,38 @@
 from typing import Optional
 
-from sqlalchemy import Column, String, Integer, ForeignKey, Enum
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, String, Integer, ForeignKey, Enum, Index, event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, relationship
 from enums.enums import ChatRole
+from typing_extensions import Self
+
+from database.db import commit, session
 
 from .base import BaseModel
+from .chat_history_cache import ChatHistoryCache
+from .message_content import MessageContent
+
+# Key in Session.info of the history entries that are appended to ChatHistoryCache once the session commits.
+PENDING_HISTORY_KEY = 'pending_chat_history'
 
 
 class ChatMessage(BaseModel):
     __tablename__ = 'chat_message'
+    __table_args__ = (
+        # Covers history loads, filtered by chat_id and role and ordered by created_at, id.
+        Index('ix_chat_message_chat_id_role_created_at', 'chat_id', 'role', 'created_at', 'id'),
+        # Finds the messages of a content, for search results.
+        Index('ix_chat_message_content_id', 'content_id'),
+    )
 
     chat_id = Column(Integer, ForeignKey('chat.id', ondelete='CASCADE'), nullable=False)
+    content_id = Column(Integer, ForeignKey('message_content.id'), nullable=False)
 
-    content = Column(String(), nullable=False)
     model = Column(String(), nullable=True)
     role = Column(Enum(ChatRole), nullable=False)
 
-    chat = relationship('Chat', back_populates='messages')
+    chat = relationship('Chat', back_populates='messages', foreign_keys=[chat_id])
+    message_content = relationship('MessageContent', lazy='joined')
 
     def __init__(self, chat_id: int, content: str, role: ChatRole, model: Optional[str] = None) -> None:
         super().__init__()
@@ -27,5 +43,80 @@ class ChatMessage(BaseModel):
 
         assert not self.role.is_assistant() or self.model, 'model must be set for assistant messages'
 
+    @property
+    def content(self) -> str:
+        # Content that has not been saved yet lives on the instance until save() resolves its MessageContent row.
+        pending_content = getattr(self, '_pending_content', None)
+        if pending_content is not None:
+            return pending_content
+        return self.message_content.content
+
+    @content.setter
+    def content(self, value: str) -> None:
+        self._pending_content = value
+
     def to_dict(self) -> dict:
         return {'role': self.role.value, 'content': self.content}
+
+    def save(self) -> Self:
+        """Save message to database and append it to the cached chat history."""
+        return self.save_all([self])[0]
+
+    @classmethod
+    def save_all(cls, messages: list[Self]) -> list[Self]:
+        """Save messages in a single transaction, storing each distinct content only once."""
+        # Read these before committing, the commit expires the instances.
+        history_entries = cls._get_history_entries(messages)
+
+        cls.stage_all(session, messages)
+        cls._defer_history_cache(session(), history_entries)
+        commit()
+
+        return messages
+
+    @classmethod
+    async def save_all_async(cls, db_session: AsyncSession, messages: list[Self]) -> list[Self]:
+        """Async variant of save_all, the messages are committed on the given async session."""
+        history_entries = cls._get_history_entries(messages)
+
+        await db_session.run_sync(cls.stage_all, messages)
+        cls._defer_history_cache(db_session.sync_session, history_entries)
+        await db_session.commit()
+
+        return messages
+
+    @staticmethod
+    def stage_all(db_session: Session, messages: list['ChatMessage']) -> None:
+        """Resolve the shared contents of the messages and add them to the session without committing."""
+        pending = [message for message in messages if getattr(message, '_pending_content', None) is not None]
+        if pending:
+            contents = MessageContent.get_or_create_many(db_session, [message.content for message in pending])
+            for message in pending:
+                message.message_content = contents[MessageContent.compute_hash(message.content)]
+
+        db_session.add_all([message for message in messages if message not in db_session])
+
+    @staticmethod
+    def _get_history_entries(messages: list['ChatMessage']) -> list[tuple[int, dict]]:
+        return [(message.chat_id, message.to_dict()) for message in messages if message.id is None]
+
+    @staticmethod
+    def _defer_history_cache(db_session: Session, history_entries: list[tuple[int, dict]]) -> None:
+        """Append the entries to the cached histories once the session commits, they are dropped on rollback."""
+        db_session.info.setdefault(PENDING_HISTORY_KEY, []).extend(history_entries)
+
+    def delete(self) -> None:
+        chat_id = self.chat_id
+        super().delete()
+        ChatHistoryCache.invalidate(chat_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _append_committed_history(db_session: Session) -> None:
+    for chat_id, message in db_session.info.pop(PENDING_HISTORY_KEY, []):
+        ChatHistoryCache.append(chat_id, message)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_rolled_back_history(db_session: Session) -> None:
+    db_session.info.pop(PENDING_HISTORY_KEY, None)
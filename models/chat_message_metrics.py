@@ -0,0 +1,157 @@
+from typing import Optional
+
+import ollama
+from sqlalchemy import BigInteger, Column, Float, ForeignKey, Integer, String, case, cast, func, or_, select
+from sqlalchemy.orm import relationship
+
+from database.db import session
+
+from .base import BaseModel
+from .chat_message import ChatMessage
+from .conversation import Conversation
+
+TTFT_PERCENTILES = (50, 95)
+
+
+class ChatMessageMetrics(BaseModel):
+    """Performance numbers of one generated message, Ollama durations are in nanoseconds."""
+
+    __tablename__ = 'chat_message_metrics'
+
+    chat_message_id = Column(Integer, ForeignKey('chat_message.id', ondelete='CASCADE'), nullable=False, unique=True)
+    model = Column(String(), nullable=False)
+
+    # As reported by Ollama in the final chunk of the stream.
+    total_duration = Column(BigInteger, nullable=True)
+    load_duration = Column(BigInteger, nullable=True)
+    prompt_eval_count = Column(Integer, nullable=True)
+    prompt_eval_duration = Column(BigInteger, nullable=True)
+    eval_count = Column(Integer, nullable=True)
+    eval_duration = Column(BigInteger, nullable=True)
+
+    # Measured client side, in seconds.
+    time_to_first_token = Column(Float, nullable=True)
+    db_write_duration = Column(Float, nullable=True)
+
+    chat_message = relationship('ChatMessage')
+
+    def __init__(
+        self,
+        chat_message_id: int,
+        model: str,
+        final_chunk: Optional[ollama.ChatResponse] = None,
+        time_to_first_token: Optional[float] = None,
+        db_write_duration: Optional[float] = None,
+    ) -> None:
+        super().__init__()
+        self.chat_message_id = chat_message_id
+        self.model = model
+        self.time_to_first_token = time_to_first_token
+        self.db_write_duration = db_write_duration
+
+        if final_chunk:
+            self.total_duration = final_chunk.total_duration
+            self.load_duration = final_chunk.load_duration
+            self.prompt_eval_count = final_chunk.prompt_eval_count
+            self.prompt_eval_duration = final_chunk.prompt_eval_duration
+            self.eval_count = final_chunk.eval_count
+            self.eval_duration = final_chunk.eval_duration
+
+    @classmethod
+    def get_stats(cls, conv_id: Optional[int] = None, per_conversation: bool = True) -> list[dict]:
+        """
+        Aggregate the metrics per model, and per conversation if per_conversation, in one grouped query. Time to first
+        token percentiles are nearest rank, the smallest time at least q percent of the turns took: percentile_disc on
+        Postgres, a window over each group on other databases.
+        """
+        postgres = session.get_bind().dialect.name == 'postgresql'
+        group_columns = ([Conversation.id.label('conv_id')] if per_conversation else []) + [cls.model.label('model')]
+        ttft = cls.time_to_first_token
+        columns = [
+            *group_columns,
+            cls.prompt_eval_count,
+            cls.eval_count,
+            cls.eval_duration,
+            cls.load_duration,
+            cls.db_write_duration,
+            ttft,
+        ]
+        if not postgres:
+            partition = [column.element for column in group_columns]
+            columns += [
+                # Rows without a time to first token are ranked last, ranks 1 to ttft_count have one.
+                func.row_number().over(partition_by=partition, order_by=[ttft.is_(None), ttft]).label('ttft_rank'),
+                func.count(ttft).over(partition_by=partition).label('ttft_count'),
+            ]
+
+        metrics = (
+            select(*columns)
+            .join(ChatMessage, cls.chat_message_id == ChatMessage.id)
+            .join(
+                Conversation,
+                or_(
+                    Conversation.agent_1_chat_id == ChatMessage.chat_id,
+                    Conversation.agent_2_chat_id == ChatMessage.chat_id,
+                ),
+            )
+        )
+        if conv_id is not None:
+            metrics = metrics.where(Conversation.id == conv_id)
+        metrics = metrics.subquery()
+
+        if postgres:
+            ttft_percentiles = [
+                func.percentile_disc(q / 100).within_group(metrics.c.time_to_first_token) for q in TTFT_PERCENTILES
+            ]
+        else:
+            ttft_percentiles = [
+                func.max(
+                    case(
+                        (
+                            # Rank ceil(count * q / 100), like percentile_disc.
+                            metrics.c.ttft_rank == (metrics.c.ttft_count * q + 99) // 100,
+                            metrics.c.time_to_first_token,
+                        )
+                    )
+                )
+                for q in TTFT_PERCENTILES
+            ]
+
+        group = [metrics.c[column.name] for column in group_columns]
+        statement = (
+            select(
+                *group,
+                func.count(),
+                func.coalesce(func.sum(metrics.c.prompt_eval_count), 0),
+                func.coalesce(func.sum(metrics.c.eval_count), 0),
+                # Postgres sums bigints as numeric, cast back so they are not read as Decimal.
+                cast(func.coalesce(func.sum(metrics.c.eval_duration), 0), BigInteger),
+                cast(func.coalesce(func.sum(metrics.c.load_duration), 0), BigInteger),
+                func.coalesce(func.sum(metrics.c.db_write_duration), 0),
+                *ttft_percentiles,
+            )
+            .group_by(*group)
+            .order_by(*group)
+        )
+
+        stats = []
+        for row in session.execute(statement):
+            keys = dict(zip([column.name for column in group_columns], row))
+            turns, prompt_tokens, eval_count, eval_duration, load_duration, db_write_duration, *ttfts = row[len(keys) :]
+            stats.append(
+                {
+                    **keys,
+                    'turns': turns,
+                    'prompt_tokens': prompt_tokens,
+                    'generated_tokens': eval_count,
+                    'tokens_per_second': round(eval_count / (eval_duration / 1e9), 2) if eval_duration else None,
+                    **{f'ttft_p{q}_s': _round(ttft) for q, ttft in zip(TTFT_PERCENTILES, ttfts)},
+                    'load_s': round(load_duration / 1e9, 3),
+                    'db_write_s': round(db_write_duration, 3),
+                }
+            )
+        return stats
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 3)
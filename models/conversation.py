@@ -1,25 +1,106 @@
-from enums.enums import ChatRole, TextAlignment, TextColor
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import datetime
+
+from enums.enums import ChatRole, ConversationSortKey, TextAlignment, TextColor
 from .base import BaseModel
-from sqlalchemy import Column, Integer, ForeignKey
+from typing import Iterator, Optional, Union
+
+from sqlalchemy import (
+    Column,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    Row,
+    Select,
+    Update,
+    and_,
+    delete,
+    exists,
+    func,
+    inspect,
+    or_,
+    select,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased, joinedload, relationship
+from sqlalchemy.orm.attributes import set_committed_value
+from typing_extensions import Self
+
+from database.db import commit, session, transaction
 
 from rich.panel import Panel
 from rich.text import Text
 from rich.align import Align
 
 from .chat import Chat
+from .chat_history_cache import ChatHistoryCache
 from .chat_message import ChatMessage
+from .message_content import MessageContent
+
+TRANSCRIPT_ROLES = [ChatRole.ASSISTANT, ChatRole.SYSTEM]
+TRANSCRIPT_PAGE_SIZE = 200
+# Contents checked for remaining references per statement when conversations are deleted.
+CONTENT_DELETE_BATCH_SIZE = 1000
+
+
+@dataclass
+class ConversationSummary:
+    conv_id: int
+    agent_1_model: str
+    agent_2_model: str
+    # Responses and their characters written in this conversation, history shared with a parent is not counted.
+    turns: int
+    characters: int
+    created_at: datetime
+    last_activity: datetime
 
 
 class Conversation(BaseModel):
     __tablename__ = 'conversation'
+    __table_args__ = (
+        # Used by the cascade when chats are deleted.
+        Index('ix_conversation_agent_1_chat_id', 'agent_1_chat_id'),
+        Index('ix_conversation_agent_2_chat_id', 'agent_2_chat_id'),
+    )
+
+    # Deleting a chat deletes its conversation, see delete_many.
+    agent_1_chat_id = Column(Integer, ForeignKey('chat.id', ondelete='CASCADE'), nullable=False)
+    agent_2_chat_id = Column(Integer, ForeignKey('chat.id', ondelete='CASCADE'), nullable=False)
+
+    # Loaded once and kept on the instance, use Conversation.load to get both in the same query.
+    agent_1_chat = relationship('Chat', foreign_keys=[agent_1_chat_id])
+    agent_2_chat = relationship('Chat', foreign_keys=[agent_2_chat_id])
+
+    # Budgets the runners stop at, None is unlimited. Wall time is the time spent generating turns, in seconds.
+    max_turns = Column(Integer, nullable=True)
+    max_generated_tokens = Column(Integer, nullable=True)
+    max_wall_seconds = Column(Float, nullable=True)
 
-    agent_1_chat_id = Column(Integer, ForeignKey('chat.id'), nullable=False)
-    agent_2_chat_id = Column(Integer, ForeignKey('chat.id'), nullable=False)
+    # What has been used of the budgets, over all runs. Only updated by record_turn.
+    turn_count = Column(Integer, nullable=False, default=0)
+    generated_token_count = Column(Integer, nullable=False, default=0)
+    wall_seconds = Column(Float, nullable=False, default=0)
 
-    def __init__(self, agent_1_chat_id: int, agent_2_chat_id: int) -> None:
+    def __init__(
+        self,
+        agent_1_chat_id: int,
+        agent_2_chat_id: int,
+        max_turns: Optional[int] = None,
+        max_generated_tokens: Optional[int] = None,
+        max_wall_seconds: Optional[float] = None,
+    ) -> None:
         super().__init__()
         self.agent_1_chat_id = agent_1_chat_id
         self.agent_2_chat_id = agent_2_chat_id
+        self.max_turns = max_turns
+        self.max_generated_tokens = max_generated_tokens
+        self.max_wall_seconds = max_wall_seconds
+        self.turn_count = 0
+        self.generated_token_count = 0
+        self.wall_seconds = 0
 
     def to_dict(self) -> dict:
         return {
@@ -29,33 +110,434 @@ class Conversation(BaseModel):
             'created_at': self.created_at,
         }
 
-    @property
-    def agent_1_chat(self) -> Chat:
-        return Chat.get_one(id=self.agent_1_chat_id)
+    def get_exhausted_budget(self) -> Optional[str]:
+        """Description of the first budget that is used up, None while the conversation may continue."""
+        for name, used, limit in (
+            ('turns', self.turn_count, self.max_turns),
+            ('generated tokens', self.generated_token_count, self.max_generated_tokens),
+            ('wall time seconds', self.wall_seconds, self.max_wall_seconds),
+        ):
+            if limit is not None and used >= limit:
+                return f'{name} ({round(used, 1)} of {limit})'
+        return None
 
-    @property
-    def agent_2_chat(self) -> Chat:
-        return Chat.get_one(id=self.agent_2_chat_id)
+    def _record_turn_statement(self, generated_tokens: int, seconds: float) -> Update:
+        # Incremented in the database, concurrent runs of the same conversation do not lose each other's turns.
+        cls = type(self)
+        return (
+            update(cls)
+            .where(cls.id == self.id)
+            .values(
+                turn_count=cls.turn_count + 1,
+                generated_token_count=cls.generated_token_count + generated_tokens,
+                wall_seconds=cls.wall_seconds + seconds,
+            )
+            .returning(cls.turn_count, cls.generated_token_count, cls.wall_seconds)
+            .execution_options(synchronize_session=False)
+        )
+
+    def _set_counters(self, row: Row) -> None:
+        for key, value in row._mapping.items():
+            set_committed_value(self, key, value)
+
+    def record_turn(self, generated_tokens: int, seconds: float) -> None:
+        """Add a turn to the used budgets."""
+        row = session.execute(self._record_turn_statement(generated_tokens, seconds)).one()
+        commit()
+        self._set_counters(row)
+
+    async def record_turn_async(self, db_session: AsyncSession, generated_tokens: int, seconds: float) -> None:
+        row = (await db_session.execute(self._record_turn_statement(generated_tokens, seconds))).one()
+        await db_session.commit()
+        self._set_counters(row)
+
+    @classmethod
+    def get_summaries(
+        cls,
+        model: Optional[str] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        sort: ConversationSortKey = ConversationSortKey.ID,
+        descending: bool = False,
+        limit: Optional[int] = None,
+        offset: int = 0,
+    ) -> list[ConversationSummary]:
+        """
+        Summaries of the conversations in a single aggregate query. model matches either agent, since and until
+        bound when the conversation was created.
+        """
+        agent_1_chat = aliased(Chat)
+        agent_2_chat = aliased(Chat)
+        turns = func.count(ChatMessage.id)
+        characters = func.coalesce(func.sum(func.length(MessageContent.content)), 0)
+        last_activity = func.coalesce(func.max(ChatMessage.created_at), cls.created_at)
+
+        statement = (
+            select(
+                cls.id,
+                agent_1_chat.default_model,
+                agent_2_chat.default_model,
+                turns,
+                characters,
+                cls.created_at,
+                last_activity,
+            )
+            .join(agent_1_chat, agent_1_chat.id == cls.agent_1_chat_id)
+            .join(agent_2_chat, agent_2_chat.id == cls.agent_2_chat_id)
+            # Served by the (chat_id, role, ...) index of chat_message.
+            .outerjoin(
+                ChatMessage,
+                and_(
+                    ChatMessage.chat_id.in_([cls.agent_1_chat_id, cls.agent_2_chat_id]),
+                    ChatMessage.role == ChatRole.ASSISTANT,
+                ),
+            )
+            .outerjoin(MessageContent, MessageContent.id == ChatMessage.content_id)
+            .group_by(cls.id, cls.created_at, agent_1_chat.default_model, agent_2_chat.default_model)
+        )
+        if model is not None:
+            statement = statement.where(or_(agent_1_chat.default_model == model, agent_2_chat.default_model == model))
+        if since is not None:
+            statement = statement.where(cls.created_at >= since)
+        if until is not None:
+            statement = statement.where(cls.created_at < until)
+
+        sort_column = {
+            ConversationSortKey.ID: cls.id,
+            ConversationSortKey.CREATED_AT: cls.created_at,
+            ConversationSortKey.LAST_ACTIVITY: last_activity,
+            ConversationSortKey.TURNS: turns,
+            ConversationSortKey.CHARACTERS: characters,
+        }[sort]
+        # id breaks ties, so pages are stable.
+        statement = statement.order_by(*((sort_column.desc(), cls.id.desc()) if descending else (sort_column, cls.id)))
+        statement = statement.limit(limit).offset(offset)
+
+        return [ConversationSummary(*row) for row in session.execute(statement)]
+
+    @classmethod
+    def stale_statement(cls, older_than: datetime, model: Optional[str] = None) -> Select:
+        """
+        Select the ids of conversations without messages since older_than, of the model if given. Forks share the
+        history of their parent and are deleted with it, a conversation with a fork in use is not stale.
+        """
+        # Pairs every old conversation with its chats and all chats forked from them, forks of forks included.
+        conversation = aliased(cls)
+        chat = aliased(Chat)
+        lineage = (
+            select(conversation.id.label('conv_id'), chat.id.label('chat_id'))
+            .join(chat, chat.id.in_([conversation.agent_1_chat_id, conversation.agent_2_chat_id]))
+            .where(conversation.created_at < older_than)
+            .cte('stale_lineage', recursive=True)
+        )
+        fork = aliased(Chat)
+        lineage = lineage.union_all(
+            select(lineage.c.conv_id, fork.id).join(lineage, fork.parent_chat_id == lineage.c.chat_id)
+        )
+        lineage_chat = aliased(Chat)
+        active = (
+            select(lineage.c.conv_id)
+            .join(lineage_chat, lineage_chat.id == lineage.c.chat_id)
+            .where(
+                or_(
+                    lineage_chat.created_at >= older_than,
+                    exists().where(ChatMessage.chat_id == lineage_chat.id, ChatMessage.created_at >= older_than),
+                )
+            )
+        )
+
+        statement = select(cls.id).where(cls.created_at < older_than, cls.id.not_in(active))
+        if model is not None:
+            agent_chat = aliased(Chat)
+            statement = statement.where(
+                exists().where(
+                    agent_chat.id.in_([cls.agent_1_chat_id, cls.agent_2_chat_id]), agent_chat.default_model == model
+                )
+            )
+        return statement
+
+    @classmethod
+    def with_forks_statement(cls, conv_ids: Union[list[int], Select]) -> Select:
+        """Select the ids of the conversations, given as ids or a statement selecting them, and of all their forks."""
+        chat_ids = cls._chats_with_forks_statement(conv_ids)
+        return (
+            select(cls.id)
+            .where(or_(cls.agent_1_chat_id.in_(chat_ids), cls.agent_2_chat_id.in_(chat_ids)))
+            .order_by(cls.id)
+        )
+
+    @classmethod
+    def _chats_with_forks_statement(cls, conv_ids: Union[list[int], Select]) -> Select:
+        conversation = aliased(cls)
+        selected_chats = (
+            select(Chat.id)
+            .join(
+                conversation,
+                or_(conversation.agent_1_chat_id == Chat.id, conversation.agent_2_chat_id == Chat.id),
+            )
+            .where(conversation.id.in_(conv_ids))
+            .cte('chat_with_forks', recursive=True)
+        )
+        fork = aliased(Chat)
+        chats = selected_chats.union(select(fork.id).join(selected_chats, fork.parent_chat_id == selected_chats.c.id))
+        return select(chats.c.id)
+
+    @classmethod
+    def delete_many(cls, conv_ids: Union[list[int], Select]) -> list[int]:
+        """
+        Delete the conversations, given as ids or a statement selecting them, with their chats and messages in a
+        few set-based statements. Forks share the history of their parent, so they are deleted too. Returns the ids
+        of all deleted conversations.
+        """
+        deleted_chat_ids = cls._chats_with_forks_statement(conv_ids)
+
+        with transaction() as db_session:
+            deleted_conv_ids = list(db_session.scalars(cls.with_forks_statement(conv_ids)))
+            # Contents are shared between messages, the ones of the deleted messages are checked once those are gone.
+            content_ids = list(
+                db_session.scalars(
+                    select(ChatMessage.content_id).where(ChatMessage.chat_id.in_(deleted_chat_ids)).distinct()
+                )
+            )
+            # Conversations, messages and their metrics go with the chats by ON DELETE CASCADE.
+            chat_ids = list(
+                db_session.scalars(
+                    delete(Chat).where(Chat.id.in_(deleted_chat_ids)).returning(Chat.id),
+                    execution_options={'synchronize_session': False},
+                )
+            )
+            cls._delete_unused_contents(db_session, content_ids)
+            cls._expunge_deleted(db_session)
+
+        for chat_id in chat_ids:
+            ChatHistoryCache.invalidate(chat_id)
+
+        return deleted_conv_ids
+
+    @staticmethod
+    def _delete_unused_contents(db_session: Session, content_ids: list[int]) -> None:
+        """Delete the given contents that no message refers to anymore."""
+        postgres = db_session.get_bind().dialect.name == 'postgresql'
+        for start in range(0, len(content_ids), CONTENT_DELETE_BATCH_SIZE):
+            batch = content_ids[start : start + CONTENT_DELETE_BATCH_SIZE]
+            if postgres:
+                # Writers lock the contents they reuse until they commit, see MessageContent.get_or_create_many.
+                # Waiting for them here lets the check below see their messages, later ones wait for this delete.
+                # SQLite runs one writer at a time.
+                db_session.execute(
+                    select(MessageContent.id)
+                    .where(MessageContent.id.in_(batch))
+                    .order_by(MessageContent.id)
+                    .with_for_update()
+                )
+            db_session.execute(
+                delete(MessageContent).where(
+                    MessageContent.id.in_(batch), ~exists().where(ChatMessage.content_id == MessageContent.id)
+                ),
+                execution_options={'synchronize_session': False},
+            )
+
+    @staticmethod
+    def _expunge_deleted(db_session: Session) -> None:
+        """
+        Detach the instances whose rows were deleted in bulk, the session does not track those deletes. SQLite reuses
+        the ids of deleted rows, a new row would clash with the stale instance.
+        """
+        instances = defaultdict(dict)
+        for (model, primary_key, _), instance in list(db_session.identity_map.items()):
+            instances[model][primary_key[0]] = instance
+
+        for model, by_id in instances.items():
+            id_column = inspect(model).primary_key[0]
+            remaining = set(db_session.scalars(select(id_column).where(id_column.in_(list(by_id)))))
+            for instance_id, instance in by_id.items():
+                # Expunging a chat also expunges its loaded messages.
+                if instance_id not in remaining and instance in db_session:
+                    db_session.expunge(instance)
+
+    @classmethod
+    def load(cls, conv_id: int) -> Self:
+        """Get a conversation with both of its chats in a single query."""
+        results = cls.query(id=conv_id).options(joinedload(cls.agent_1_chat), joinedload(cls.agent_2_chat)).all()
+
+        assert not len(results) < 1, 'requested one, got none'
+
+        return results[0]
+
+    def get_chat(self, chat_id: int) -> Chat:
+        assert chat_id == self.agent_1_chat_id or chat_id == self.agent_2_chat_id, (
+            'must be any of the conversation chats.'
+        )
+        return self.agent_1_chat if chat_id == self.agent_1_chat_id else self.agent_2_chat
+
+    def get_messages(self, roles: list[ChatRole]) -> list[ChatMessage]:
+        """
+        Messages of both chats with the given roles in a single query, including history shared with the parent
+        conversation of a fork. `chat` of every message is set to the chat of this conversation it belongs to.
+        """
+        return self._execute_messages(self._messages_statement(roles))
+
+    def _messages_statement(self, roles: list[ChatRole]) -> Select:
+        return Chat.history_statement([self.agent_1_chat_id, self.agent_2_chat_id], roles=roles)
+
+    def _execute_messages(self, statement: Select) -> list[ChatMessage]:
+        rows = session.execute(statement)
+        messages = []
+        for message, owner_chat_id in rows:
+            set_committed_value(message, 'chat', self.get_chat(owner_chat_id))
+            messages.append(message)
+
+        return messages
+
+    def load_transcript(self) -> list[ChatMessage]:
+        """Load all displayed messages of both chats in a single query, without lazy loading their chats."""
+        return self.get_messages(roles=TRANSCRIPT_ROLES)
+
+    def iter_transcript(
+        self, after_message_id: Optional[int] = None, page_size: int = TRANSCRIPT_PAGE_SIZE
+    ) -> Iterator[ChatMessage]:
+        """
+        Yield the displayed messages after the given one, or all of them, fetching page_size rows at a time.
+        Pages continue from the (created_at, id) of the last message seen, so every page is an index range scan
+        and messages added meanwhile are picked up rather than shifting the pages.
+        """
+        while True:
+            statement = self._messages_after(self._messages_statement(TRANSCRIPT_ROLES), after_message_id)
+            messages = self._execute_messages(statement.limit(page_size))
+            yield from messages
+
+            if len(messages) < page_size:
+                return
+            after_message_id = messages[-1].id
+
+    def load_transcript_tail(self, count: int) -> list[ChatMessage]:
+        """The last `count` displayed messages, oldest first."""
+        statement = (
+            self._messages_statement(TRANSCRIPT_ROLES)
+            .order_by(None)
+            .order_by(ChatMessage.created_at.desc(), ChatMessage.id.desc())
+            .limit(count)
+        )
+        return self._execute_messages(statement)[::-1]
+
+    def load_transcript_page(self, page: int, page_size: int = TRANSCRIPT_PAGE_SIZE) -> list[ChatMessage]:
+        """
+        Displayed messages of a 1-based page, for jumping into the middle of a transcript. Only ids are counted to
+        find the last message of the previous page, the page continues from its (created_at, id) like iter_transcript.
+        """
+        assert page >= 1, 'page must be 1 or more.'
+        after_message_id = None
+        if page > 1:
+            ids = self._messages_statement(TRANSCRIPT_ROLES).with_only_columns(ChatMessage.id)
+            after_message_id = session.scalar(ids.offset((page - 1) * page_size - 1).limit(1))
+            if after_message_id is None:
+                return []
+
+        statement = self._messages_after(self._messages_statement(TRANSCRIPT_ROLES), after_message_id)
+        return self._execute_messages(statement.limit(page_size))
+
+    @staticmethod
+    def _messages_after(statement: Select, after_message_id: Optional[int]) -> Select:
+        """Limit the messages to those ordered after the given one, all of them if None."""
+        if after_message_id is None:
+            return statement
+
+        # Compared to the stored row, SQLite keeps created_at as text that a bound datetime does not match.
+        after_message = aliased(ChatMessage)
+        return statement.join(after_message, after_message.id == after_message_id).filter(
+            or_(
+                ChatMessage.created_at > after_message.created_at,
+                and_(ChatMessage.created_at == after_message.created_at, ChatMessage.id > after_message.id),
+            )
+        )
 
     @property
     def merged_chat_history(self) -> list[ChatMessage]:
-        message = ChatMessage.get_multiple(
-            chat_id=[self.agent_1_chat_id, self.agent_2_chat_id], role=[ChatRole.ASSISTANT, ChatRole.SYSTEM]
-        )
-        return message
+        return self.load_transcript()
+
+    def get_turn_order(self) -> tuple[Chat, Chat]:
+        """Figure out whos turn it is to answer, returns the sender and responder chats."""
+        messages = self.get_messages(roles=[ChatRole.ASSISTANT])
+
+        # The agent that answered last is the responder of the next turn.
+        if messages and messages[-1].chat is self.agent_1_chat:
+            return self.agent_2_chat, self.agent_1_chat
+
+        return self.agent_1_chat, self.agent_2_chat
+
+    def fork(self, at_message_id: int) -> Self:
+        """
+        Branch the conversation right after a message of its transcript. The chats of the new conversation
+        reference the history of this one up to that message instead of copying it.
+        """
+        at_message = next((m for m in self.load_transcript() if m.id == at_message_id), None)
+        assert at_message, f'message {at_message_id} is not part of conversation {self.id}.'
+
+        with transaction():
+            forked_chats = Chat.save_all(
+                [
+                    Chat.fork(chat, self._get_fork_point(chat, at_message))
+                    for chat in (self.agent_1_chat, self.agent_2_chat)
+                ]
+            )
+            # Forks get the budgets of the conversation, and start using them from zero.
+            return Conversation(
+                agent_1_chat_id=forked_chats[0].id,
+                agent_2_chat_id=forked_chats[1].id,
+                max_turns=self.max_turns,
+                max_generated_tokens=self.max_generated_tokens,
+                max_wall_seconds=self.max_wall_seconds,
+            ).save()
+
+    @staticmethod
+    def _get_fork_point(chat: Chat, at_message: ChatMessage) -> int:
+        """Id of the last message of the chat's history that belongs before the fork."""
+        if at_message.chat is chat:
+            return at_message.id
+
+        position = (at_message.created_at, at_message.id)
+        history = chat.get_chat_history()
+        if at_message.role == ChatRole.ASSISTANT:
+            # A response is also stored as a user message of the other agent, in the same transaction.
+            reply = next(
+                (
+                    m
+                    for m in history
+                    if (m.created_at, m.id) > position
+                    and m.role == ChatRole.USER
+                    and m.content_id == at_message.content_id
+                ),
+                None,
+            )
+            if reply:
+                return reply.id
+
+        earlier = [m for m in history if (m.created_at, m.id) <= position]
+        if earlier:
+            return earlier[-1].id
+
+        # Forked before the chat's first message, like at the other agent's system prompt. The fork keeps the first
+        # message, the system prompt the agent needs to take part at all.
+        assert history, f'chat {chat.id} has no messages to fork after.'
+        return history[0].id
 
     def generate_chat_bubble(self, chat_message: ChatMessage) -> Align:
-        assert chat_message.chat_id == self.agent_1_chat_id or chat_message.chat_id == self.agent_2_chat_id, (
+        # For messages shared with a parent conversation, chat is the chat of this conversation (see get_messages).
+        chat = chat_message.chat
+        assert chat.id == self.agent_1_chat_id or chat.id == self.agent_2_chat_id, (
             'must be a message from any of the conversation chats.'
         )
 
-        chat_bubble = self.generate_empty_chat_bubble(chat_message.chat)
+        chat_bubble = self.generate_empty_chat_bubble(chat)
         panel = chat_bubble.renderable
+        # Shown so messages can be referred to, like with fork-conversation --at-message.
+        panel.subtitle = f'#{chat_message.id}'
+        panel.subtitle_align = panel.title_align
 
         if chat_message.role == ChatRole.SYSTEM:
             color = TextColor.SYSTEM_COLOR
             panel.border_style = color.value
-            if chat_message.chat_id == self.agent_1_chat_id:
+            if chat.id == self.agent_1_chat_id:
                 panel.title = 'Agent 1 (SYSTEM)'
             else:
                 panel.title = 'Agent 2 (SYSTEM)'
@@ -0,0 +1,100 @@
+import hashlib
+
+from sqlalchemy import Column, Connection, String, event, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from .base import BaseModel
+
+
+class MessageContent(BaseModel):
+    __tablename__ = 'message_content'
+
+    hash = Column(String(64), nullable=False, unique=True)
+    content = Column(String(), nullable=False)
+
+    def __init__(self, content: str) -> None:
+        super().__init__()
+        self.content = content
+        self.hash = self.compute_hash(content)
+
+    @staticmethod
+    def compute_hash(content: str) -> str:
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_or_create_many(cls, db_session: Session, contents: list[str]) -> dict[str, 'MessageContent']:
+        """Map each content hash to its stored MessageContent, inserting the missing ones in the session's transaction."""
+        hashes = {cls.compute_hash(content): content for content in contents}
+        insert = postgresql.insert if db_session.get_bind().dialect.name == 'postgresql' else sqlite.insert
+
+        by_hash = {}
+        while len(by_hash) < len(hashes):
+            missing = {content_hash: content for content_hash, content in hashes.items() if content_hash not in by_hash}
+            # Another writer may store the same content in the meantime, skip its rows instead of failing on them.
+            # A failed statement would leave its cursor to the garbage collector, on whichever thread that runs.
+            db_session.execute(
+                insert(cls).on_conflict_do_nothing(index_elements=[cls.hash]),
+                [{'hash': content_hash, 'content': content} for content_hash, content in missing.items()],
+            )
+            # Locked until commit, so deleting unused contents waits for the messages about to use them, see
+            # Conversation.delete_many. On SQLite the insert already took the write lock. A content that was deleted
+            # between the two statements is inserted again.
+            stored = db_session.query(cls).filter(cls.hash.in_(list(missing))).with_for_update(key_share=True).all()
+            by_hash.update((message_content.hash, message_content) for message_content in stored)
+
+        return by_hash
+
+
+# Full-text search index on message bodies, maintained by the database on every insert. Postgres keeps a generated
+# tsvector column with a GIN index, SQLite an external content FTS5 table kept in sync by triggers. See search.
+SEARCH_LANGUAGE = 'english'
+SQLITE_FTS_TABLE = 'message_content_fts'
+
+
+def create_search_index(connection: Connection) -> None:
+    if connection.dialect.name == 'postgresql':
+        connection.execute(
+            text(
+                'ALTER TABLE message_content ADD COLUMN IF NOT EXISTS search_vector tsvector '
+                f"GENERATED ALWAYS AS (to_tsvector('{SEARCH_LANGUAGE}', content)) STORED"
+            )
+        )
+        connection.execute(
+            text(
+                'CREATE INDEX IF NOT EXISTS ix_message_content_search_vector '
+                'ON message_content USING GIN (search_vector)'
+            )
+        )
+    elif connection.dialect.name == 'sqlite':
+        connection.execute(
+            text(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {SQLITE_FTS_TABLE} '
+                "USING fts5(content, content='message_content', content_rowid='id')"
+            )
+        )
+        insert = 'INSERT INTO {fts}(rowid, content) VALUES (new.id, new.content);'
+        delete = "INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.id, old.content);"
+        for name, event_name, statements in (
+            ('message_content_ai', 'INSERT', insert),
+            ('message_content_ad', 'DELETE', delete),
+            ('message_content_au', 'UPDATE', delete + insert),
+        ):
+            connection.execute(
+                text(
+                    f'CREATE TRIGGER IF NOT EXISTS {name} AFTER {event_name} ON message_content '
+                    f'BEGIN {statements.format(fts=SQLITE_FTS_TABLE)} END'
+                )
+            )
+        # Index the rows that were there before the table existed.
+        connection.execute(text(f"INSERT INTO {SQLITE_FTS_TABLE}({SQLITE_FTS_TABLE}) VALUES ('rebuild')"))
+
+
+def drop_search_index(connection: Connection) -> None:
+    # The Postgres column and index go with the table, the SQLite FTS table is separate.
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text(f'DROP TABLE IF EXISTS {SQLITE_FTS_TABLE}'))
+
+
+event.listen(MessageContent.__table__, 'after_create', lambda target, connection, **kw: create_search_index(connection))
+event.listen(MessageContent.__table__, 'before_drop', lambda target, connection, **kw: drop_search_index(connection))
@@ -0,0 +1,139 @@
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import ColumnElement, Select, and_, case, column, func, literal, literal_column, or_, select, table
+from sqlalchemy.orm import aliased
+
+from database.db import session
+from enums.enums import ChatRole
+
+from .chat_message import ChatMessage
+from .conversation import Conversation
+from .message_content import SEARCH_LANGUAGE, SQLITE_FTS_TABLE, MessageContent
+
+HIGHLIGHT_START = '**'
+HIGHLIGHT_STOP = '**'
+SNIPPET_WORDS = 20
+
+
+@dataclass
+class SearchResult:
+    conv_id: int
+    agent: int
+    # Number of responses in the conversation up to and including this message.
+    turn: int
+    chat_message_id: int
+    role: ChatRole
+    created_at: datetime
+    snippet: str
+    rank: float
+
+
+def search_messages(query: str, limit: int = 20, conv_id: Optional[int] = None) -> list[SearchResult]:
+    """Messages of all conversation transcripts matching the query, best matches first. A blank query matches none."""
+    if not query.split():
+        return []
+
+    statement = _search_statement(session.get_bind().dialect.name, query)
+
+    turn_message = aliased(ChatMessage)
+    turn = (
+        select(func.count(turn_message.id))
+        .where(
+            turn_message.chat_id.in_([Conversation.agent_1_chat_id, Conversation.agent_2_chat_id]),
+            turn_message.role == ChatRole.ASSISTANT,
+            or_(
+                turn_message.created_at < ChatMessage.created_at,
+                and_(turn_message.created_at == ChatMessage.created_at, turn_message.id <= ChatMessage.id),
+            ),
+        )
+        .scalar_subquery()
+    )
+    statement = (
+        statement.add_columns(
+            Conversation.id,
+            case((ChatMessage.chat_id == Conversation.agent_1_chat_id, 1), else_=2),
+            turn,
+            ChatMessage.id,
+            ChatMessage.role,
+            ChatMessage.created_at,
+        )
+        .join(ChatMessage, ChatMessage.content_id == MessageContent.id)
+        # Messages shared with a fork are found once, in the conversation they were written in.
+        .join(
+            Conversation,
+            or_(
+                Conversation.agent_1_chat_id == ChatMessage.chat_id, Conversation.agent_2_chat_id == ChatMessage.chat_id
+            ),
+        )
+        # Responses are also stored as user messages of the other agent, only show them once.
+        .where(ChatMessage.role.in_([ChatRole.ASSISTANT, ChatRole.SYSTEM]))
+        .limit(limit)
+    )
+    if conv_id is not None:
+        statement = statement.where(Conversation.id == conv_id)
+
+    return [
+        SearchResult(
+            conv_id=row_conv_id,
+            agent=agent,
+            turn=row_turn,
+            chat_message_id=chat_message_id,
+            role=role,
+            created_at=created_at,
+            snippet=snippet,
+            rank=rank,
+        )
+        for rank, snippet, row_conv_id, agent, row_turn, chat_message_id, role, created_at in session.execute(statement)
+    ]
+
+
+def _search_statement(dialect: str, query: str) -> Select:
+    """Select (rank, snippet) of matching contents ordered by rank, the rest of the search joins onto it."""
+    if dialect == 'postgresql':
+        ts_query = func.websearch_to_tsquery(SEARCH_LANGUAGE, query)
+        search_vector = literal_column('message_content.search_vector')
+        rank = func.ts_rank(search_vector, ts_query)
+        snippet = func.ts_headline(
+            SEARCH_LANGUAGE,
+            MessageContent.content,
+            ts_query,
+            f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_STOP}, MaxWords={SNIPPET_WORDS}, MinWords=5',
+        )
+        match: ColumnElement = search_vector.op('@@')(ts_query)
+        return (
+            select(rank.label('rank'), snippet.label('snippet'))
+            .select_from(MessageContent)
+            .where(match)
+            .order_by(rank.desc(), MessageContent.id)
+        )
+
+    if dialect == 'sqlite':
+        fts_table = table(SQLITE_FTS_TABLE, column('rowid'))
+        # The FTS5 functions take the table itself as their first argument.
+        fts = literal_column(SQLITE_FTS_TABLE)
+        # bm25 is lower for better matches.
+        rank = -func.bm25(fts)
+        snippet = func.snippet(fts, 0, HIGHLIGHT_START, HIGHLIGHT_STOP, '…', SNIPPET_WORDS)
+        return (
+            select(rank.label('rank'), snippet.label('snippet'))
+            .select_from(MessageContent)
+            .join(fts_table, fts_table.c.rowid == MessageContent.id)
+            .where(fts.op('MATCH')(_to_fts5_query(query)))
+            .order_by(func.bm25(fts), MessageContent.id)
+        )
+
+    # Without a full-text index, a slow scan is better than no search at all. Wildcards in the query match literally.
+    pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return (
+        select(literal(0.0).label('rank'), func.substr(MessageContent.content, 1, 200).label('snippet'))
+        .select_from(MessageContent)
+        .where(MessageContent.content.ilike(f'%{pattern}%', escape='\\'))
+        .order_by(MessageContent.id)
+    )
+
+
+def _to_fts5_query(query: str) -> str:
+    """Match all words of the query, quoted so FTS5 operators and punctuation in it are taken literally."""
+    return ' '.join('"{}"'.format(word.replace('"', '""')) for word in query.split())
@@ -0,0 +1,15 @@
+from sqlalchemy import Column, Integer, String
+
+from .base import BaseModel
+
+
+class SchemaMigration(BaseModel):
+    __tablename__ = 'schema_migration'
+
+    version = Column(Integer, nullable=False, unique=True)
+    description = Column(String(), nullable=False)
+
+    def __init__(self, version: int, description: str) -> None:
+        super().__init__()
+        self.version = version
+        self.description = description
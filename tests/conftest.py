@@ -0,0 +1,32 @@
+import os
+import tempfile
+
+import pytest
+
+# The engines are created on first use, point them at a throwaway SQLite database before any test gets there.
+TEST_DIRECTORY = tempfile.mkdtemp(prefix='llm-talks-tests-')
+os.environ['LLM_TALKS_CONFIG'] = os.path.join(TEST_DIRECTORY, 'config.json')
+os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(TEST_DIRECTORY, "test.db")}'
+os.environ.pop('ASYNC_DATABASE_URL', None)
+
+
+@pytest.fixture
+def empty_db():
+    """A database without any tables, everything is dropped again after the test."""
+    from database.clean_db import clean_db
+    from database.db import session
+    from models.chat_history_cache import ChatHistoryCache
+
+    clean_db()
+    yield
+    session.remove()
+    ChatHistoryCache.clear()
+    clean_db()
+
+
+@pytest.fixture
+def db(empty_db):
+    """A database created from the current models."""
+    from database.init_db import init_db
+
+    init_db()
@@ -0,0 +1,98 @@
+import io
+import json
+
+import pytest
+from sqlalchemy import func, select
+
+from cli.archive import export_conversations, import_conversations
+from database.db import session
+from enums.enums import ChatRole
+from models.chat import Chat
+from models.chat_message import ChatMessage
+from models.conversation import Conversation
+
+
+def add_turn(conversation: Conversation, content: str) -> int:
+    """Save a turn like AsyncOllamaManager.save_turn does, returns the id of the response."""
+    sender, responder = conversation.get_turn_order()
+    response, _ = ChatMessage.save_all(
+        [
+            ChatMessage(chat_id=sender.id, role=ChatRole.ASSISTANT, model=sender.default_model, content=content),
+            ChatMessage(chat_id=responder.id, role=ChatRole.USER, model=sender.default_model, content=content),
+        ]
+    )
+    return response.id
+
+
+def create_forked_conversation() -> tuple[Conversation, Conversation]:
+    agent_1_chat = Chat.set_up_agent('model-1', 'agent 1')
+    agent_2_chat = Chat.set_up_agent('model-2', 'agent 2')
+    conversation = Conversation(agent_1_chat.id, agent_2_chat.id, max_turns=10).save()
+    add_turn(conversation, 'hello')
+    fork_point = add_turn(Conversation.load(conversation.id), 'general kenobi')
+    add_turn(Conversation.load(conversation.id), 'only in the parent')
+
+    fork = conversation.fork(fork_point)
+    add_turn(Conversation.load(fork.id), 'only in the fork')
+    return Conversation.load(conversation.id), Conversation.load(fork.id)
+
+
+def export(conv_ids=None) -> list[str]:
+    output = io.StringIO()
+    export_conversations(output, conv_ids=conv_ids)
+    return output.getvalue().splitlines(keepends=True)
+
+
+def transcript(conv_id: int) -> list[tuple[str, str]]:
+    return [(message.role.value, message.content) for message in Conversation.load(conv_id).load_transcript()]
+
+
+def latest_conv_ids(count: int) -> list[int]:
+    return sorted(session.scalars(select(Conversation.id).order_by(Conversation.id.desc()).limit(count)))
+
+
+def test_export_and_import_keep_forks(db):
+    conversation, fork = create_forked_conversation()
+
+    counts = import_conversations(export())
+
+    assert counts == {'conversation': 2, 'chat': 4, 'chat_message': 12}
+    imported, imported_fork = (Conversation.load(conv_id) for conv_id in latest_conv_ids(2))
+    assert transcript(imported.id) == transcript(conversation.id)
+    assert transcript(imported_fork.id) == transcript(fork.id)
+    assert ('assistant', 'only in the parent') not in transcript(imported_fork.id)
+    assert imported.max_turns == 10
+
+    # The forks point at the imported chats and messages, not at the exported ids.
+    assert imported_fork.agent_1_chat.parent_chat_id == imported.agent_1_chat_id
+    fork_point = session.get(ChatMessage, imported_fork.agent_1_chat.parent_message_id)
+    assert fork_point.chat_id == imported.agent_1_chat_id
+    assert fork_point.content == 'general kenobi'
+
+
+def test_exporting_a_fork_takes_the_chats_it_was_forked_from(db):
+    _, fork = create_forked_conversation()
+
+    counts = import_conversations(export([fork.id]))
+
+    assert counts == {'conversation': 1, 'chat': 4, 'chat_message': 12}
+    (imported_fork,) = latest_conv_ids(1)
+    assert transcript(imported_fork) == transcript(fork.id)
+
+
+def test_import_rejects_forks_without_their_parent(db):
+    conversation, fork = create_forked_conversation()
+    parent_chat_ids = {conversation.agent_1_chat_id, conversation.agent_2_chat_id}
+
+    def of_parent(record: dict) -> bool:
+        return (record['type'] == 'chat' and record['id'] in parent_chat_ids) or record.get(
+            'chat_id'
+        ) in parent_chat_ids
+
+    lines = [line for line in export([fork.id]) if not of_parent(json.loads(line))]
+    conversation_count = session.scalar(select(func.count()).select_from(Conversation))
+
+    with pytest.raises(AssertionError, match='not in the archive'):
+        import_conversations(lines)
+
+    assert session.scalar(select(func.count()).select_from(Conversation)) == conversation_count
@@ -0,0 +1,89 @@
+import contextlib
+import io
+
+import pytest
+from click.testing import CliRunner
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from cli.batch import run_batch
+from cli.cli import cli
+from enums.enums import ChatRole
+from integrations.ollama_manager import AsyncOllamaManager, OllamaManager
+from models.chat import Chat
+from models.conversation import Conversation
+
+TOKENS_PER_RESPONSE = 8
+
+
+@pytest.fixture
+def ollama_server():
+    with FakeOllamaServer(models=['model-1', 'model-2'], tokens_per_response=TOKENS_PER_RESPONSE) as server:
+        OllamaManager._async_manager = AsyncOllamaManager(host=server.url)
+        yield server
+    OllamaManager._async_manager = None
+
+
+def create_conversation(**budgets) -> int:
+    agent_1_chat = Chat.set_up_agent('model-1', 'agent 1')
+    agent_2_chat = Chat.set_up_agent('model-2', 'agent 2')
+    return Conversation(agent_1_chat.id, agent_2_chat.id, **budgets).save().id
+
+
+def run(conv_id: int, max_turns: int = 10) -> None:
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert run_batch([conv_id], max_turns=max_turns, concurrency=1) == {conv_id: True}
+
+
+@pytest.mark.parametrize(
+    'budgets, turns',
+    [
+        ({'max_turns': 3}, 3),
+        ({'max_generated_tokens': 2 * TOKENS_PER_RESPONSE + 1}, 3),
+        # Any turn takes longer than that, the first one uses it up.
+        ({'max_wall_seconds': 1e-6}, 1),
+        ({'max_turns': 0}, 0),
+        # The first budget used up stops the run, however much of the others is left.
+        ({'max_turns': 5, 'max_generated_tokens': TOKENS_PER_RESPONSE, 'max_wall_seconds': 3600}, 1),
+    ],
+)
+def test_run_conversation_stops_when_a_budget_is_used_up(db, ollama_server, budgets, turns):
+    conv_id = create_conversation(**budgets)
+
+    result = CliRunner().invoke(
+        cli, ['run-conversation', '--conv_id', str(conv_id), '--interactive', 'False', '--no-render', '--tail', '0']
+    )
+
+    assert '⏹️ The conversation used up its budget of' in result.output, result.output
+    conversation = Conversation.load(conv_id)
+    assert conversation.turn_count == turns
+    assert conversation.generated_token_count == turns * TOKENS_PER_RESPONSE
+    assert (conversation.wall_seconds > 0) == (turns > 0)
+
+
+def test_budget_holds_across_runs(db, ollama_server):
+    conv_id = create_conversation(max_turns=5)
+
+    run(conv_id, max_turns=2)
+    resumed = Conversation.load(conv_id)
+    # A resumed conversation continues from the counters of the runs before.
+    assert (resumed.turn_count, resumed.generated_token_count) == (2, 2 * TOKENS_PER_RESPONSE)
+    wall_seconds = resumed.wall_seconds
+    assert wall_seconds > 0
+
+    run(conv_id, max_turns=2)
+    run(conv_id, max_turns=2)
+    run(conv_id, max_turns=2)
+
+    conversation = Conversation.load(conv_id)
+    assert (conversation.turn_count, conversation.generated_token_count) == (5, 5 * TOKENS_PER_RESPONSE)
+    assert conversation.wall_seconds > wall_seconds
+    assert len(conversation.get_messages(roles=[ChatRole.ASSISTANT])) == 5
+
+
+def test_set_budget_shows_a_budget_of_zero(db):
+    conv_id = create_conversation()
+
+    result = CliRunner().invoke(cli, ['set-budget', '--conv_id', str(conv_id), '--max_turns', '0'])
+
+    assert 'used 0 of 0 turns, 0 of unlimited tokens' in result.output, result.output
+    assert Conversation.load(conv_id).get_exhausted_budget() == 'turns (0 of 0)'
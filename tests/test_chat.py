@@ -0,0 +1,100 @@
+from sqlalchemy import delete
+
+from database.db import session
+from enums.enums import ChatRole
+from models.chat import Chat
+from models.chat_history_cache import ChatHistoryCache
+from models.chat_message import ChatMessage
+from models.conversation import Conversation
+
+
+def add_messages(chat: Chat, *contents: str) -> list[int]:
+    messages = ChatMessage.save_all([ChatMessage(chat_id=chat.id, role=ChatRole.USER, content=c) for c in contents])
+    return [message.id for message in messages]
+
+
+def history(chat: Chat) -> list[str]:
+    return [message.content for message in chat.get_chat_history()]
+
+
+def test_fork_history_follows_the_fork_points(db):
+    root = Chat(default_model='model-1').save()
+    r1, r2, _ = add_messages(root, 'r1', 'r2', 'r3')
+
+    fork = Chat.fork(root, r2).save()
+    f1, _ = add_messages(fork, 'f1', 'f2')
+    # Written to the parent after the fork, not part of the fork's history.
+    add_messages(root, 'r4')
+
+    fork_of_fork = Chat.fork(fork, f1).save()
+    add_messages(fork_of_fork, 'g1')
+    # Forked at a message the fork inherited, the older bound applies to the root.
+    fork_at_inherited = Chat.fork(fork, r1).save()
+    add_messages(fork_at_inherited, 'h1')
+
+    assert history(root) == ['r1', 'r2', 'r3', 'r4']
+    assert history(fork) == ['r1', 'r2', 'f1', 'f2']
+    assert history(fork_of_fork) == ['r1', 'r2', 'f1', 'g1']
+    assert history(fork_at_inherited) == ['r1', 'h1']
+
+
+def test_history_of_several_chats_at_once(db):
+    root = Chat(default_model='model-1').save()
+    ChatMessage(chat_id=root.id, role=ChatRole.SYSTEM, content='system').save()
+    (r1,) = add_messages(root, 'r1')
+    fork = Chat.fork(root, r1).save()
+    add_messages(fork, 'f1')
+    add_messages(root, 'r2')
+
+    rows = session.execute(Chat.history_statement([root.id, fork.id])).all()
+    by_chat = {root.id: [], fork.id: []}
+    for message, chat_id in rows:
+        by_chat[chat_id].append(message.content)
+    # Shared messages are returned once for every chat they belong to.
+    assert by_chat == {root.id: ['system', 'r1', 'r2'], fork.id: ['system', 'r1', 'f1']}
+
+    statement = Chat.history_statement([fork.id], roles=[ChatRole.SYSTEM])
+    assert [message.content for message in session.scalars(statement)] == ['system']
+
+
+def test_history_cache_keeps_the_recently_used_chats(monkeypatch):
+    monkeypatch.setattr(ChatHistoryCache, 'MAX_CHATS', 2)
+    ChatHistoryCache.clear()
+
+    ChatHistoryCache.set(1, [{'role': 'user', 'content': '1'}])
+    ChatHistoryCache.set(2, [{'role': 'user', 'content': '2'}])
+    ChatHistoryCache.get(1)
+    ChatHistoryCache.set(3, [{'role': 'user', 'content': '3'}])
+
+    # The least recently used chat makes room, its history is loaded again on next access.
+    assert ChatHistoryCache.get(2) is None
+    assert ChatHistoryCache.get(1) == [{'role': 'user', 'content': '1'}]
+    assert ChatHistoryCache.get(3) == [{'role': 'user', 'content': '3'}]
+    ChatHistoryCache.clear()
+
+
+def test_cached_history_is_dropped_with_the_chat(db):
+    chats = [Chat.set_up_agent('model-1', 'agent 1'), Chat.set_up_agent('model-2', 'agent 2')]
+    conversation = Conversation(chats[0].id, chats[1].id).save()
+    for chat in chats:
+        chat.get_chat_history_as_dict()
+
+    Conversation.delete_many([conversation.id])
+
+    assert [ChatHistoryCache.get(chat.id) for chat in chats] == [None, None]
+
+
+def test_new_chats_do_not_reuse_a_cached_history(db):
+    root = Chat.set_up_agent('model-1', 'agent 1')
+    (r1,) = add_messages(root, 'r1')
+    chat = Chat.set_up_agent('model-2', 'agent 2')
+    chat_id = chat.id
+    chat.get_chat_history_as_dict()
+    # Deleted without going through the models, like by another process. SQLite hands out the id again.
+    session.execute(delete(Chat).where(Chat.id == chat_id))
+    session.commit()
+
+    fork = Chat.fork(root, r1).save()
+
+    assert fork.id == chat_id
+    assert [message['content'] for message in fork.get_chat_history_as_dict()] == ['agent 1', '', 'r1']
@@ -0,0 +1,84 @@
+import ollama
+import pytest
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from database.db import session
+from integrations.context_window import ContextWindow, estimate_tokens
+from integrations.event_loop import BackgroundEventLoop
+from models.chat import Chat
+
+SYSTEM_PROMPT = {'role': 'system', 'content': 'You are agent 1.'}
+# Every message is about 100 tokens, ten of them do not fit the budget.
+BUDGET = 500
+
+
+@pytest.fixture
+def ollama_server():
+    with FakeOllamaServer(models=['model-1']) as server:
+        yield server
+
+
+def message(index: int) -> dict[str, str]:
+    role = 'assistant' if index % 2 else 'user'
+    return {'role': role, 'content': f'message {index} '.ljust(400, '.')}
+
+
+def build(server: FakeOllamaServer, chat: Chat, history: list[dict[str, str]]) -> list[dict[str, str]]:
+    window = ContextWindow(ollama.AsyncClient(host=server.url))
+    return BackgroundEventLoop.run(window.build(chat, history))
+
+
+def summary_requests(server: FakeOllamaServer) -> list[dict]:
+    return [body for path, body in server.requests if path == '/api/chat']
+
+
+def stored_chat(chat_id: int) -> Chat:
+    session.expire_all()
+    return session.get(Chat, chat_id)
+
+
+def test_history_within_budget_is_sent_as_is(db, ollama_server):
+    chat = Chat.set_up_agent('model-1', SYSTEM_PROMPT['content'], context_token_budget=BUDGET)
+    history = [SYSTEM_PROMPT, *(message(i) for i in range(4))]
+
+    assert build(ollama_server, chat, history) == history
+    assert summary_requests(ollama_server) == []
+
+
+def test_old_turns_are_folded_into_a_stored_summary(db, ollama_server):
+    chat = Chat.set_up_agent('model-1', SYSTEM_PROMPT['content'], context_token_budget=BUDGET)
+    history = [SYSTEM_PROMPT, *(message(i) for i in range(10))]
+    assert estimate_tokens(history) > BUDGET
+
+    context = build(ollama_server, chat, history)
+
+    # The system prompt and the recent turns stay verbatim, the turns before them are summarized once.
+    (request,) = summary_requests(ollama_server)
+    summary = stored_chat(chat.id).context_summary
+    assert summary
+    assert context == [
+        SYSTEM_PROMPT,
+        {'role': 'system', 'content': f'Summary of the conversation so far: {summary}'},
+        message(8),
+        message(9),
+    ]
+    assert estimate_tokens(context) <= BUDGET
+    assert stored_chat(chat.id).context_summary_message_count == 8
+    assert 'message 7 ' in request['messages'][-1]['content']
+    assert 'message 8 ' not in request['messages'][-1]['content']
+
+    # A new turn that still fits next to the stored summary reuses it.
+    history.append(message(10))
+    assert build(ollama_server, stored_chat(chat.id), history) == [*context, message(10)]
+    assert len(summary_requests(ollama_server)) == 1
+
+    # Once it no longer fits, only the newly folded turns are summarized, continuing the stored summary.
+    history += [message(i) for i in range(11, 15)]
+    context = build(ollama_server, stored_chat(chat.id), history)
+    requests = summary_requests(ollama_server)
+    assert len(requests) == 2
+    assert requests[1]['messages'][-1]['content'].startswith(f'Summary so far: {summary}')
+    assert 'message 7 ' not in requests[1]['messages'][-1]['content']
+    assert stored_chat(chat.id).context_summary_message_count == 13
+    assert context[0] == SYSTEM_PROMPT
+    assert context[2:] == [message(13), message(14)]
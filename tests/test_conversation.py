@@ -0,0 +1,169 @@
+import warnings
+from datetime import datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import select, update
+
+from database.db import session
+
+from enums.enums import ChatRole
+from models.chat import Chat
+from models.chat_message import ChatMessage
+from models.conversation import Conversation
+from models.message_content import MessageContent
+
+# After the system messages, which are created now.
+START = datetime(2100, 1, 1)
+
+
+def create_conversation() -> Conversation:
+    agent_1_chat = Chat.set_up_agent('model-1', 'agent 1')
+    agent_2_chat = Chat.set_up_agent('model-2', 'agent 2')
+    return Conversation(agent_1_chat.id, agent_2_chat.id).save()
+
+
+def add_turn(sender: Chat, responder: Chat, content: str, created_at: datetime) -> ChatMessage:
+    """Save a turn like AsyncOllamaManager.save_turn does, both rows share the given created_at."""
+    response, reply = (
+        ChatMessage(chat_id=chat.id, role=role, model=chat.default_model, content=content)
+        for chat, role in ((sender, ChatRole.ASSISTANT), (responder, ChatRole.USER))
+    )
+    response.created_at = reply.created_at = created_at
+    ChatMessage.save_all([response, reply])
+    return response
+
+
+def create_transcript(conversation: Conversation) -> list[str]:
+    """
+    Add turns with created_at ties across the page boundaries, and a turn whose id is lower than those it is ordered
+    after. Returns the transcript in order.
+    """
+    chats = conversation.get_turn_order()
+    timestamps = [START + timedelta(seconds=second) for second in (1, 1, 1, 2, 2, 4, 5, 5, 5)]
+    for turn, created_at in enumerate(timestamps):
+        add_turn(chats[turn % 2], chats[(turn + 1) % 2], f'turn {turn}', created_at)
+    add_turn(chats[1], chats[0], 'late id', START + timedelta(seconds=3))
+
+    return [
+        'agent 1',
+        'agent 2',
+        *[f'turn {turn}' for turn in range(5)],
+        'late id',
+        *[f'turn {t}' for t in (5, 6, 7, 8)],
+    ]
+
+
+def contents(messages) -> list[str]:
+    return [message.content for message in messages]
+
+
+def test_transcript_pages_follow_the_order(db):
+    conversation = create_conversation()
+    transcript = create_transcript(conversation)
+    conversation = Conversation.load(conversation.id)
+
+    assert contents(conversation.load_transcript()) == transcript
+    for page_size in (1, 2, 3, 5, len(transcript), len(transcript) + 1):
+        pages = [conversation.load_transcript_page(page, page_size=page_size) for page in range(1, 20)]
+        assert [contents(page) for page in pages if page] == [
+            transcript[start : start + page_size] for start in range(0, len(transcript), page_size)
+        ]
+        assert contents(conversation.iter_transcript(page_size=page_size)) == transcript
+
+    assert conversation.load_transcript_page(4, page_size=5) == []
+    assert contents(conversation.load_transcript_tail(3)) == transcript[-3:]
+
+
+def test_iter_transcript_continues_after_a_message(db):
+    conversation = create_conversation()
+    transcript = create_transcript(conversation)
+    conversation = Conversation.load(conversation.id)
+    messages = conversation.load_transcript()
+
+    for index, message in enumerate(messages):
+        assert (
+            contents(conversation.iter_transcript(after_message_id=message.id, page_size=2)) == transcript[index + 1 :]
+        )
+
+    # Messages added after the last page was read are picked up by the next read, ties included.
+    chats = conversation.get_turn_order()
+    add_turn(chats[0], chats[1], 'turn 9', START + timedelta(seconds=5))
+    assert contents(conversation.iter_transcript(after_message_id=messages[-1].id)) == ['turn 9']
+
+
+def test_conversations_with_a_fork_in_use_are_not_stale(db):
+    cutoff, recent = datetime(2200, 1, 1), datetime(2300, 1, 1)
+
+    def create_forked(*, fork_of_fork_message_at: Optional[datetime] = None) -> list[int]:
+        """A conversation with a turn, a fork of it, and a fork of that fork, optionally with a message."""
+        conversation = create_conversation()
+        sender, responder = conversation.get_turn_order()
+        fork = conversation.fork(add_turn(sender, responder, 'hello', START).id)
+        fork_of_fork = fork.fork(fork.load_transcript()[-1].id)
+        if fork_of_fork_message_at:
+            add_turn(*fork_of_fork.get_turn_order(), 'still here', fork_of_fork_message_at)
+        return [conversation.id, fork.id, fork_of_fork.id]
+
+    in_use = create_forked(fork_of_fork_message_at=recent)
+    unused = create_forked()
+    just_forked = create_forked()
+    # A fork that was created after the cutoff but has no messages yet is in use as well.
+    session.execute(
+        update(Chat).where(Chat.id == Conversation.load(just_forked[2]).agent_1_chat_id).values(created_at=recent)
+    )
+    session.commit()
+
+    stale = Conversation.stale_statement(cutoff)
+    assert list(session.scalars(stale.order_by(Conversation.id))) == unused
+    assert list(session.scalars(Conversation.with_forks_statement(stale))) == unused
+    # Only the forks of a conversation go with it, not its parent.
+    assert list(session.scalars(Conversation.with_forks_statement([in_use[1]]))) == in_use[1:]
+
+    assert Conversation.delete_many(stale) == unused
+    assert list(session.scalars(select(Conversation.id).order_by(Conversation.id))) == in_use + just_forked
+    assert contents(Conversation.load(in_use[2]).load_transcript()) == ['agent 1', 'agent 2', 'hello', 'still here']
+
+
+def test_deleting_keeps_contents_still_in_use(db):
+    kept, removed = create_conversation(), create_conversation()
+    add_turn(*kept.get_turn_order(), 'shared', START)
+    add_turn(*removed.get_turn_order(), 'shared', START)
+    add_turn(*removed.get_turn_order(), 'only removed', START)
+
+    stored = set(session.scalars(select(MessageContent.content)))
+
+    assert Conversation.delete_many([removed.id]) == [removed.id]
+    assert set(session.scalars(select(MessageContent.content))) == stored - {'only removed'}
+    assert contents(Conversation.load(kept.id).load_transcript()) == ['agent 1', 'agent 2', 'shared']
+
+
+def test_deleted_instances_leave_the_session(db):
+    removed = create_conversation()
+    removed_chats = removed.get_turn_order()
+    add_turn(*removed_chats, 'hello', START)
+    Conversation.delete_many([removed.id])
+
+    assert removed not in session and not any(chat in session for chat in removed_chats)
+    # SQLite hands out the ids of the deleted rows again, the new instances must not clash with the old ones.
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        created = create_conversation()
+        add_turn(*created.get_turn_order(), 'hello again', START)
+    assert contents(Conversation.load(created.id).load_transcript()) == ['agent 1', 'agent 2', 'hello again']
+
+
+def test_fork_at_the_first_and_last_message(db):
+    conversation = create_conversation()
+    sender, responder = conversation.get_turn_order()
+    add_turn(sender, responder, 'hello', START)
+    add_turn(responder, sender, 'general kenobi', START + timedelta(seconds=1))
+    transcript = Conversation.load(conversation.id).load_transcript()
+
+    # Agent 2 has nothing before agent 1's system prompt, it keeps its own.
+    at_first = conversation.fork(transcript[0].id)
+    assert contents(Conversation.load(at_first.id).load_transcript()) == ['agent 1', 'agent 2']
+    assert [message.content for message in at_first.agent_2_chat.get_chat_history()] == ['agent 2']
+
+    at_last = conversation.fork(transcript[-1].id)
+    assert contents(Conversation.load(at_last.id).load_transcript()) == contents(transcript)
+    assert at_last.get_turn_order() == (at_last.agent_1_chat, at_last.agent_2_chat)
@@ -0,0 +1,58 @@
+from database.db import session
+from enums.enums import ChatRole
+from models.chat import Chat
+from models.chat_message import ChatMessage
+from models.conversation import Conversation
+from models.message_search import _search_statement, search_messages
+
+RESPONSES = [
+    'We spend 50% of the budget on tokens.',
+    'That leaves 500 tokens for the summary.',
+    'Name the columns in snake_case.',
+    'Not in snakeXcase, and not with a back\\slash.',
+]
+
+
+def create_conversation() -> Conversation:
+    """A conversation whose agents take turns giving the RESPONSES."""
+    chats = [Chat.set_up_agent('model-1', 'agent 1'), Chat.set_up_agent('model-2', 'agent 2')]
+    for turn, content in enumerate(RESPONSES):
+        sender, responder = chats[turn % 2], chats[(turn + 1) % 2]
+        ChatMessage.save_all(
+            [
+                ChatMessage(chat_id=sender.id, role=ChatRole.ASSISTANT, model=sender.default_model, content=content),
+                ChatMessage(chat_id=responder.id, role=ChatRole.USER, model=sender.default_model, content=content),
+            ]
+        )
+    return Conversation(chats[0].id, chats[1].id).save()
+
+
+def fallback_search(query: str) -> list[str]:
+    """Contents found by the search for databases without a full-text index."""
+    return [snippet for _, snippet in session.execute(_search_statement('other', query))]
+
+
+def test_full_text_search(db):
+    conversation = create_conversation()
+
+    (result,) = search_messages('BUDGET spend')
+    # Responses are stored for both agents but found once, as the response of the agent that gave it.
+    assert (result.conv_id, result.agent, result.turn, result.role) == (conversation.id, 1, 1, ChatRole.ASSISTANT)
+    assert result.snippet == 'We **spend** 50% of the **budget** on tokens.'
+
+    # Punctuation in the query is taken literally, 50% is the word 50 and does not match 500.
+    assert [result.snippet for result in search_messages('50%')] == ['We spend **50**% of the budget on tokens.']
+    # Ordered by rank, the shorter response matches better.
+    assert [(result.turn, result.agent) for result in search_messages('tokens')] == [(2, 2), (1, 1)]
+    assert search_messages('tokens', conv_id=conversation.id + 1) == []
+    assert search_messages('"') == [] and search_messages('   ') == []
+
+
+def test_fallback_search_matches_wildcards_literally(db):
+    create_conversation()
+
+    assert fallback_search('50%') == [RESPONSES[0]]
+    assert fallback_search('snake_case') == [RESPONSES[2]]
+    assert fallback_search('BACK\\SLASH') == [RESPONSES[3]]
+    assert fallback_search('%') == [RESPONSES[0]]
+    assert fallback_search('_') == [RESPONSES[2]]
@@ -0,0 +1,75 @@
+from typing import Optional
+
+import ollama
+
+from database.db import session
+from enums.enums import ChatRole
+from models.chat import Chat
+from models.chat_message import ChatMessage
+from models.chat_message_metrics import ChatMessageMetrics
+from models.conversation import Conversation
+
+
+def create_conversation(ttfts_1: list[Optional[float]], ttfts_2: list[Optional[float]]) -> int:
+    """A conversation whose agents generated responses with the given times to first token."""
+    chats = [Chat.set_up_agent('model-1', 'agent 1'), Chat.set_up_agent('model-2', 'agent 2')]
+    for chat, ttfts in zip(chats, (ttfts_1, ttfts_2)):
+        messages = ChatMessage.save_all(
+            [
+                ChatMessage(
+                    chat_id=chat.id, role=ChatRole.ASSISTANT, model=chat.default_model, content=f'response {ttft}'
+                )
+                for ttft in ttfts
+            ]
+        )
+        final_chunk = ollama.ChatResponse(
+            model=chat.default_model,
+            done=True,
+            message=ollama.Message(role='assistant', content=''),
+            prompt_eval_count=3,
+            eval_count=10,
+            eval_duration=10**9,
+            load_duration=10**8,
+        )
+        session.add_all(
+            ChatMessageMetrics(
+                message.id, chat.default_model, final_chunk, time_to_first_token=ttft, db_write_duration=0.01
+            )
+            for message, ttft in zip(messages, ttfts)
+        )
+    session.commit()
+    return Conversation(chats[0].id, chats[1].id).save().id
+
+
+def test_stats_take_the_nearest_rank(db):
+    conv_id_1 = create_conversation([0.1, 0.2, 0.3, 0.4], [1.0, None])
+    conv_id_2 = create_conversation([float(ttft) for ttft in range(1, 11)], [2.0])
+
+    stats = ChatMessageMetrics.get_stats()
+
+    # Smallest time at least half and 95 percent of the turns took, turns without one are not counted.
+    assert [(s['conv_id'], s['model'], s['turns'], s['ttft_p50_s'], s['ttft_p95_s']) for s in stats] == [
+        (conv_id_1, 'model-1', 4, 0.2, 0.4),
+        (conv_id_1, 'model-2', 2, 1.0, 1.0),
+        (conv_id_2, 'model-1', 10, 5.0, 10.0),
+        (conv_id_2, 'model-2', 1, 2.0, 2.0),
+    ]
+    assert stats[0] == {
+        'conv_id': conv_id_1,
+        'model': 'model-1',
+        'turns': 4,
+        'prompt_tokens': 12,
+        'generated_tokens': 40,
+        'tokens_per_second': 10.0,
+        'ttft_p50_s': 0.2,
+        'ttft_p95_s': 0.4,
+        'load_s': 0.4,
+        'db_write_s': 0.04,
+    }
+
+    by_model = ChatMessageMetrics.get_stats(per_conversation=False)
+    assert [(s['model'], s['turns'], s['ttft_p50_s'], s['ttft_p95_s']) for s in by_model] == [
+        ('model-1', 14, 3.0, 10.0),
+        ('model-2', 3, 1.0, 2.0),
+    ]
+    assert [s['turns'] for s in ChatMessageMetrics.get_stats(conv_id=conv_id_2)] == [10, 1]
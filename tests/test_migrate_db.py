@@ -0,0 +1,113 @@
+from sqlalchemy import Column, DateTime, Enum, ForeignKey, Integer, MetaData, String, Table, func, inspect, select
+
+from database.db import get_db_engine, session
+from database.migrate_db import MIGRATIONS, migrate_db
+from enums.enums import ChatRole
+from models.chat import Chat
+from models.chat_message import ChatMessage
+from models.chat_message_metrics import ChatMessageMetrics
+from models.conversation import Conversation
+from models.message_content import MessageContent
+
+
+def create_baseline_schema() -> None:
+    """The tables as build-db created them before there were migrations."""
+    metadata = MetaData()
+
+    def base_columns() -> list[Column]:
+        return [
+            Column('id', Integer, primary_key=True, autoincrement=True),
+            Column('created_at', DateTime, server_default=func.now(), nullable=False),
+            Column('updated_at', DateTime, server_default=func.now(), nullable=False),
+        ]
+
+    chat = Table('chat', metadata, *base_columns(), Column('default_model', String(), nullable=False))
+    chat_message = Table(
+        'chat_message',
+        metadata,
+        *base_columns(),
+        Column('chat_id', Integer, ForeignKey('chat.id', ondelete='CASCADE'), nullable=False),
+        Column('content', String(), nullable=False),
+        Column('model', String(), nullable=True),
+        Column('role', Enum(ChatRole), nullable=False),
+    )
+    conversation = Table(
+        'conversation',
+        metadata,
+        *base_columns(),
+        Column('agent_1_chat_id', Integer, ForeignKey('chat.id'), nullable=False),
+        Column('agent_2_chat_id', Integer, ForeignKey('chat.id'), nullable=False),
+    )
+
+    with get_db_engine().begin() as connection:
+        metadata.create_all(connection)
+        connection.execute(chat.insert(), [{'id': 1, 'default_model': 'm1'}, {'id': 2, 'default_model': 'm2'}])
+        connection.execute(
+            chat_message.insert(),
+            [
+                {'id': 1, 'chat_id': 1, 'content': 'be agent 1', 'role': ChatRole.SYSTEM},
+                {'id': 2, 'chat_id': 2, 'content': 'be agent 2', 'role': ChatRole.SYSTEM},
+                {'id': 3, 'chat_id': 1, 'content': 'hello there', 'model': 'm1', 'role': ChatRole.ASSISTANT},
+                {'id': 4, 'chat_id': 2, 'content': 'hello there', 'model': 'm2', 'role': ChatRole.USER},
+                {'id': 5, 'chat_id': 2, 'content': 'general kenobi', 'model': 'm2', 'role': ChatRole.ASSISTANT},
+                {'id': 6, 'chat_id': 1, 'content': 'general kenobi', 'model': 'm1', 'role': ChatRole.USER},
+            ],
+        )
+        connection.execute(conversation.insert(), [{'id': 1, 'agent_1_chat_id': 1, 'agent_2_chat_id': 2}])
+
+
+def test_migrates_baseline_schema(empty_db):
+    create_baseline_schema()
+
+    applied = migrate_db()
+
+    assert [migration.version for migration in applied] == [migration.version for migration in MIGRATIONS]
+    assert migrate_db() == []
+
+    # Message bodies moved to message_content, each distinct body stored once.
+    assert session.scalar(select(func.count()).select_from(MessageContent)) == 4
+    messages = session.scalars(select(ChatMessage).order_by(ChatMessage.id)).all()
+    assert [message.content for message in messages] == [
+        'be agent 1',
+        'be agent 2',
+        'hello there',
+        'hello there',
+        'general kenobi',
+        'general kenobi',
+    ]
+    assert messages[2].content_id == messages[3].content_id
+
+    inspector = inspect(get_db_engine())
+    assert 'content' not in {column['name'] for column in inspector.get_columns('chat_message')}
+    assert {'ix_chat_message_chat_id_role_created_at', 'ix_chat_message_content_id'} <= {
+        index['name'] for index in inspector.get_indexes('chat_message')
+    }
+    assert {'ix_conversation_agent_1_chat_id', 'ix_conversation_agent_2_chat_id'} <= {
+        index['name'] for index in inspector.get_indexes('conversation')
+    }
+
+    # Usage of the budgets is counted from the responses written before them.
+    conversation = Conversation.load(1)
+    assert conversation.turn_count == 2
+    assert conversation.max_turns is None
+    assert [message.id for message in conversation.load_transcript()] == [1, 2, 3, 5]
+
+    # Tables get the constraints of the models, SQLite by rebuilding them, so deletes cascade like in a new database.
+    for model in (Chat, ChatMessage, ChatMessageMetrics, Conversation):
+        foreign_keys = {
+            (fk['constrained_columns'][0], fk['referred_table'], fk.get('options', {}).get('ondelete'))
+            for fk in inspector.get_foreign_keys(model.__tablename__)
+        }
+        assert foreign_keys == {
+            (fk.parent.name, fk.column.table.name, fk.ondelete) for fk in model.__table__.foreign_keys
+        }
+        columns = {column['name']: column['nullable'] for column in inspector.get_columns(model.__tablename__)}
+        assert columns == {column.name: column.nullable for column in model.__table__.columns}
+
+    assert Conversation.delete_many([1]) == [1]
+    for model in (Chat, ChatMessage, MessageContent):
+        assert session.scalar(select(func.count()).select_from(model)) == 0
+
+
+def test_created_database_has_nothing_to_migrate(db):
+    assert migrate_db() == []
@@ -0,0 +1,96 @@
+from enums.enums import RepetitionAction
+from integrations.repetition import MERSENNE_PRIME, ROLLING_BASE, RepetitionDetector
+
+WORDS = [f'word{i}' for i in range(200)]
+
+
+def text(start: int, stop: int) -> str:
+    return ' '.join(WORDS[start:stop])
+
+
+def jaccard(detector: RepetitionDetector, text_1: str, text_2: str) -> float:
+    shingles_1, shingles_2 = detector.shingle_hashes(text_1), detector.shingle_hashes(text_2)
+    return len(shingles_1 & shingles_2) / len(shingles_1 | shingles_2)
+
+
+def test_rolling_hash_matches_hashing_every_shingle():
+    detector = RepetitionDetector()
+
+    def direct_hash(shingle: list[str]) -> int:
+        shingle_hash = 0
+        for word in shingle:
+            shingle_hash = (shingle_hash * ROLLING_BASE + detector.shingle_hashes(word).pop()) % MERSENNE_PRIME
+        return shingle_hash
+
+    words = WORDS[:10]
+    assert detector.shingle_hashes(' '.join(words)) == {direct_hash(words[i : i + 3]) for i in range(8)}
+    # Shorter responses are a single shingle of all their words, empty ones have none.
+    assert detector.shingle_hashes('Hello, there!') == {direct_hash(['hello', 'there'])}
+    assert detector.shingle_hashes(' ...') == set()
+
+
+def test_similarity_estimates_jaccard():
+    detector = RepetitionDetector()
+
+    assert detector.similarity(detector.signature(text(0, 100)), detector.signature(text(0, 100))) == 1.0
+    # Case and punctuation do not make a response different.
+    assert detector.signature('Hello there, General Kenobi!') == detector.signature('hello there general kenobi')
+
+    for start in (10, 50, 90):
+        estimate = detector.similarity(detector.signature(text(0, 100)), detector.signature(text(start, start + 100)))
+        assert abs(estimate - jaccard(detector, text(0, 100), text(start, start + 100))) < 0.15
+
+    assert detector.similarity(detector.signature(text(0, 100)), detector.signature(text(100, 200))) < 0.1
+
+
+def test_stops_on_near_duplicate():
+    detector = RepetitionDetector(threshold=0.8)
+    near_duplicate = text(0, 100).replace('word50', 'something else')
+    assert jaccard(detector, text(0, 100), near_duplicate) > 0.9
+
+    detector.observe(1, text(0, 100))
+    assert detector.get_action(1) == RepetitionAction.CONTINUE
+    # Half of the words overlap, that is not repeating.
+    detector.observe(1, text(50, 150))
+    assert detector.get_action(1) == RepetitionAction.CONTINUE
+
+    assert detector.observe(1, near_duplicate) >= 0.8
+    assert detector.get_action(1) == RepetitionAction.STOP
+    # Every chat is compared with its own responses only.
+    assert detector.get_action(2) == RepetitionAction.CONTINUE
+
+
+def test_threshold_is_inclusive():
+    detector = RepetitionDetector(threshold=0.8)
+    detector.observe(1, text(0, 100))
+    similarity = detector.observe(1, text(0, 100).replace('word50', 'something else'))
+
+    detector.threshold = similarity
+    assert detector.get_action(1) == RepetitionAction.STOP
+    detector.threshold = similarity + 1 / 64
+    assert detector.get_action(1) == RepetitionAction.CONTINUE
+
+
+def test_compares_with_recent_responses_only():
+    detector = RepetitionDetector(window=2)
+    detector.observe(1, text(0, 100))
+    detector.observe(1, text(100, 200))
+    detector.observe(1, text(50, 150))
+
+    # The first response dropped out of the window.
+    detector.observe(1, text(0, 100))
+    assert detector.get_action(1) == RepetitionAction.CONTINUE
+
+
+def test_nudges_once_then_stops():
+    detector = RepetitionDetector(nudge='Talk about something else.')
+    detector.observe(1, text(0, 100))
+    detector.observe(1, text(0, 100))
+    assert detector.get_action(1) == RepetitionAction.NUDGE
+
+    # The responses before the nudge are forgotten, only repeating after it stops the conversation.
+    detector.mark_nudged([1])
+    detector.observe(1, text(0, 100))
+    assert detector.get_action(1) == RepetitionAction.CONTINUE
+    detector.observe(1, text(0, 100))
+    assert detector.get_action(1) == RepetitionAction.STOP
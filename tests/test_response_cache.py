@@ -0,0 +1,118 @@
+import contextlib
+import io
+import json
+
+from click.testing import CliRunner
+from sqlalchemy import func, select
+
+from benchmarks.fake_ollama import FakeOllamaServer
+from cli.batch import run_batch
+from cli.cli import cli
+from database.db import session
+from integrations.ollama_manager import AsyncOllamaManager, OllamaManager
+from integrations.response_cache import ResponseCache
+from models.chat import Chat
+from models.chat_message_metrics import ChatMessageMetrics
+from models.conversation import Conversation
+
+MESSAGES = [{'role': 'system', 'content': 'be brief'}, {'role': 'user', 'content': 'hello'}]
+
+
+def entry_size(chunks: list[str]) -> int:
+    return len(json.dumps({'chunks': chunks}, ensure_ascii=False).encode('utf-8'))
+
+
+def test_key_is_stable():
+    key = ResponseCache.make_key('model-1', {'seed': 42, 'temperature': 0}, MESSAGES)
+
+    # Keys name the files of earlier runs, they must not depend on dict order or change between versions.
+    assert key == ResponseCache.make_key(
+        'model-1', {'temperature': 0, 'seed': 42}, [dict(reversed(m.items())) for m in MESSAGES]
+    )
+    assert key == 'c788ec58b43e9b2e3ca5f91327a02eeed4e09475bd6f41c3634021cfa9567ba5'
+    assert ResponseCache.make_key('model-1', None, MESSAGES) == ResponseCache.make_key('model-1', {}, MESSAGES)
+
+    assert key != ResponseCache.make_key('model-2', {'seed': 42, 'temperature': 0}, MESSAGES)
+    assert key != ResponseCache.make_key('model-1', {'seed': 43, 'temperature': 0}, MESSAGES)
+    assert key != ResponseCache.make_key('model-1', {'seed': 42, 'temperature': 0}, MESSAGES[:1])
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResponseCache(directory=tmp_path, max_bytes=2 * entry_size(['a']))
+    cache.set('a', ['a'])
+    cache.set('b', ['b'])
+
+    assert cache.get('a') == ['a']
+    cache.set('c', ['c'])
+
+    assert cache.get('b') is None
+    assert cache.get('a') == ['a']
+    assert cache.get('c') == ['c']
+    assert (cache.hits, cache.misses) == (3, 1)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['a.json', 'c.json']
+
+    # Entries that do not fit at all are not stored, rather than evicting everything else.
+    cache.set('d', ['d' * 100])
+    assert cache.get('d') is None
+    assert cache.get('a') == ['a']
+
+
+def test_reloads_entries_from_directory(tmp_path):
+    ResponseCache(directory=tmp_path).set('a', ['hello', ' there'])
+
+    cache = ResponseCache(directory=tmp_path)
+    assert cache.get('a') == ['hello', ' there']
+
+    cache.clear()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_cache_hit_records_no_metrics(db, tmp_path):
+    with FakeOllamaServer(models=['model-1', 'model-2']) as server:
+        OllamaManager._async_manager = AsyncOllamaManager(host=server.url)
+        try:
+            response_cache = OllamaManager.enable_response_cache(directory=tmp_path)
+            # Set up the same way, the first turn of the second conversation sends the same messages.
+            conv_ids = [
+                Conversation(Chat.set_up_agent('model-1', 'agent 1').id, Chat.set_up_agent('model-2', 'agent 2').id)
+                .save()
+                .id
+                for _ in range(2)
+            ]
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = run_batch(conv_ids, max_turns=1, concurrency=1)
+        finally:
+            OllamaManager._async_manager = None
+
+    assert results == {conv_id: True for conv_id in conv_ids}
+    assert (response_cache.hits, response_cache.misses) == (1, 1)
+    assert [path for path, _ in server.requests].count('/api/chat') == 1 + 2  # preloads and the one generated turn
+
+    # Only the generated response has metrics, the replayed one still counts as a turn.
+    assert session.scalar(select(func.count()).select_from(ChatMessageMetrics)) == 1
+    assert [Conversation.load(conv_id).turn_count for conv_id in conv_ids] == [1, 1]
+    assert [Conversation.load(conv_id).generated_token_count for conv_id in conv_ids] == [32, 0]
+
+
+def test_generation_options_are_sent_with_every_response(db):
+    with FakeOllamaServer(models=['model-1', 'model-2']) as server:
+        OllamaManager._async_manager = AsyncOllamaManager(host=server.url)
+        try:
+            agent_1_chat, agent_2_chat = (
+                Chat.set_up_agent('model-1', 'agent 1'),
+                Chat.set_up_agent('model-2', 'agent 2'),
+            )
+            conv_id = Conversation(agent_1_chat.id, agent_2_chat.id, max_turns=3).save().id
+            # Two turns of the batch, then run-conversation continues until the budget of three turns.
+            for arguments in (
+                ['run-batch', '--conv_id', str(conv_id), '--max_turns', '2'],
+                ['run-conversation', '--conv_id', str(conv_id), '--interactive', 'False', '--no-render'],
+            ):
+                result = CliRunner().invoke(cli, [*arguments, '--seed', '42', '--temperature', '0'])
+                assert '❌' not in result.output, result.output
+        finally:
+            OllamaManager._async_manager = None
+
+    # Preloading sends no messages.
+    responses = [body for path, body in server.requests if path == '/api/chat' and body.get('messages')]
+    assert [body['options'] for body in responses] == [{'seed': 42, 'temperature': 0}] * 3
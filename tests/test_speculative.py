@@ -0,0 +1,103 @@
+import time
+
+import pytest
+from click.testing import CliRunner
+from sqlalchemy import func, select
+
+import cli.cli
+from benchmarks.fake_ollama import FakeOllamaServer
+from database.db import session
+from enums.enums import ChatRole
+from integrations.ollama_manager import AsyncOllamaManager, OllamaManager
+from models.chat import Chat
+from models.chat_message import ChatMessage
+from models.chat_message_metrics import ChatMessageMetrics
+from models.conversation import Conversation
+
+
+@pytest.fixture
+def ollama_server():
+    with FakeOllamaServer(models=['model-1', 'model-2'], tokens_per_response=8) as server:
+        OllamaManager._async_manager = AsyncOllamaManager(host=server.url)
+        yield server
+    OllamaManager._async_manager = None
+
+
+def create_conversation(**budgets) -> int:
+    agent_1_chat = Chat.set_up_agent('model-1', 'agent 1')
+    agent_2_chat = Chat.set_up_agent('model-2', 'agent 2')
+    return Conversation(agent_1_chat.id, agent_2_chat.id, **budgets).save().id
+
+
+def responses_generated(server: FakeOllamaServer) -> int:
+    # Preloading a model sends no messages.
+    return len([body for path, body in server.requests if path == '/api/chat' and body.get('messages')])
+
+
+def wait_until(condition) -> None:
+    deadline = time.monotonic() + 10
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def saved_turns(conv_id: int) -> tuple[int, int, int]:
+    """Turns counted against the budget, responses and metrics saved."""
+    session.expire_all()
+    conversation = Conversation.load(conv_id)
+    responses = len(conversation.get_messages(roles=[ChatRole.ASSISTANT]))
+    metrics = session.scalar(select(func.count()).select_from(ChatMessageMetrics))
+    return conversation.turn_count, responses, metrics
+
+
+def run_conversation(conv_id: int) -> str:
+    result = CliRunner().invoke(
+        cli.cli.cli, ['run-conversation', '--conv_id', str(conv_id), '--no-render', '--tail', '0']
+    )
+    assert '❌' not in result.output, result.output
+    return result.output
+
+
+def test_discarded_turn_is_not_saved(db, ollama_server):
+    conv_id = create_conversation()
+    sender, responder = Conversation.load(conv_id).get_turn_order()
+    messages_before = session.scalar(select(func.count()).select_from(ChatMessage))
+
+    speculative_chat = OllamaManager.start_speculative_chat(sender, responder)
+    # Discarded only once the whole response was generated, it is still not saved.
+    wait_until(lambda: speculative_chat.stream_stats.final_chunk is not None)
+    OllamaManager.discard_speculative_chat(speculative_chat)
+
+    assert speculative_chat.discarded
+    assert session.scalar(select(func.count()).select_from(ChatMessage)) == messages_before
+    assert saved_turns(conv_id) == (0, 0, 0)
+    with pytest.raises(AssertionError, match='discarded'):
+        list(OllamaManager.stream_speculative_chat(speculative_chat))
+
+
+def test_aborting_discards_the_speculative_turn(db, ollama_server, monkeypatch):
+    conv_id = create_conversation(max_turns=5)
+
+    def abort(conversation, speculative_chat):
+        # Like the menu's Abort, after the next turn was generated in the background.
+        wait_until(lambda: speculative_chat.stream_stats.final_chunk is not None)
+        OllamaManager.discard_speculative_chat(speculative_chat)
+        return False
+
+    monkeypatch.setattr(cli.cli, 'run_interactive_prompt', abort)
+    run_conversation(conv_id)
+
+    assert responses_generated(ollama_server) == 2
+    assert saved_turns(conv_id) == (1, 1, 1)
+
+
+def test_no_turn_is_speculated_past_the_budget(db, ollama_server, monkeypatch):
+    conv_id = create_conversation(max_turns=2)
+    monkeypatch.setattr(cli.cli, 'run_interactive_prompt', lambda conversation, speculative_chat: True)
+
+    output = run_conversation(conv_id)
+
+    # The second turn was generated while the menu was open, nothing after the last turn the budget allows.
+    assert 'used up its budget of turns (2 of 2)' in output
+    assert responses_generated(ollama_server) == 2
+    assert saved_turns(conv_id) == (2, 2, 2)